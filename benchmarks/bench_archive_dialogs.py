@@ -0,0 +1,68 @@
+'''
+Бенчмарк архивации диалогов: сколько старых диалогов в секунду переносится в сжатый архив
+и насколько уменьшаются данные.
+
+Запуск:
+    python benchmarks/bench_archive_dialogs.py --backend mongodb --mongodb-uri mongodb://localhost:27017 --dialogs 20000
+    python benchmarks/bench_archive_dialogs.py --backend sqlite --dialogs 20000
+'''
+
+import sys
+import asyncio
+import argparse
+from pathlib import Path
+from datetime import datetime, timedelta
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import database  # noqa: E402
+from bench_async_db import create_bench_storage, drop_bench_storage, bench_user  # noqa: E402
+
+
+N_USERS = 100
+
+
+def bench_dialog(dialog_id, user_id, start_time, n_messages):
+    messages = [
+        {
+            "user": f"Вопрос номер {i}: расскажи подробнее про архивацию диалогов в MongoDB",
+            "bot": "Старые диалоги сжимаются и переносятся в отдельную коллекцию, текущий диалог остается на месте. " * 3,
+            "date": start_time,
+            "n_tokens": 120,
+        }
+        for i in range(n_messages)
+    ]
+    return {"_id": dialog_id, "user_id": user_id, "chat_mode": "assistant", "start_time": start_time, "messages": messages}
+
+
+async def main(args):
+    storage = create_bench_storage(args)
+    await drop_bench_storage(storage)
+    storage = create_bench_storage(args)
+    await storage.migrate()
+
+    # the newest dialog of every user is its current one and must stay hot
+    old = datetime.now() - timedelta(days=365)
+    await storage.insert_users([bench_user(user_id, current_dialog_id=f"bench_dialog_{user_id}") for user_id in range(N_USERS)])
+    for i in range(args.dialogs):
+        user_id = i % N_USERS
+        dialog_id = f"bench_dialog_{user_id}" if i < N_USERS else f"bench_dialog_{user_id}_{i}"
+        await storage.insert_dialog(bench_dialog(dialog_id, user_id, old + timedelta(seconds=i), args.messages))
+
+    report = await database.AsyncDatabase(storage).archive_dialogs(older_than_days=30)
+    print(f"archived {report['n_dialogs']} of {args.dialogs} dialogs ({report['n_messages']} messages) in {report['elapsed']:.2f}s "
+          f"({report['n_dialogs'] / report['elapsed']:.0f} dialogs/s)")
+    print(f"messages {report['raw_bytes'] / 2**20:.1f} MiB -> archive {report['archived_bytes'] / 2**20:.1f} MiB, "
+          f"reclaimed {report['reclaimed_bytes'] / 2**20:.1f} MiB")
+
+    await drop_bench_storage(storage)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["mongodb", "sqlite"], default="mongodb")
+    parser.add_argument("--mongodb-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--db-name", default="chatgpt_telegram_bot_bench")
+    parser.add_argument("--dialogs", type=int, default=20000)
+    parser.add_argument("--messages", type=int, default=10)
+    asyncio.run(main(parser.parse_args()))
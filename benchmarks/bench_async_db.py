@@ -0,0 +1,136 @@
+'''
+Бенчмарк: сколько конкурентных апдейтов проходит через слой БД
+с синхронным Database (pymongo) и с AsyncDatabase.
+
+Каждый "апдейт" повторяет обращения к БД из message_handle:
+проверка пользователя, token_limit, current_chat_mode, last_interaction,
+запись last_interaction и чтение сообщений диалога.
+
+Запуск:
+    python benchmarks/bench_async_db.py --backend mongodb --mongodb-uri mongodb://localhost:27017 --updates 500
+    python benchmarks/bench_async_db.py --backend sqlite --updates 500  # офлайн, без MongoDB
+'''
+
+import sys
+import time
+import asyncio
+import argparse
+from pathlib import Path
+from datetime import datetime
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import database  # noqa: E402
+
+
+N_USERS = 50
+
+
+def use_bench_db(db, db_name):
+    # не трогаем боевую базу chatgpt_telegram_bot
+    db.db = db.client[db_name]
+    db.user_collection = db.db["user"]
+    db.dialog_collection = db.db["dialog"]
+    return db
+
+
+def create_bench_storage(args):
+    """Хранилище для бенчмарков: отдельная база MongoDB или SQLite в памяти."""
+    if args.backend == "mongodb":
+        from mongo_storage import MongoStorage
+        return MongoStorage(args.mongodb_uri, db_name=args.db_name)
+    else:
+        from sqlite_storage import SQLiteStorage
+        return SQLiteStorage(":memory:")
+
+
+async def drop_bench_storage(storage):
+    if hasattr(storage, "client"):
+        await storage.client.drop_database(storage.db.name)
+    await storage.close()
+
+
+def bench_user(user_id, **fields):
+    user_dict = {
+        "_id": user_id, "chat_id": user_id, "username": f"bench_{user_id}", "first_name": "Bench", "last_name": "User",
+        "last_interaction": datetime.now(), "first_seen": datetime.now(),
+        "current_dialog_id": f"bench_dialog_{user_id}", "current_chat_mode": "assistant",
+        "n_used_tokens": 0, "token_limit": 10000, "is_admin": False, "is_paid_sub": False,
+    }
+    user_dict.update(fields)
+    return user_dict
+
+
+async def heartbeat(stop: asyncio.Event, interval: float = 0.005):
+    """Измеряет максимальную задержку event loop'а (время, на которое он был заблокирован)."""
+    max_lag = 0.0
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        t = loop.time()
+        await asyncio.sleep(interval)
+        max_lag = max(max_lag, loop.time() - t - interval)
+    return max_lag
+
+
+async def sync_update(db, user_id):
+    # так выглядел хендлер до перехода: синхронные вызовы внутри корутины
+    db.check_if_user_exists(user_id)
+    db.get_user_attribute(user_id, "token_limit")
+    db.get_user_attribute(user_id, "current_chat_mode")
+    db.get_user_attribute(user_id, "last_interaction")
+    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.get_dialog_messages(user_id)
+
+
+async def async_update(db, user_id):
+    await db.check_if_user_exists(user_id)
+    await db.get_user_attribute(user_id, "token_limit")
+    await db.get_user_attribute(user_id, "current_chat_mode")
+    await db.get_user_attribute(user_id, "last_interaction")
+    db.touch_user(user_id)
+    await db.get_dialog_messages(user_id)
+
+
+async def run(name, update_func, db, n_updates):
+    stop = asyncio.Event()
+    hb = asyncio.ensure_future(heartbeat(stop))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[update_func(db, i % N_USERS) for i in range(n_updates)])
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    max_lag = await hb
+    print(f"{name:>14}: {n_updates} updates in {elapsed:.2f}s "
+          f"({n_updates / elapsed:.0f} updates/s), max event loop stall {max_lag * 1000:.1f} ms")
+
+
+async def prepare(storage):
+    await storage.migrate()
+    await storage.insert_users([bench_user(user_id) for user_id in range(N_USERS)])
+    for user_id in range(N_USERS):
+        await storage.insert_dialog({
+            "_id": f"bench_dialog_{user_id}", "user_id": user_id, "chat_mode": "assistant",
+            "start_time": datetime.now(), "messages": []
+        })
+
+
+async def main(args):
+    storage = create_bench_storage(args)
+    await prepare(storage)
+
+    if args.backend == "mongodb":
+        sync_db = use_bench_db(database.Database(args.mongodb_uri), args.db_name)
+        await run("sync pymongo", sync_update, sync_db, args.updates)
+    await run(f"async {args.backend}", async_update, database.AsyncDatabase(storage), args.updates)
+
+    await drop_bench_storage(storage)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["mongodb", "sqlite"], default="mongodb")
+    parser.add_argument("--mongodb-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--db-name", default="chatgpt_telegram_bot_bench")
+    parser.add_argument("--updates", type=int, default=500)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,53 @@
+'''
+Бенчмарк выгрузки /get_users: время и пиковая память Python при потоковой записи gzip CSV.
+
+Запуск:
+    python benchmarks/bench_export_users.py --backend mongodb --mongodb-uri mongodb://localhost:27017 --users 1000000
+    python benchmarks/bench_export_users.py --backend sqlite --users 1000000
+'''
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import database  # noqa: E402
+from bench_async_db import create_bench_storage, drop_bench_storage  # noqa: E402
+from bench_update_balance import fill_users  # noqa: E402
+
+
+async def main(args):
+    storage = create_bench_storage(args)
+    await storage.migrate()
+    await fill_users(storage, args.users)
+    db = database.AsyncDatabase(storage)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "users.csv.gz")
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        count = await db.export_users_csv(path)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(f"exported {count} users in {elapsed:.2f}s, file {os.path.getsize(path) / 2**20:.1f} MiB, "
+              f"peak python memory {peak / 2**20:.1f} MiB")
+
+    await drop_bench_storage(storage)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["mongodb", "sqlite"], default="mongodb")
+    parser.add_argument("--mongodb-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--db-name", default="chatgpt_telegram_bot_bench")
+    parser.add_argument("--users", type=int, default=1000000)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,99 @@
+'''
+Бенчмарк RequestScheduler на имитации OpenAI с лимитом запросов в минуту.
+
+Без планировщика все запросы уходят сразу, и все, что выше лимита, получает 429.
+С планировщиком запросы ждут места в бюджете: показывается пропускная способность
+при насыщении и время ожидания в очереди по полосам приоритета.
+
+Запуск:
+    python benchmarks/bench_request_scheduler.py --rpm 600 --requests 900
+'''
+
+import sys
+import time
+import random
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import openai  # noqa: E402
+
+import openai_utils  # noqa: E402
+
+
+class FakeOpenAI:
+    """Отвечает за latency секунд и возвращает 429 сверх rpm запросов в минуту."""
+
+    def __init__(self, rpm, latency):
+        self.bucket = openai_utils.TokenBucket(rpm)
+        self.latency = latency
+        self.n_ok = 0
+        self.n_rate_limited = 0
+
+    async def acreate(self, **kwargs):
+        if self.bucket.wait_time(1) > 0:
+            self.n_rate_limited += 1
+            raise openai.error.RateLimitError("Rate limit reached for requests")
+        self.bucket.consume(1)
+        await asyncio.sleep(self.latency)
+        self.n_ok += 1
+        return {"usage": {"total_tokens": 100}}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def without_scheduler(args):
+    upstream = FakeOpenAI(args.rpm, args.latency)
+    results = await asyncio.gather(*[upstream.acreate() for _ in range(args.requests)], return_exceptions=True)
+    n_errors = sum(isinstance(result, Exception) for result in results)
+    print(f"without scheduler: {upstream.n_ok} ok, {n_errors} failed with 429")
+
+
+async def with_scheduler(args):
+    upstream = FakeOpenAI(args.rpm, args.latency)
+    scheduler = openai_utils.RequestScheduler(rpm=args.rpm, max_retries=3)
+
+    rnd = random.Random(0)
+    lanes = [openai_utils.PRIORITY_ADMIN] * 1 + [openai_utils.PRIORITY_PAID] * 3 + [openai_utils.PRIORITY_FREE] * 16
+    waits = {priority: [] for priority in openai_utils.PRIORITY_LANES}
+
+    async def request(priority):
+        enqueued_at = time.perf_counter()
+        await scheduler.acquire(priority)
+        waits[priority].append(time.perf_counter() - enqueued_at)
+        await upstream.acreate()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[request(rnd.choice(lanes)) for _ in range(args.requests)])
+    elapsed = time.perf_counter() - start
+
+    print(f"with scheduler: {upstream.n_ok} ok, {upstream.n_rate_limited} failed with 429, "
+          f"{args.requests} requests in {elapsed:.1f}s")
+    # after the initial burst the throughput is capped by the refill rate
+    n_after_burst = max(0, args.requests - args.rpm)
+    if n_after_burst > 0:
+        print(f"  saturated throughput: {n_after_burst / max(elapsed - args.latency, 1e-9) * 60:.0f} requests/min (limit {args.rpm})")
+    for priority, lane_waits in waits.items():
+        if lane_waits:
+            print(f"  {openai_utils.PRIORITY_LANES[priority]:>10}: {len(lane_waits)} requests, "
+                  f"wait p50 {percentile(lane_waits, 0.5):.2f}s, p95 {percentile(lane_waits, 0.95):.2f}s, max {max(lane_waits):.2f}s")
+
+
+async def main(args):
+    await without_scheduler(args)
+    await with_scheduler(args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rpm", type=int, default=600)
+    parser.add_argument("--requests", type=int, default=900)
+    parser.add_argument("--latency", type=float, default=0.3)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,142 @@
+'''
+Бенчмарк правок потоковых ответов в Telegram.
+
+Имитирует chats чатов, в каждом из которых модель стримит ответ со скоростью tokens_per_second,
+и Telegram, который пропускает не больше одной правки в секунду на чат и 30 в секунду на бота,
+а сверх лимита отвечает flood wait на retry_after секунд (AIORateLimiter ждет и повторяет).
+
+Сравниваются:
+    - прежний способ: правка на каждые 100 новых символов и sleep(0.01);
+    - StreamRenderer с общим EditScheduler.
+
+Для каждого способа показывается число правок на ответ и время до финального текста.
+
+Запуск:
+    python benchmarks/bench_stream_edits.py --chats 20 --tokens 600 --tokens-per-second 80
+'''
+
+import sys
+import time
+import random
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import streaming  # noqa: E402
+
+
+WORDS = ["def", " self", ".", "value", " =", " None", "\n    ", "return", " (", ")", ":", " # ", "x", "[i]"]
+
+
+class FakeTelegram:
+    def __init__(self, chat_interval=1.0, global_rate=30, retry_after=3.0):
+        self.chat_interval = chat_interval
+        self.global_rate = global_rate
+        self.retry_after = retry_after
+        self._last_call = {}
+        self._recent_calls = []
+        self.n_calls = 0
+        self.n_flood_waits = 0
+
+    async def _call(self, chat_id):
+        while True:
+            now = time.monotonic()
+            self._recent_calls = [t for t in self._recent_calls if t > now - 1]
+            if now - self._last_call.get(chat_id, -1e9) >= self.chat_interval and len(self._recent_calls) < self.global_rate:
+                break
+            self.n_flood_waits += 1
+            await asyncio.sleep(self.retry_after)
+
+        self._last_call[chat_id] = now
+        self._recent_calls.append(now)
+        self.n_calls += 1
+        await asyncio.sleep(0.05)  # request latency
+
+    async def edit_message_text(self, text, chat_id, message_id, parse_mode=None):
+        await self._call(chat_id)
+
+
+class FakeMessage:
+    def __init__(self, telegram, chat_id, message_id=1):
+        self.telegram = telegram
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    async def reply_text(self, text, parse_mode=None):
+        await self.telegram._call(self.chat_id)
+        return FakeMessage(self.telegram, self.chat_id, self.message_id + 1)
+
+
+async def stream(n_tokens, tokens_per_second):
+    for _ in range(n_tokens):
+        await asyncio.sleep(1 / tokens_per_second)
+        yield random.choice(WORDS)
+
+
+async def answer_fixed(telegram, chat_id, n_tokens, tokens_per_second):
+    start = time.monotonic()
+    n_edits = 0
+    answer = ""
+    prev_answer = ""
+    sent_message = None
+    async for delta in stream(n_tokens, tokens_per_second):
+        answer += delta
+        if sent_message is None:
+            sent_message = await FakeMessage(telegram, chat_id).reply_text(answer)
+        elif len(answer) - len(prev_answer) >= 100:
+            await telegram.edit_message_text(answer, chat_id=chat_id, message_id=sent_message.message_id)
+            await asyncio.sleep(0.01)
+            n_edits += 1
+        else:
+            continue
+        prev_answer = answer
+
+    await telegram.edit_message_text(answer, chat_id=chat_id, message_id=sent_message.message_id)
+    return n_edits + 1, time.monotonic() - start
+
+
+async def answer_renderer(telegram, scheduler, chat_id, n_tokens, tokens_per_second):
+    renderer = streaming.StreamRenderer(telegram, FakeMessage(telegram, chat_id), None, scheduler)
+    buffer = streaming.StreamBuffer()
+    async for delta in stream(n_tokens, tokens_per_second):
+        buffer.append(delta)
+        await renderer.update(buffer)
+    await renderer.finish(buffer.getvalue())
+    return renderer.n_edits, time.monotonic() - renderer.started_at
+
+
+async def bench(name, answers):
+    results = await asyncio.gather(*answers)
+    n_edits = [result[0] for result in results]
+    times = sorted(result[1] for result in results)
+    print(f"{name:<10} edits per answer {sum(n_edits) / len(n_edits):6.1f}, "
+          f"time to final median {times[len(times) // 2]:6.2f}s / max {times[-1]:6.2f}s")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--tokens", type=int, default=600)
+    parser.add_argument("--tokens-per-second", type=float, default=80)
+    args = parser.parse_args()
+
+    random.seed(0)
+    print(f"{args.chats} chats, {args.tokens} tokens per answer at {args.tokens_per_second} tokens/s "
+          f"(pure generation {args.tokens / args.tokens_per_second:.1f}s)")
+
+    telegram = FakeTelegram()
+    await bench("fixed", [answer_fixed(telegram, chat_id, args.tokens, args.tokens_per_second) for chat_id in range(args.chats)])
+    print(f"           flood waits {telegram.n_flood_waits}")
+
+    telegram = FakeTelegram()
+    scheduler = streaming.EditScheduler()
+    await bench("renderer", [
+        answer_renderer(telegram, scheduler, chat_id, args.tokens, args.tokens_per_second) for chat_id in range(args.chats)
+    ])
+    print(f"           flood waits {telegram.n_flood_waits}, {scheduler.stats()}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,174 @@
+'''
+Бенчмарк пути потокового ответа от OpenAI до StreamRenderer, как в message_handle.
+
+Поток из n_tokens дельт (по умолчанию 4096, как длинный ответ с кодом) проходит через настоящий
+ChatGPT.send_message_stream (openai.ChatCompletion.acreate подменен на готовый поток) и отрисовывается
+настоящим StreamRenderer. Telegram отвечает мгновенно, а бюджет времени правок снят (правка на каждые
+min_chars символов), поэтому измеряется только работа бота на дельту и на правку. Сравниваются:
+    - accumulated: прежний способ - ответ копится в строке (answer += delta), и на каждой дельте отдается целиком;
+    - two buffers: дельты собираются и в StreamBuffer генератора, и в StreamBuffer message_handle;
+    - one buffer: генератор дописывает дельты в StreamBuffer message_handle, из которого читает StreamRenderer.
+
+Запуск:
+    python benchmarks/bench_streaming.py --tokens 4096 --repeat 20
+    python benchmarks/bench_streaming.py --tokens 4096 --min-chars 1000  # реже правки - виднее цена дельты
+'''
+
+import sys
+import time
+import random
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import openai  # noqa: E402
+from telegram.constants import ParseMode  # noqa: E402
+
+import tokens  # noqa: E402
+import streaming  # noqa: E402
+import openai_utils  # noqa: E402
+
+
+CODE_TOKENS = ["def", " ", "self", ".", "x", " = ", "(", ")", ":", "\n    ", "return", " None", "  # ", "value", "[i]", ", "]
+
+
+def make_deltas(n_tokens):
+    random.seed(0)
+    return [random.choice(CODE_TOKENS) for _ in range(n_tokens)]
+
+
+class Delta(dict):
+    __getattr__ = dict.__getitem__
+
+
+def make_stream_items(deltas):
+    return [
+        type("StreamItem", (), {"choices": [type("Choice", (), {"delta": Delta(content=delta)})]})
+        for delta in deltas
+    ]
+
+
+class FakeBot:
+    async def edit_message_text(self, text, chat_id, message_id, parse_mode=None):
+        pass
+
+
+class FakeMessage:
+    chat_id = 1
+    message_id = 1
+
+    async def reply_text(self, text, parse_mode=None):
+        return self
+
+
+class AnswerView:
+    """Всё, что StreamRenderer.update читает из буфера, поверх уже собранной строки."""
+
+    def __init__(self, answer):
+        self.answer = answer
+
+    def __len__(self):
+        return len(self.answer)
+
+    def getvalue(self, start=0):
+        return self.answer[start:]
+
+
+def create_renderer(min_chars):
+    # no time budget for edits: every min_chars new symbols are rendered, so the cost of each edit counts
+    scheduler = streaming.EditScheduler(interval=0, min_chars=min_chars, global_rate=float("inf"))
+    return streaming.StreamRenderer(FakeBot(), FakeMessage(), ParseMode.HTML, scheduler)
+
+
+async def accumulated_stream(message, stream_items):
+    # send_message_stream before deltas: the whole answer so far on every chunk
+    answer = ""
+    async for r_item in openai_stream(stream_items):
+        delta = r_item.choices[0].delta
+        if "content" in delta:
+            answer += delta.content
+            yield "not_finished", answer
+    n_used_tokens = tokens.count_chat_tokens(message, [], "assistant", answer)
+    yield "finished", answer.strip(), n_used_tokens, 0
+
+
+async def openai_stream(stream_items):
+    for r_item in stream_items:
+        yield r_item
+
+
+async def consume_accumulated(stream_items, min_chars):
+    renderer = create_renderer(min_chars)
+    async for gen_item in accumulated_stream("hi", stream_items):
+        if gen_item[0] == "not_finished":
+            await renderer.update(AnswerView(gen_item[1]))
+        else:
+            await renderer.finish(gen_item[1])
+    return renderer.n_edits
+
+
+async def consume_two_buffers(stream_items, min_chars):
+    renderer = create_renderer(min_chars)
+    buffer = streaming.StreamBuffer()
+    async for gen_item in openai_utils.ChatGPT().send_message_stream("hi"):
+        if gen_item[0] == "not_finished":
+            buffer.append(gen_item[1])
+            await renderer.update(buffer)
+        else:
+            await renderer.finish(gen_item[1])
+    return renderer.n_edits
+
+
+async def consume_one_buffer(stream_items, min_chars):
+    renderer = create_renderer(min_chars)
+    buffer = streaming.StreamBuffer()
+    async for gen_item in openai_utils.ChatGPT().send_message_stream("hi", buffer=buffer):
+        if gen_item[0] == "not_finished":
+            await renderer.update(buffer)
+        else:
+            await renderer.finish(gen_item[1])
+    return renderer.n_edits
+
+
+async def bench(name, consumer, stream_items, repeat, min_chars):
+    async def acreate(**kwargs):
+        return openai_stream(stream_items)
+
+    openai.ChatCompletion.acreate = acreate
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        n_edits = await consumer(stream_items, min_chars)
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    print(f"{name:<12} median {timings[len(timings) // 2] * 1000:8.2f} ms, "
+          f"min {timings[0] * 1000:8.2f} ms, edits {n_edits}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=4096)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--min-chars", type=int, default=100)
+    args = parser.parse_args()
+
+    # the request itself is not measured: no queue, no key pool, no completion cache
+    openai_utils.chat_scheduler = openai_utils.RequestScheduler(rpm=10 ** 9)
+    openai_utils.completion_cache = None
+
+    deltas = make_deltas(args.tokens)
+    stream_items = make_stream_items(deltas)
+    print(f"{args.tokens} deltas, answer {sum(len(delta) for delta in deltas)} symbols")
+
+    for _ in range(2):  # the first round warms up tiktoken and the formatting regexes
+        await bench("accumulated", consume_accumulated, stream_items, args.repeat, args.min_chars)
+        await bench("two buffers", consume_two_buffers, stream_items, args.repeat, args.min_chars)
+        await bench("one buffer", consume_one_buffer, stream_items, args.repeat, args.min_chars)
+        print()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,87 @@
+'''
+Микро-бенчмарк подсчета токенов одного хода диалога разной длины.
+
+legacy: как было в ChatGPT._count_tokens_for_chatgpt - encoding_for_model на каждый ответ
+и кодирование всего промпта, включая system prompt.
+cached: tokens.count_chat_tokens - энкодер из кэша, prompt_start посчитан при старте,
+у сообщений диалога уже есть n_tokens, кодируются только новое сообщение и ответ.
+
+Запуск:
+    python benchmarks/bench_token_counting.py --turns 200
+'''
+
+import sys
+import time
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import tiktoken  # noqa: E402
+
+import tokens  # noqa: E402
+import openai_utils  # noqa: E402
+
+
+MODEL = "gpt-3.5-turbo"
+DIALOG_LENGTHS = [1, 10, 50, 200]
+
+
+def legacy_count(prompt_messages, answer, model=MODEL):
+    prompt_messages = prompt_messages + [{"role": "assistant", "content": answer}]
+
+    encoding = tiktoken.encoding_for_model(model)
+    n_tokens = 0
+    for message in prompt_messages:
+        n_tokens += 4
+        for key, value in message.items():
+            if key == "role":
+                n_tokens += 1
+            elif key == "content":
+                n_tokens += len(encoding.encode(value))
+    n_tokens -= 1
+    return n_tokens
+
+
+def make_dialog(n_messages):
+    dialog_messages = []
+    for i in range(n_messages):
+        dialog_message = {
+            "user": f"Вопрос {i}: как работает кэширование энкодеров tiktoken?",
+            "bot": f"Ответ {i}: энкодер создается один раз и переиспользуется. " * 5,
+        }
+        # as stored by append_dialog_message
+        dialog_message["n_tokens"] = tokens.count_dialog_message_tokens(dialog_message, model=MODEL)
+        dialog_messages.append(dialog_message)
+    return dialog_messages
+
+
+def main(args):
+    chatgpt = openai_utils.ChatGPT()
+    tokens.warm_up(models=[MODEL])
+
+    for n_messages in DIALOG_LENGTHS:
+        dialog_messages = make_dialog(n_messages)
+
+        # every turn brings a new message and a new answer (unique per dialog length, so the memo can't help)
+        turns = [(f"Вопрос {n_messages}-{i}", f"Ответ {n_messages}-{i}. " * 20) for i in range(args.turns)]
+
+        start = time.perf_counter()
+        for message, answer in turns:
+            prompt_messages = chatgpt._generate_prompt_messages_for_chatgpt_api(message, dialog_messages, "assistant")
+            legacy_n_tokens = legacy_count(prompt_messages, answer)
+        legacy_elapsed = (time.perf_counter() - start) / args.turns
+
+        start = time.perf_counter()
+        for message, answer in turns:
+            cached_n_tokens = tokens.count_chat_tokens(message, dialog_messages, "assistant", answer, model=MODEL)
+        cached_elapsed = (time.perf_counter() - start) / args.turns
+
+        print(f"{n_messages:>4} dialog messages: legacy {legacy_elapsed * 1000:.3f} ms/turn ({legacy_n_tokens} tokens), "
+              f"cached {cached_elapsed * 1000:.3f} ms/turn ({cached_n_tokens} tokens), x{legacy_elapsed / cached_elapsed:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=200)
+    main(parser.parse_args())
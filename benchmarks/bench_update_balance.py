@@ -0,0 +1,75 @@
+'''
+Бенчмарк ежедневного пополнения баланса на синтетической коллекции пользователей.
+
+Сравнивает старый цикл по всем пользователям (Database.update_balance_every_day,
+~4 запроса на пользователя, только MongoDB) и set-based вариант
+AsyncDatabase.update_balance_every_day (один курсор по индексу token_limit + один update_many).
+
+Запуск:
+    python benchmarks/bench_update_balance.py --backend mongodb --mongodb-uri mongodb://localhost:27017 --users 100000
+    python benchmarks/bench_update_balance.py --backend sqlite --users 100000
+'''
+
+import sys
+import time
+import random
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import config  # noqa: E402
+import database  # noqa: E402
+from bench_async_db import use_bench_db, create_bench_storage, drop_bench_storage, bench_user  # noqa: E402
+
+
+BATCH_SIZE = 10000
+
+
+async def fill_users(storage, n_users, seed=0):
+    """Создает n_users пользователей, примерно половина из которых потратила часть баланса."""
+    rnd = random.Random(seed)
+
+    batch = []
+    for user_id in range(n_users):
+        token_limit = rnd.choice([config.token_limit_for_users, rnd.randint(-1000, config.token_limit_for_users - 1)])
+        batch.append(bench_user(user_id, token_limit=token_limit))
+        if len(batch) == BATCH_SIZE:
+            await storage.insert_users(batch)
+            batch = []
+    if batch:
+        await storage.insert_users(batch)
+
+
+async def main(args):
+    if args.backend == "mongodb":
+        storage = create_bench_storage(args)
+        await drop_bench_storage(storage)
+        storage = create_bench_storage(args)
+        await storage.migrate()
+        await fill_users(storage, args.users)
+
+        sync_db = use_bench_db(database.Database(args.mongodb_uri), args.db_name)
+        start = time.perf_counter()
+        n_updated = len(sync_db.update_balance_every_day())
+        print(f"  per-user loop: {n_updated} of {args.users} users refilled in {time.perf_counter() - start:.2f}s")
+        await drop_bench_storage(storage)
+
+    storage = create_bench_storage(args)
+    await storage.migrate()
+    await fill_users(storage, args.users)
+    start = time.perf_counter()
+    n_updated = len(await database.AsyncDatabase(storage).update_balance_every_day())
+    print(f"set-based update: {n_updated} of {args.users} users refilled in {time.perf_counter() - start:.2f}s")
+
+    await drop_bench_storage(storage)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["mongodb", "sqlite"], default="mongodb")
+    parser.add_argument("--mongodb-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--db-name", default="chatgpt_telegram_bot_bench")
+    parser.add_argument("--users", type=int, default=100000)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,145 @@
+'''
+Проверки AsyncDatabase на встроенном SQLite (без MongoDB): гонки и сбои между шагами записи.
+
+Запуск:
+    python benchmarks/check_database.py
+'''
+
+import sys
+import asyncio
+from pathlib import Path
+from datetime import datetime, timedelta
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import database  # noqa: E402
+from sqlite_storage import SQLiteStorage  # noqa: E402
+
+
+async def create_db():
+    db = database.AsyncDatabase(SQLiteStorage(":memory:"))
+    await db.migrate()
+    await db.add_new_user(1, 1, username="check", first_name="Check", last_name="User")
+    return db
+
+
+async def check_payment_is_credited_once_after_crash():
+    db = await create_db()
+    balance_before = await db.get_user_attribute(1, "token_limit")
+    assert await db.add_payment(1, "charge-1", "telegram-1", 69, "RUB", 10000)
+
+    # the process "crashes" after the top-up, before the payment is marked credited
+    mark_payment_credited = db.storage._mark_payment_credited
+
+    def crash(payment_id):
+        raise RuntimeError("crash")
+
+    db.storage._mark_payment_credited = crash
+    try:
+        await db.credit_payment("charge-1")
+    except RuntimeError:
+        pass
+    db.storage._mark_payment_credited = mark_payment_credited
+
+    # a redelivery and the startup pass race for the same payment
+    redelivered, pending = await asyncio.gather(db.credit_payment("charge-1"), db.credit_pending_payments())
+    assert await db.credit_payment("charge-1") is None
+    assert await db.credit_pending_payments() == []
+
+    db.user_cache.clear()
+    assert await db.get_user_attribute(1, "token_limit") == balance_before + 10000
+    assert (redelivered is not None) != (len(pending) == 1), (redelivered, pending)
+    await db.close()
+
+
+async def check_read_in_flight_does_not_overwrite_newer_cache():
+    db = await create_db()
+    db.user_cache.clear()
+
+    find_user = db.storage.find_user
+    read_done = asyncio.Event()
+    charged = asyncio.Event()
+
+    async def slow_find_user(user_id):
+        user_dict = await find_user(user_id)
+        read_done.set()
+        await charged.wait()  # the charge finishes while the old document is still on its way
+        return user_dict
+
+    db.storage.find_user = slow_find_user
+    read = asyncio.create_task(db.get_user(1))
+    await read_done.wait()
+    db.storage.find_user = find_user
+
+    balance = await db.charge_tokens(1, 9000)
+    charged.set()
+    user_dict = await read
+
+    assert balance == 1000, balance
+    assert user_dict["token_limit"] == 1000, user_dict["token_limit"]
+    assert await db.get_user_attribute(1, "token_limit") == 1000
+    await db.close()
+
+
+async def check_overdraft_reset_keeps_concurrent_top_up():
+    db = await create_db()
+    assert await db.charge_tokens(1, 10500) == -500
+
+    # check_token_limit read -500, then a payment lands before the overdraft is cleared
+    assert await db.top_up_tokens(1, 10000, is_paid_sub=True) == 9500
+    await db.clear_overdraft(1)
+    assert await db.get_user_attribute(1, "token_limit") == 9500
+    db.user_cache.clear()
+    assert await db.get_user_attribute(1, "token_limit") == 9500
+
+    # nothing landed in between: the overdraft is cleared in storage and in the cache
+    assert await db.charge_tokens(1, 10000) == -500
+    await db.clear_overdraft(1)
+    assert await db.get_user_attribute(1, "token_limit") == 0
+    db.user_cache.clear()
+    assert await db.get_user_attribute(1, "token_limit") == 0
+    await db.close()
+
+
+async def check_window_skips_only_unsummarized_messages():
+    db = await create_db()
+    await db.start_new_dialog(1)
+    started_at = datetime(2026, 1, 1)
+    for i in range(10):
+        dialog_message = {"user": f"question {i}", "bot": f"answer {i}", "date": started_at + timedelta(minutes=i), "n_tokens": 10}
+        await db.append_dialog_message(1, dialog_message)
+
+    # messages 0-2 are folded into the summary; the window is smaller than the unsummarized tail of 7
+    summary_until = started_at + timedelta(minutes=2)
+    assert await db.set_dialog_summary(1, "summary", summary_until, None)
+
+    dialog_messages, n_skipped = await db.get_dialog_messages_window(1, 1000, max_messages=4, summary_until=summary_until)
+    assert [dialog_message["user"] for dialog_message in dialog_messages] == [f"question {i}" for i in range(6, 10)]
+    assert n_skipped == 3, n_skipped
+
+    # the token budget trims the window further
+    dialog_messages, n_skipped = await db.get_dialog_messages_window(1, 25, max_messages=4, summary_until=summary_until)
+    assert len(dialog_messages) == 2 and n_skipped == 5, (dialog_messages, n_skipped)
+
+    # everything is summarized: nothing is reported as skipped
+    dialog_messages, n_skipped = await db.get_dialog_messages_window(
+        1, 1000, max_messages=4, summary_until=started_at + timedelta(minutes=9)
+    )
+    assert dialog_messages == [] and n_skipped == 0, (dialog_messages, n_skipped)
+    await db.close()
+
+
+async def main():
+    checks = [
+        check_payment_is_credited_once_after_crash,
+        check_read_in_flight_does_not_overwrite_newer_cache,
+        check_overdraft_reset_keeps_concurrent_top_up,
+        check_window_skips_only_unsummarized_messages,
+    ]
+    for check in checks:
+        await check()
+        print(f"ok {check.__name__}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
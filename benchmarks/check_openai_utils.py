@@ -0,0 +1,197 @@
+'''
+Проверки openai_utils без обращения к OpenAI: функции openai подменяются на время проверки.
+
+Запуск:
+    python benchmarks/check_openai_utils.py
+'''
+
+import io
+import sys
+import asyncio
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import openai  # noqa: E402
+
+import openai_utils  # noqa: E402
+import completion_cache  # noqa: E402
+
+
+def create_pool():
+    return openai_utils.ApiKeyPool([
+        openai_utils.ApiEndpoint("sk-check-aaaa"),
+        openai_utils.ApiEndpoint("sk-check-bbbb", api_base="http://localhost:8000/v1"),
+    ])
+
+
+async def check_transcribe_audio_uses_key_pool():
+    pool = create_pool()
+    calls = []
+
+    async def atranscribe(model, audio_file, **kwargs):
+        calls.append(kwargs)
+        return {"text": audio_file.read().decode("utf-8")}
+
+    atranscribe_before, audio_scheduler_before = openai.Audio.atranscribe, openai_utils.audio_scheduler
+    openai.Audio.atranscribe = atranscribe
+    openai_utils.audio_scheduler = openai_utils.RequestScheduler(rpm=600, key_pool=pool)
+    try:
+        texts = [await openai_utils.transcribe_audio(io.BytesIO(b"hello")) for _ in range(2)]
+    finally:
+        openai.Audio.atranscribe, openai_utils.audio_scheduler = atranscribe_before, audio_scheduler_before
+
+    assert texts == ["hello", "hello"], texts
+    assert [call["api_key"] for call in calls] == ["sk-check-aaaa", "sk-check-bbbb"], calls
+    assert "api_base" not in calls[0] and calls[1]["api_base"] == "http://localhost:8000/v1", calls
+    assert all(stats["outstanding"] == 0 for stats in pool.stats())
+
+
+class Delta(dict):
+    __getattr__ = dict.__getitem__
+
+
+def stream_item(content):
+    return type("StreamItem", (), {"choices": [type("Choice", (), {"delta": Delta(content=content)})]})
+
+
+async def stream(contents, gate=None):
+    for content in contents:
+        if gate is not None:
+            await gate.wait()
+        yield stream_item(content)
+
+
+async def collect(gen):
+    items = [item async for item in gen]
+    return items[-1][1]
+
+
+async def check_stream_waiter_stops_waiting_for_stuck_leader():
+    gate = asyncio.Event()  # the leader's stream never gets going
+    n_requests = 0
+
+    async def acreate(**kwargs):
+        nonlocal n_requests
+        n_requests += 1
+        return stream(["stuck"], gate=gate) if n_requests == 1 else stream(["hello", " world"])
+
+    acreate_before, chat_scheduler_before, cache_before = (
+        openai.ChatCompletion.acreate, openai_utils.chat_scheduler, openai_utils.completion_cache
+    )
+    openai.ChatCompletion.acreate = acreate
+    openai_utils.chat_scheduler = openai_utils.RequestScheduler(rpm=600)
+    cache = openai_utils.completion_cache = completion_cache.CompletionCache(wait_timeout=0.05)
+    try:
+        chatgpt = openai_utils.ChatGPT()
+        leader = asyncio.create_task(collect(chatgpt.send_message_stream("hi")))
+        await asyncio.sleep(0.01)
+        answer = await asyncio.wait_for(collect(chatgpt.send_message_stream("hi")), 1)
+
+        assert answer == "hello world", answer
+        assert cache.stats()["timeouts"] == 1 and cache.stats()["in_flight"] == 1, cache.stats()
+
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+        assert cache.stats()["in_flight"] == 0, cache.stats()
+    finally:
+        openai.ChatCompletion.acreate, openai_utils.chat_scheduler, openai_utils.completion_cache = (
+            acreate_before, chat_scheduler_before, cache_before
+        )
+
+
+async def check_closed_stream_releases_singleflight_key():
+    async def acreate(**kwargs):
+        return stream(["hello", " world"])
+
+    acreate_before, chat_scheduler_before, cache_before = (
+        openai.ChatCompletion.acreate, openai_utils.chat_scheduler, openai_utils.completion_cache
+    )
+    openai.ChatCompletion.acreate = acreate
+    openai_utils.chat_scheduler = openai_utils.RequestScheduler(rpm=600)
+    cache = openai_utils.completion_cache = completion_cache.CompletionCache()
+    try:
+        # the consumer gives up after the first delta, like message_handle when rendering fails
+        gen = openai_utils.ChatGPT().send_message_stream("hi")
+        await gen.__anext__()
+        assert cache.stats()["in_flight"] == 1
+        await gen.aclose()
+        assert cache.stats()["in_flight"] == 0, cache.stats()
+    finally:
+        openai.ChatCompletion.acreate, openai_utils.chat_scheduler, openai_utils.completion_cache = (
+            acreate_before, chat_scheduler_before, cache_before
+        )
+
+
+async def check_stream_holds_key_until_finished():
+    pool = create_pool()
+    gate = asyncio.Event()
+
+    async def broken_stream():
+        yield stream_item("hello")
+        raise openai.error.APIConnectionError("connection reset")
+
+    async def acreate(**kwargs):
+        return broken_stream() if kwargs["api_key"] == "sk-check-bbbb" else stream(["hello", " world"], gate=gate)
+
+    scheduler = openai_utils.RequestScheduler(rpm=600, key_pool=pool)
+    r_gen = await scheduler.run(acreate, stream=True)
+    assert [stats["outstanding"] for stats in pool.stats()] == [1, 0], pool.stats()
+    gate.set()
+    assert [item.choices[0].delta.content async for item in r_gen] == ["hello", " world"]
+    assert [stats["outstanding"] for stats in pool.stats()] == [0, 0], pool.stats()
+
+    # a stream that breaks midway is an error of its key
+    r_gen = await scheduler.run(acreate, stream=True)
+    try:
+        async for _ in r_gen:
+            pass
+    except openai.error.APIConnectionError:
+        pass
+    assert [stats["outstanding"] for stats in pool.stats()] == [0, 0], pool.stats()
+    assert [stats["errors"] for stats in pool.stats()] == [0, 1], pool.stats()
+
+    # an abandoned stream gives its key back when it is closed
+    r_gen = await scheduler.run(acreate, stream=True)
+    await r_gen.__anext__()
+    await r_gen.aclose()
+    assert [stats["outstanding"] for stats in pool.stats()] == [0, 0], pool.stats()
+
+
+async def check_session_counts_stream_until_closed():
+    session = openai_utils.OpenAISession()
+
+    async def acreate(**kwargs):
+        return stream(["hello", " world"])
+
+    r_gen = await session.call(acreate, stream=True)
+    assert session.stats()["in_flight"] == 1
+    await r_gen.__anext__()
+    assert session.stats()["in_flight"] == 1, session.stats()
+    assert [item async for item in r_gen] and session.stats()["in_flight"] == 0, session.stats()
+
+    # through the scheduler, and abandoned after the first chunk
+    scheduler = openai_utils.RequestScheduler(rpm=600, session=session, key_pool=create_pool())
+    r_gen = await scheduler.run(acreate, stream=True)
+    await r_gen.__anext__()
+    assert session.stats()["in_flight"] == 1, session.stats()
+    await r_gen.aclose()
+    assert session.stats()["in_flight"] == 0, session.stats()
+    assert session.stats()["max_in_flight"] == 1 and session.stats()["requests"] == 2, session.stats()
+
+
+async def main():
+    checks = [
+        check_transcribe_audio_uses_key_pool,
+        check_stream_waiter_stops_waiting_for_stuck_leader,
+        check_closed_stream_releases_singleflight_key,
+        check_stream_holds_key_until_finished,
+        check_session_counts_stream_until_closed,
+    ]
+    for check in checks:
+        await check()
+        print(f"ok {check.__name__}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,137 @@
+'''
+Проверки очередей обработки сообщений: очередь пользователя (user_queue) и лимиты нагрузки (admission).
+
+Запуск:
+    python benchmarks/check_queues.py
+'''
+
+import sys
+import asyncio
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import admission  # noqa: E402
+import user_queue  # noqa: E402
+
+
+async def hold_user_slot(queue, user_id, gate, statuses):
+    async with queue.slot(user_id) as status:
+        statuses.append(status)
+        if status == user_queue.ADMITTED:
+            await gate.wait()
+
+
+async def check_user_queue_cancel_while_queued():
+    for drop_policy in user_queue.DROP_POLICIES:
+        queue = user_queue.UserRequestQueue(max_depth=2, drop_policy=drop_policy)
+        gate = asyncio.Event()
+        statuses = []
+
+        first = asyncio.create_task(hold_user_slot(queue, 1, gate, statuses))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(hold_user_slot(queue, 1, gate, statuses))
+        await asyncio.sleep(0)
+        assert queue.depth(1) == 1
+
+        # the turn is released while the queued task is already cancelled, before it gets to run
+        gate.set()
+        second.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+
+        assert second.cancelled()
+        assert not queue.is_busy(1), f"{drop_policy}: the user stays busy"
+        assert len(queue) == 0
+
+        # the user is served again afterwards
+        third = asyncio.create_task(hold_user_slot(queue, 1, gate, statuses))
+        await asyncio.wait_for(third, 1)
+        assert statuses == [user_queue.ADMITTED, user_queue.ADMITTED], statuses
+        assert not queue.is_busy(1)
+
+
+async def check_user_queue_drop_oldest_skips_cancelled():
+    queue = user_queue.UserRequestQueue(max_depth=1, drop_policy=user_queue.DROP_OLDEST)
+    gate = asyncio.Event()
+    statuses = []
+
+    first = asyncio.create_task(hold_user_slot(queue, 1, gate, statuses))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(hold_user_slot(queue, 1, gate, statuses))
+    await asyncio.sleep(0)
+
+    # the queued task is cancelled and a newer message arrives before the cancellation is handled
+    second.cancel()
+    third = asyncio.create_task(hold_user_slot(queue, 1, gate, statuses))
+    await asyncio.sleep(0)
+    gate.set()
+    await asyncio.gather(first, second, third, return_exceptions=True)
+
+    assert statuses == [user_queue.ADMITTED, user_queue.ADMITTED], statuses
+    assert not queue.is_busy(1)
+
+
+async def hold_admission_slot(controller, gate, results):
+    async with controller.slot() as admitted:
+        results.append(admitted)
+        if admitted:
+            await gate.wait()
+
+
+async def check_admission_cancel_while_queued():
+    controller = admission.AdmissionController("check", max_concurrency=1, max_queue=2)
+    gate = asyncio.Event()
+    results = []
+
+    first = asyncio.create_task(hold_admission_slot(controller, gate, results))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(hold_admission_slot(controller, gate, results))
+    await asyncio.sleep(0)
+    assert controller.queued == 1
+
+    # the slot is released while the queued task is already cancelled, before it gets to run
+    gate.set()
+    second.cancel()
+    results_of_tasks = await asyncio.gather(first, second, return_exceptions=True)
+
+    assert isinstance(results_of_tasks[1], asyncio.CancelledError), results_of_tasks
+    assert controller.in_flight == 0 and controller.queued == 0, controller.stats()
+
+
+async def check_admission_cancel_after_handover():
+    controller = admission.AdmissionController("check", max_concurrency=1, max_queue=2)
+    gate = asyncio.Event()
+    gate.set()
+    results = []
+
+    holder = controller.slot()
+    assert await holder.__aenter__()
+    second = asyncio.create_task(hold_admission_slot(controller, gate, results))
+    third = asyncio.create_task(hold_admission_slot(controller, gate, results))
+    await asyncio.sleep(0)
+    assert controller.queued == 2
+
+    # the slot is handed to the second task, which is cancelled before it runs: the slot goes on to the third
+    await holder.__aexit__(None, None, None)
+    second.cancel()
+    await asyncio.gather(second, third, return_exceptions=True)
+
+    assert second.cancelled()
+    assert results == [True], results
+    assert controller.in_flight == 0 and controller.queued == 0, controller.stats()
+
+
+async def main():
+    checks = [
+        check_user_queue_cancel_while_queued,
+        check_user_queue_drop_oldest_skips_cancelled,
+        check_admission_cancel_while_queued,
+        check_admission_cancel_after_handover,
+    ]
+    for check in checks:
+        await check()
+        print(f"ok {check.__name__}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+'''
+Проверки выбора границы сообщения (streaming.find_split_point) и бюджета правок (streaming.EditScheduler).
+
+Запуск:
+    python benchmarks/check_streaming.py
+'''
+
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+import streaming  # noqa: E402
+
+
+def check_split_point_in_first_half_is_rejected():
+    # the only paragraph break is in the first half: the message is cut at the limit instead
+    text = "a" * 10 + "\n\n" + "b" * 200
+    assert streaming.find_split_point(text, 100) == 100
+
+
+def check_split_point_prefers_later_separator():
+    text = "a" * 10 + "\n\n" + "b" * 60 + " " + "c" * 200
+    assert streaming.find_split_point(text, 100) == 73  # after the space, not after the early paragraph break
+
+    text = "a" * 60 + "\n\n" + "b" * 200
+    assert streaming.find_split_point(text, 100) == 62
+
+
+def check_split_point_outside_code_block():
+    text = "a" * 55 + "\n" + "```\n" + "b" * 10 + "\n" + "c" * 200
+    # the line break at 70 is inside the code block, the one at 55 is outside and in the second half
+    assert streaming.find_split_point(text, 100) == 56
+
+    text = "a" * 20 + "\n" + "```\n" + "b" * 50 + "\n" + "c" * 200
+    # the only break outside the block is in the first half: a break inside the block is taken
+    assert streaming.find_split_point(text, 100) == 76
+
+
+def check_concurrent_streams_share_global_budget():
+    scheduler = streaming.EditScheduler(interval=0, min_chars=1, global_rate=3)
+
+    # five streams of different chats ask in the same tick, before any edit is awaited
+    allowed = [scheduler.should_edit(chat_id, 100) for chat_id in range(5)]
+    assert allowed == [True, True, True, False, False], allowed
+
+    # the reserved edits are not counted a second time when they are recorded
+    for chat_id in range(3):
+        scheduler.record(chat_id, time.monotonic(), reserved=True)
+    assert len(scheduler._recent_edits) == 3
+    assert not scheduler.should_edit(3, 100)
+
+
+def main():
+    checks = [
+        check_split_point_in_first_half_is_rejected,
+        check_split_point_prefers_later_separator,
+        check_split_point_outside_code_block,
+        check_concurrent_streams_share_global_budget,
+    ]
+    for check in checks:
+        check()
+        print(f"ok {check.__name__}")
+
+
+if __name__ == "__main__":
+    main()
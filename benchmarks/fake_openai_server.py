@@ -0,0 +1,111 @@
+'''
+Локальная имитация OpenAI API для проверки пула ключей и нагрузочных тестов.
+
+Отвечает на /v1/chat/completions (обычный ответ и SSE при stream=true) с задержкой latency
+секунд и возвращает 429 сверх rpm запросов в минуту. В config.yml сервер подключается как
+один из ключей пула:
+
+    openai_api_keys:
+      - {api_key: "sk-local-1", api_base: "http://localhost:8000/v1"}
+      - {api_key: "sk-local-2", api_base: "http://localhost:8001/v1"}
+
+Запуск:
+    python benchmarks/fake_openai_server.py --port 8000 --rpm 600 --latency 0.5
+'''
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve() / "bot"))
+
+from aiohttp import web  # noqa: E402
+
+import openai_utils  # noqa: E402
+
+
+ANSWER = "Это ответ локальной имитации OpenAI API."
+
+
+def completion_chunk(request_id, model, delta, finish_reason=None):
+    return {
+        "id": request_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+async def chat_completions(request):
+    app = request.app
+    app["n_requests"] += 1
+    if app["bucket"].wait_time(1) > 0:
+        app["n_rate_limited"] += 1
+        return web.json_response(
+            {"error": {"message": "Rate limit reached for requests", "type": "requests", "code": None}},
+            status=429,
+        )
+    app["bucket"].consume(1)
+
+    payload = await request.json()
+    model = payload.get("model", "gpt-3.5-turbo")
+    request_id = f"chatcmpl-local-{app['n_requests']}"
+    await asyncio.sleep(app["latency"])
+
+    if not payload.get("stream", False):
+        return web.json_response({
+            "id": request_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": ANSWER}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+
+    chunks = [completion_chunk(request_id, model, {"role": "assistant"})]
+    chunks += [completion_chunk(request_id, model, {"content": word + " "}) for word in ANSWER.split()]
+    chunks.append(completion_chunk(request_id, model, {}, finish_reason="stop"))
+    for chunk in chunks:
+        await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+        await asyncio.sleep(app["chunk_delay"])
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+async def on_shutdown(app):
+    print(f"requests: {app['n_requests']}, 429: {app['n_rate_limited']}")
+
+
+def create_app(rpm, latency, chunk_delay):
+    app = web.Application()
+    app["bucket"] = openai_utils.TokenBucket(rpm)
+    app["latency"] = latency
+    app["chunk_delay"] = chunk_delay
+    app["n_requests"] = 0
+    app["n_rate_limited"] = 0
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--rpm", type=int, default=600)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--chunk-delay", type=float, default=0.05)
+    args = parser.parse_args()
+
+    web.run_app(create_app(args.rpm, args.latency, args.chunk_delay), port=args.port)
+
+
+if __name__ == "__main__":
+    main()
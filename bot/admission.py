@@ -0,0 +1,110 @@
+'''
+Контроль допуска: ограничение одновременной работы по классам нагрузки.
+
+У каждого класса (чат, распознавание голоса, DALL-E, озвучка, рассылка) свой AdmissionController:
+не больше max_concurrency задач выполняются одновременно, еще max_queue ждут своей очереди, а все,
+что сверх этого, сразу отклоняется - пользователь быстро получает ответ "бот занят" вместо того,
+чтобы его запрос копился в памяти и тормозил всех остальных.
+'''
+
+import time
+import asyncio
+import contextlib
+from collections import deque
+
+
+BUSY = "busy"  # limits are reached, the task is rejected
+
+
+class AdmissionController:
+    def __init__(self, name: str, max_concurrency: int, max_queue: int = 0):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+
+        self.in_flight = 0
+        self._waiters = deque()  # futures of queued tasks, FIFO
+
+        self.n_admitted = 0
+        self.n_queued = 0
+        self.n_rejected = 0
+        self.max_in_flight = 0
+        self.total_wait = 0.0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Отдает True, когда задачу можно выполнять, и False, если лимиты исчерпаны и задача отклонена."""
+        if not await self._acquire():
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            self._release()
+
+    async def _acquire(self) -> bool:
+        if self.in_flight < self.max_concurrency and not self._waiters:
+            self._admit()
+            return True
+
+        if len(self._waiters) >= self.max_queue:
+            self.n_rejected += 1
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        self.n_queued += 1
+
+        started_at = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed over right before the cancellation: give it back
+                self._release()
+            elif future in self._waiters:
+                # _release may have popped and skipped it already
+                self._waiters.remove(future)
+            raise
+        finally:
+            self.total_wait += time.monotonic() - started_at
+        return True
+
+    def _admit(self):
+        self.in_flight += 1
+        self.n_admitted += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def _release(self):
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < self.max_concurrency:
+            # the slot goes straight to the oldest waiter, so new tasks can't overtake the queue
+            future = self._waiters.popleft()
+            if not future.done():
+                self._admit()
+                future.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "max_in_flight": self.max_in_flight,
+            "queued": self.queued,
+            "max_queue": self.max_queue,
+            "admitted": self.n_admitted,
+            "rejected": self.n_rejected,
+            "wait_avg": self.total_wait / self.n_queued if self.n_queued > 0 else 0.0,
+        }
+
+
+def create_controllers(limits: dict) -> dict:
+    """limits: {класс: {"max_concurrency": ..., "max_queue": ...}} -> {класс: AdmissionController}."""
+    return {
+        name: AdmissionController(name, class_limits["max_concurrency"], class_limits.get("max_queue", 0))
+        for name, class_limits in limits.items()
+    }
@@ -1,10 +1,10 @@
-import csv
 import logging
 import asyncio
 import traceback
 import html
 import json
 import tempfile
+import contextlib
 import pydub
 import platform
 from pathlib import Path
@@ -24,19 +24,34 @@ import openai
 import config
 import database
 import openai_utils
+import tokens
+import streaming
+import user_queue
+import admission
 from get_current_usd import usd_rate_check
 from synthesis import main
 import messages
 
 
 # setup
-db = database.Database()
+db = database.AsyncDatabase()
 logger = logging.getLogger(__name__)
-user_semaphores = {}
+user_request_queue = user_queue.UserRequestQueue(
+    max_depth=config.user_queue_depth,
+    drop_policy=config.user_queue_drop_policy
+)
+admission_controllers = admission.create_controllers(config.admission_limits)
+summarizing_dialogs = set()
+edit_scheduler = streaming.EditScheduler(
+    interval=config.stream_edit_interval,
+    min_chars=config.stream_edit_min_chars,
+    global_rate=config.stream_global_edit_rate
+)
 platname = platform.system()
 
 ZERO = 0
 GROUP_ATTR = '-'
+BUSY_TEXT = "🚦 <b>Сейчас слишком много запросов.</b> Пожалуйста, повторите через минуту"
 CWD = Path.cwd()
 
 
@@ -48,23 +63,48 @@ def split_text_into_chunks(text, chunk_size):
         yield text[i:i + chunk_size]
 
 
+async def reply_busy(update: Update):
+    await update.effective_message.reply_text(BUSY_TEXT, parse_mode=ParseMode.HTML)
+
+
+def with_admission(workload: str, handler):
+    """Хендлер, который целиком выполняется в лимите класса нагрузки workload (сверх лимита - быстрый ответ "занято")."""
+    async def admitted_handler(update: Update, context: CallbackContext):
+        async with admission_controllers[workload].slot() as admitted:
+            if not admitted:
+                await reply_busy(update)
+                return
+            await handler(update, context)
+
+    return admitted_handler
+
+
+@contextlib.asynccontextmanager
+async def chat_turn(user_id: int):
+    """Очередь пользователя, затем общий лимит чата. Отдает статус user_queue или admission.BUSY."""
+    async with user_request_queue.slot(user_id) as status:
+        if status != user_queue.ADMITTED:
+            yield status
+            return
+
+        async with admission_controllers["chat"].slot() as admitted:
+            yield status if admitted else admission.BUSY
+
+
 async def register_user_if_not_exists(update: Update, context: CallbackContext, user: User):
     # if not db.check_if_user_exists(user.id) and not update.message.from_user.is_bot:
-    if not db.check_if_user_exists(user.id):
-        db.add_new_user(
+    if not await db.check_if_user_exists(user.id):
+        await db.add_new_user(
             user.id,
             update.message.chat_id,
             username=user.username,
             first_name=user.first_name,
             last_name= user.last_name
         )
-        db.start_new_dialog(user.id)
-
-    if db.get_user_attribute(user.id, "current_dialog_id") is None:
-        db.start_new_dialog(user.id)
+        await db.start_new_dialog(user.id)
 
-    if user.id not in user_semaphores:
-        user_semaphores[user.id] = asyncio.Semaphore(1)
+    if await db.get_user_attribute(user.id, "current_dialog_id") is None:
+        await db.start_new_dialog(user.id)
 
 
 async def check_token_limit(update: Update, context: CallbackContext):
@@ -77,12 +117,12 @@ async def check_token_limit(update: Update, context: CallbackContext):
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     user_id = update.message.from_user.id
-    balance = db.get_user_attribute(user_id, 'token_limit')
+    balance = await db.get_user_attribute(user_id, 'token_limit')
 
     if balance <= ZERO and user_id not in config.admin_ids:
         text = "🥲 К сожалению, Вы исчерпали весь лимит токенов на сегодня.\n\nВы можете подождать ежедневного обновления токенов или купить пакет токенов."
         await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
-        db.set_user_attribute(user_id, 'token_limit', ZERO)
+        await db.clear_overdraft(user_id)
         return False
     return True
 
@@ -110,14 +150,14 @@ async def reset_token_limit(update: Update, context: CallbackContext):
             await context.bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
             return
         
-        if not db.check_if_user_exists(int(context.args[0])):
+        if not await db.check_if_user_exists(int(context.args[0])):
             
             text=f"Пользователь с user_id: <code>{int(context.args[0])}</code> не зарегистрирован"
             await context.bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
             return
         else:
-            db.set_user_attribute(int(context.args[0]), 'token_limit', ZERO)
-            username = db.get_user_attribute(int(context.args[0]), "username")
+            await db.set_user_attribute(int(context.args[0]), 'token_limit', ZERO)
+            username = await db.get_user_attribute(int(context.args[0]), "username")
             text=f"Баланс пользователя с user_id: <code>{int(context.args[0])} username: @{username}</code> обнулен!"
             text_for_user = 'Администратор обнулил Ваш баланс.'
             await context.bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
@@ -151,12 +191,12 @@ async def add_token_limit_by_id(update: Update, context: CallbackContext):
             await context.bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
             return
         
-        if not db.check_if_user_exists(int(context.args[0])):
+        if not await db.check_if_user_exists(int(context.args[0])):
             text=f"Пользователь с user_id: <code>{int(context.args[0])}</code> не зарегистрирован"
             await context.bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
             return
         else:
-            db.set_user_attribute(int(context.args[0]), 'token_limit', db.get_user_attribute(int(context.args[0]), 'token_limit') + int(context.args[1]))
+            await db.top_up_tokens(int(context.args[0]), int(context.args[1]))
             text=f"Баланс пользователя с user_id: <code>{int(context.args[0])}</code> пополнен на {int(context.args[1])} токенов!"
             await context.bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
             text=f"Ваш баланс пополнен на {int(context.args[1])} токенов!\nПроверить баланс можно в профиле /profile"
@@ -177,21 +217,16 @@ async def send_users_list_for_admin(update: Update, context: CallbackContext):
 
     date = (str(datetime.now())[:10:])
     if platname == 'Windows':
-        path_to_users_file = f'{CWD}/max_gpt4_bot/users/users.csv'
+        path_to_users_file = f'{CWD}/max_gpt4_bot/users/users.csv.gz'
     else:
-        path_to_users_file = f'{CWD}/users/users_{date}.csv'
+        path_to_users_file = f'{CWD}/users/users_{date}.csv.gz'
     
     
     if user_id in config.admin_ids:
-        user_list_csv, count = db.get_users_list(user_id)
+        count = await db.export_users_csv(path_to_users_file)
 
-        header = ['Number', "ID", 'Username', 'First_name', 'Last_name', 'Last_interaction', 'N_used_tokens', 'Balance', 'Is_admin', 'Is_paid_sub']
-        with open(path_to_users_file, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(header)
-            writer.writerows(user_list_csv)
-
-        await update.message.reply_document(open(path_to_users_file, 'rb'), caption=f'👤 Всего юзеров: <b>{count}</b>', parse_mode=ParseMode.HTML)
+        with open(path_to_users_file, 'rb') as f:
+            await update.message.reply_document(f, caption=f'👤 Всего юзеров: <b>{count}</b>', parse_mode=ParseMode.HTML)
     else:
         await update.message.reply_text("Эта команда доступна только администраторам.")
         return
@@ -207,20 +242,15 @@ async def send_paid_subs_list_for_admin(update: Update, context: CallbackContext
     date = (str(datetime.now())[:10:])
     
     if platname == 'Windows':
-        path_to_users_file = f'{CWD}/max_gpt4_bot/users/paid_subs.csv'
+        path_to_users_file = f'{CWD}/max_gpt4_bot/users/paid_subs.csv.gz'
     else:
-        path_to_users_file = f'{CWD}/users/paid_subs_{date}.csv'
+        path_to_users_file = f'{CWD}/users/paid_subs_{date}.csv.gz'
     
     if user_id in config.admin_ids:
-        paid_subs_list_csv, count = db.get_paid_subs_list(user_id)
-
-        header = ['Number', "ID", 'Username', 'First_name', 'Last_name', 'Last_interaction', 'N_used_tokens', 'Balance', 'Is_admin', 'Is_paid_sub']
-        with open(path_to_users_file, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(header)
-            writer.writerows(paid_subs_list_csv)
+        count = await db.export_users_csv(path_to_users_file, paid_subs_only=True)
 
-        await update.message.reply_document(open(path_to_users_file, 'rb'), caption=f'👤 Всего платных подписчиков: <b>{count}</b>', parse_mode=ParseMode.HTML)
+        with open(path_to_users_file, 'rb') as f:
+            await update.message.reply_document(f, caption=f'👤 Всего платных подписчиков: <b>{count}</b>', parse_mode=ParseMode.HTML)
     else:
         await update.message.reply_text("Эта команда доступна только администраторам.")
         return
@@ -231,7 +261,7 @@ async def send_prices(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.touch_user(user_id)
 
     keyboard = []
     for package, package_dict in config.prices_package.items():
@@ -305,31 +335,123 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
         399: 100000
     }
     
-    date = (str(datetime.now())[:10:])
     user_id = update.message.from_user.id
+    successful_payment = update.message.successful_payment
+    
+    total_amount = int(successful_payment.total_amount)/100
+    provider_payment_charge_id = successful_payment.provider_payment_charge_id  
+    n_tokens = prices_dict[total_amount]
+    
+    # Telegram может доставить один и тот же платеж повторно - зачисляем токены только один раз
+    is_new_payment = await db.add_payment(
+        user_id,
+        provider_payment_charge_id,
+        successful_payment.telegram_payment_charge_id,
+        total_amount,
+        successful_payment.currency,
+        n_tokens
+    )
+    # a repeated delivery still credits a payment whose earlier top-up failed
+    balance = await db.credit_payment(provider_payment_charge_id)
+    if balance is None:
+        logger.warning(f"Payment {provider_payment_charge_id} is already processed")
+        return
+    if not is_new_payment:
+        logger.warning(f"Payment {provider_payment_charge_id} was recorded earlier but credited only now")
+
+    await update.message.reply_text(f"Спасибо за платеж❤️\n\nВаш баланс равен {balance} токенов!\nПроверить баланс можно в личном кабинете /profile")
     
-    total_amount = int(update.message.successful_payment.total_amount)/100
-    provider_payment_charge_id = update.message.successful_payment.provider_payment_charge_id  
-    
-    db.set_user_attribute(user_id, 'token_limit', prices_dict[total_amount] + db.get_user_attribute(user_id, 'token_limit'))
-    db.set_user_attribute(user_id, 'is_paid_sub', True)
+    username = update.message.from_user.username
+    text = f"💰 Совершен платеж!\n\n👤 <b>ID:</b> <code>{user_id}</code> @{username}\n💵 <b>Сумма:</b> {total_amount} {successful_payment.currency}\n🪙 <b>Токены:</b> {n_tokens}\n🧾 <b>Provider_payment_charge_id:</b> <code>{provider_payment_charge_id}</code>"
+    await context.bot.send_message(config.admin_ids[0], text, parse_mode=ParseMode.HTML)
+
+
+async def send_payments_list_for_admin(update: Update, context: CallbackContext):
+    """Функция для админа. Отправляет файл с журналом платежей."""
+    if update.edited_message is not None:
+        await edited_message_handle(update, context)
+        return
+    user_id = update.message.from_user.id
     
-    header = ["Date", "ID", 'Username', 'First_name', 'Last_name', 'Last_interaction', 'N_used_tokens', 'Balance', 'Is_admin', 'Is_paid_sub', "Provider_payment_charge_id"]
+    date = (str(datetime.now())[:10:])
     
     if platname == 'Windows':
-        path_to_users_file = f'{CWD}/max_gpt4_bot/users/provider_payment_charge_id.csv'
+        path_to_payments_file = f'{CWD}/max_gpt4_bot/users/payments.csv.gz'
     else:
-        path_to_users_file = f'{CWD}/users/provider_payment_charge_id.csv'
+        path_to_payments_file = f'{CWD}/users/payments_{date}.csv.gz'
     
-    user_attr = db.get_one_paid_sub_list(user_id, date, provider_payment_charge_id)
-    
-    with open(path_to_users_file, 'a', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(header)
-        writer.writerows(user_attr)
+    if user_id in config.admin_ids:
+        count = await db.export_payments_csv(path_to_payments_file)
+
+        with open(path_to_payments_file, 'rb') as f:
+            await update.message.reply_document(f, caption=f'💰 Всего платежей: <b>{count}</b>', parse_mode=ParseMode.HTML)
+    else:
+        await update.message.reply_text("Эта команда доступна только администраторам.")
+        return
+
+
+async def stats_handle(update: Update, context: CallbackContext):
+    """Функция для админа. Показывает метрики кэшей и очередей бота."""
+    if update.edited_message is not None:
+        await edited_message_handle(update, context)
+        return
+    user_id = update.message.from_user.id
+
+    if user_id not in config.admin_ids:
+        await update.message.reply_text("Эта команда доступна только администраторам.")
+        return
+
+    text = "📊 <b>Статистика</b>\n\n"
+
+    text += "<b>Кэш ответов OpenAI:</b> "
+    if openai_utils.completion_cache is None:
+        text += "выключен\n"
+    else:
+        stats = openai_utils.completion_cache.stats()
+        text += (f"{stats['size']}/{stats['maxsize']} записей, в полете {stats['in_flight']}\n"
+                 f"hits {stats['hits']}, misses {stats['misses']}, coalesced {stats['coalesced']}, "
+                 f"evictions {stats['evictions']}, hit rate {stats['hit_rate']:.1%}\n")
+
+    stats = openai_utils.openai_session.stats()
+    text += (f"<b>HTTP-пул OpenAI:</b> в работе {stats['in_flight']}/{stats['limit']} (максимум {stats['max_in_flight']}), "
+             f"свободных соединений {stats['idle_connections']}, запросов {stats['requests']}\n")
+
+    for name, scheduler in [("чат", openai_utils.chat_scheduler), ("аудио", openai_utils.audio_scheduler), ("картинки", openai_utils.image_scheduler)]:
+        stats = scheduler.stats()
+        text += (f"<b>Очередь OpenAI ({name}):</b> {stats['requests_per_minute']} запросов за минуту, "
+                 f"повторов {stats['retries']}, 429: {stats['rate_limited']}\n")
+        for lane, lane_stats in stats["lanes"].items():
+            if lane_stats["dispatched"] > 0 or lane_stats["queued"] > 0:
+                text += (f"  {lane}: в очереди {lane_stats['queued']}, отправлено {lane_stats['dispatched']}, "
+                         f"ожидание среднее {lane_stats['wait_avg']:.2f}с / макс {lane_stats['wait_max']:.2f}с\n")
+
+    text += "<b>Ключи OpenAI:</b>\n"
+    for endpoint_stats in openai_utils.api_key_pool.stats():
+        text += (f"  {endpoint_stats['name']}: {'ok' if endpoint_stats['healthy'] else 'выведен'}, "
+                 f"в работе {endpoint_stats['outstanding']}, запросов {endpoint_stats['requests']}, "
+                 f"токенов {endpoint_stats['tokens']}, ошибок {endpoint_stats['errors']}, выводов {endpoint_stats['ejections']}\n")
+
+    stats = edit_scheduler.stats()
+    text += (f"<b>Потоковые ответы:</b> {stats['answers']} ответов, правок {stats['edits']} "
+             f"({stats['edits_per_answer']:.1f} на ответ, пропущено {stats['skipped']}, медленных {stats['slow_edits']}), "
+             f"разметка исправлена {stats['repaired']}, отклонена {stats['parse_errors']}, "
+             f"до финального текста среднее {stats['time_to_final_avg']:.2f}с / макс {stats['time_to_final_max']:.2f}с\n")
+    stats = user_request_queue.stats()
+    text += (f"<b>Очереди пользователей:</b> заняты {stats['busy_users']}, ждут {stats['queued_now']} "
+             f"(глубже всего {stats['max_depth_now']}/{stats['max_depth']}, максимум {stats['max_seen_depth']}), "
+             f"обработано {stats['processed']}, вставали в очередь {stats['queued']}, "
+             f"отклонено {stats['rejected']}, вытеснено {stats['dropped']}, ожидание среднее {stats['wait_avg']:.2f}с\n")
+    text += "<b>Лимиты нагрузки:</b>\n"
+    for workload, controller in admission_controllers.items():
+        stats = controller.stats()
+        text += (f"  {workload}: в работе {stats['in_flight']}/{stats['max_concurrency']} (максимум {stats['max_in_flight']}), "
+                 f"ждут {stats['queued']}/{stats['max_queue']}, принято {stats['admitted']}, отказано {stats['rejected']}, "
+                 f"ожидание среднее {stats['wait_avg']:.2f}с\n")
+
+    text += f"<b>Кэш пользователей:</b> {len(db.user_cache)}/{db.user_cache.maxsize}\n"
+    text += f"<b>Буфер last_interaction:</b> {len(db.last_interaction_buffer)}\n"
 
-    await update.message.reply_text(f"Спасибо за платеж❤️\n\nВаш баланс равен {db.get_user_attribute(user_id, 'token_limit')} токенов!\nПроверить баланс можно в личном кабинете /profile")
-    await context.bot.send_document(config.admin_ids[0], open(path_to_users_file, 'rb'), caption=f'💰 Совершен платеж!', parse_mode=ParseMode.HTML)
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
 
 async def copy_to_all(update: Update, context: CallbackContext):
@@ -344,12 +466,17 @@ async def copy_to_all(update: Update, context: CallbackContext):
     if user_id in config.admin_ids:
         banned_ids = []
         try:
-            user_ids_list = db.for_text_to_all()           
-            for user in user_ids_list:
-                try:
-                    await context.bot.copy_message(user, from_chat_id=message.chat_id, message_id=message.message_id, parse_mode=ParseMode.HTML)
-                except Exception as e:
-                    banned_ids.append(user)
+            # mailings run one at a time, the next ones (e.g. the rest of an album) wait in the queue
+            async with admission_controllers["broadcast"].slot() as admitted:
+                if not admitted:
+                    await reply_busy(update)
+                    return
+                user_ids_list = await db.for_text_to_all()
+                for user in user_ids_list:
+                    try:
+                        await context.bot.copy_message(user, from_chat_id=message.chat_id, message_id=message.message_id, parse_mode=ParseMode.HTML)
+                    except Exception as e:
+                        banned_ids.append(user)
             text = f'blocked_ids: {banned_ids}'
             await context.bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
 
@@ -379,12 +506,16 @@ async def send_text_to_all(update: Update, context: CallbackContext):
                 return
             else:
                 text = ' '.join(map(str, context.args))
-                user_ids_list = db.for_text_to_all()                
-                for user in user_ids_list:
-                    try:
-                        await context.bot.send_message(user, text, parse_mode=ParseMode.HTML)
-                    except Exception as e:
-                        banned_ids.append(user)
+                async with admission_controllers["broadcast"].slot() as admitted:
+                    if not admitted:
+                        await reply_busy(update)
+                        return
+                    user_ids_list = await db.for_text_to_all()
+                    for user in user_ids_list:
+                        try:
+                            await context.bot.send_message(user, text, parse_mode=ParseMode.HTML)
+                        except Exception as e:
+                            banned_ids.append(user)
                 text = f'blocked_ids: {banned_ids}'
                 await context.bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
         except ValueError:
@@ -411,11 +542,11 @@ async def start_handle(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
     
     if user_id in config.admin_ids:
-        db.set_user_attribute(user_id, "is_admin", True)
+        await db.set_user_attribute(user_id, "is_admin", True)
     
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    db.start_new_dialog(user_id)
-    balance = db.get_user_attribute(user_id, "token_limit")
+    db.touch_user(user_id)
+    await db.start_new_dialog(user_id)
+    balance = await db.get_user_attribute(user_id, "token_limit")
     
     reply_text = "Привет! Я <b>Макс,</b> бот реализованный с помощью GPT-3.5 OpenAI API 🤖\n\n"    
     
@@ -449,7 +580,7 @@ async def help_handle(update: Update, context: CallbackContext):
         ]
     
     reply_markup = InlineKeyboardMarkup(keyboard)
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.touch_user(user_id)
     await context.bot.send_message(chat_id, messages.HELP_MESSAGE, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
     
 
@@ -466,21 +597,22 @@ async def profile_handle(update: Update, context: CallbackContext):
     
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    name = db.get_user_attribute(user_id, "first_name")
-    balance = db.get_user_attribute(user_id, "token_limit")
+    user = await db.get_user(user_id)
+    name = user["first_name"]
+    balance = user["token_limit"]
     
     s_date, usd_rate = await get_s_date_user_rate(user_id)
     
-    if db.get_user_attribute(user_id, 'is_admin'): is_admin = "✅"
+    if user['is_admin']: is_admin = "✅"
     else: is_admin = "❌"
     
-    if db.get_user_attribute(user_id, 'is_paid_sub'): is_paid_sub = "✅"
+    if user['is_paid_sub']: is_paid_sub = "✅"
     else: is_paid_sub = "❌" 
     
     text = f"🗄 <b>Личный кабинет</b>\n\n👤 <b>Имя:</b> {name} (<b>ID:</b> {user_id})\n💰 <b>Баланс:</b> {balance} токенов\n\n🧑‍💻 Админ: {is_admin}\n🤩 Платный подписчик: {is_paid_sub}\n\n<i>🔥 Токены обновляются ежедневно в 10:00 по МСК</i>"
     
     await register_user_if_not_exists(update, context, update.message.from_user)
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.touch_user(user_id)
     await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
 
 
@@ -526,7 +658,7 @@ async def profile_button_handle(update: Update, context: CallbackContext):
 #                 return
 #             else:
 #                 int(context.args[0])
-#                 text = db.delete_user(int(context.args[0]))
+#                 text = await db.delete_user(int(context.args[0]))
 #                 await context.bot.send_message(user_id, text, parse_mode=ParseMode.HTML)
 #         except ValueError:
 #             text="Используйте следующую конструкцию:\n\n/delete {user_or_bot_id}. Удалить функцию"
@@ -544,7 +676,7 @@ async def help_handle_for_admins(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
     if user_id in config.admin_ids:
-        db.set_user_attribute(user_id, "last_interaction", datetime.now())
+        db.touch_user(user_id)
         await update.message.reply_text(messages.HELP_MESSAGE_FOR_ADMINS, parse_mode=ParseMode.HTML)
         return
     await update.message.reply_text("Эта команда доступна только администраторам.")
@@ -557,20 +689,12 @@ async def retry_handle(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
     
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-
-    dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
-    if len(dialog_messages) == 0:
-        await update.message.edit_text("Нет сообщений для восстановления диалога 🤷‍♂️")
-        return
-
-    last_dialog_message = dialog_messages.pop()
-    db.set_dialog_messages(user_id, dialog_messages, dialog_id=None)  # last message was removed from the context
+    db.touch_user(user_id)
 
-    await message_handle(update, context, message=last_dialog_message["user"], use_new_dialog_timeout=False)
+    await message_handle(update, context, use_new_dialog_timeout=False, retry_last_message=True)
 
 
-async def message_handle(update: Update, context: CallbackContext, message=None, use_new_dialog_timeout=True):
+async def message_handle(update: Update, context: CallbackContext, message=None, use_new_dialog_timeout=True, retry_last_message=False):
     # check if message is edited
     if update.edited_message is not None:
         await edited_message_handle(update, context)
@@ -578,18 +702,38 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
         
     await register_user_if_not_exists(update, context, update.message.from_user)
     if not await check_token_limit(update, context): return
-    if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
-    
-    async with user_semaphores[user_id]:
+
+    # messages sent while the previous answer is in progress wait for their turn
+    async with chat_turn(user_id) as status:
+        if status == admission.BUSY:
+            await reply_busy(update)
+            return
+        if status != user_queue.ADMITTED:
+            if status == user_queue.DROPPED:
+                text = "⏳ Сообщение пропущено: пока бот отвечал, пришло слишком много новых сообщений"
+            else:
+                text = "⏳ <b>Пожалуйста подождите</b> обработки предыдущих сообщений"
+            await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
+            return
+
+        if retry_last_message:
+            # popped only once admitted: a rejected /retry leaves the last turn in the dialog
+            last_dialog_message = await db.pop_dialog_message(user_id, dialog_id=None)  # last message is removed from the context
+            if last_dialog_message is None:
+                await update.message.edit_text("Нет сообщений для восстановления диалога 🤷‍♂️")
+                return
+            message = last_dialog_message["user"]
+
+        chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
+
         # new dialog timeout
         if use_new_dialog_timeout:
-            if (datetime.now() - db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout and len(db.get_dialog_messages(user_id)) > 0:
-                db.start_new_dialog(user_id)
+            if (datetime.now() - await db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout and await db.has_dialog_messages(user_id):
+                await db.start_new_dialog(user_id)
                 await update.message.edit_text(f"Начат новый диалог (Роль: <b>{openai_utils.CHAT_MODES[chat_mode]['name']}</b>) ✅", parse_mode=ParseMode.HTML)
-        db.set_user_attribute(user_id, "last_interaction", datetime.now())
+        db.touch_user(user_id)
 
         # send typing action
         await update.message.chat.send_action(action="typing")
@@ -605,13 +749,28 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
                 message = message or update.message.text
             
 
-            dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
             parse_mode = {
                 "html": ParseMode.HTML,
                 "markdown": ParseMode.MARKDOWN
             }[openai_utils.CHAT_MODES[chat_mode]["parse_mode"]]
 
-            chatgpt_instance = openai_utils.ChatGPT(use_chatgpt_api=config.use_chatgpt_api)
+            chatgpt_instance = openai_utils.ChatGPT(
+                use_chatgpt_api=config.use_chatgpt_api,
+                priority=await get_request_priority(user_id)
+            )
+
+            # long dialogs of chat modes with summarize: true send a running summary instead of the oldest messages
+            summarize = openai_utils.CHAT_MODES[chat_mode].get("summarize", False)
+            dialog_summary = await db.get_dialog_summary(user_id) if summarize else None
+
+            # load only the newest messages that fit into the model context
+            dialog_messages, n_skipped_dialog_messages = await db.get_dialog_messages_window(
+                user_id,
+                chatgpt_instance.dialog_token_budget(message, chat_mode=chat_mode, dialog_summary=dialog_summary),
+                dialog_id=None,
+                summary_until=dialog_summary["summary_until"] if dialog_summary is not None else None,
+                model=chatgpt_instance.model
+            )
 
 
             if message.startswith(config.SALUTESPEECH_PRIVATE):
@@ -624,106 +783,103 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
                 answer, n_used_tokens, n_first_dialog_messages_removed = await chatgpt_instance.send_message(
                         message,
                         dialog_messages=dialog_messages,
-                        chat_mode=chat_mode
+                        chat_mode=chat_mode,
+                        dialog_summary=dialog_summary
                     )
                 if "<" in answer or '>' in answer:
                     await update.message.chat.send_action(action="typing")
                     text = 'Невозможно озвучить код. Пожалуйста, измените режим.'
                     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
                 else:
-                    await update.message.chat.send_action(action="record_voice")
-                    audio_file_path = await main(answer, unique_id)
-                    # TODO - Учет потраченных секунд
-                    
-                    file = open(f'{audio_file_path}', 'rb')
-                    try:
-                        # await update.message.reply_text(answer, parse_mode=ParseMode.HTML)
-                        await update.message.reply_voice(voice=file, caption=f'@{username}')
-                        file.close()
-                    except telegram.error.TelegramError as e:
-                            print(f"Error sending voice message: {e}")
+                    async with admission_controllers["tts"].slot() as admitted:
+                        if not admitted:
+                            # the text answer is ready anyway, only the voice is skipped
+                            await update.message.reply_text(answer)
+                        else:
+                            await update.message.chat.send_action(action="record_voice")
+                            audio_file_path = await main(answer, unique_id)
+                            # TODO - Учет потраченных секунд
+
+                            file = open(f'{audio_file_path}', 'rb')
+                            try:
+                                # await update.message.reply_text(answer, parse_mode=ParseMode.HTML)
+                                await update.message.reply_voice(voice=file, caption=f'@{username}')
+                                file.close()
+                            except telegram.error.TelegramError as e:
+                                    print(f"Error sending voice message: {e}")
                             
                             
                 # update user data
                 new_dialog_message = {"user": message, "bot": answer, "date": datetime.now()}
-                db.set_dialog_messages(
+                new_dialog_message["n_tokens"] = tokens.count_dialog_message_tokens(new_dialog_message, model=chatgpt_instance.model)
+                await db.append_dialog_message(
                     user_id,
-                    db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message],
-                    dialog_id=None
+                    new_dialog_message,
+                    dialog_id=None,
+                    max_messages=config.max_dialog_messages
                 )
                 
                 n_used_tokens_last_message = n_used_tokens
                 
-                db.set_user_attribute(user_id, "n_used_tokens", n_used_tokens + db.get_user_attribute(user_id, "n_used_tokens"))
-                db.set_user_attribute(user_id, "token_limit", db.get_user_attribute(user_id, "token_limit") - n_used_tokens_last_message)
+                await db.charge_tokens(user_id, n_used_tokens_last_message)
+                if summarize:
+                    await schedule_dialog_summary(
+                        context, user_id, dialog_messages + [new_dialog_message], n_skipped_dialog_messages, chatgpt_instance
+                    )
                 # await debbug(update, context, n_used_tokens_last_message)
             else:
+                renderer = streaming.StreamRenderer(context.bot, update.message, parse_mode, edit_scheduler)
+                # the only copy of the answer in progress: the generator appends deltas, the renderer reads them
+                buffer = streaming.StreamBuffer()
                 if config.enable_message_streaming:
-                    gen = chatgpt_instance.send_message_stream(message, dialog_messages=dialog_messages, chat_mode=chat_mode)
+                    gen = chatgpt_instance.send_message_stream(
+                        message, dialog_messages=dialog_messages, chat_mode=chat_mode, dialog_summary=dialog_summary, buffer=buffer
+                    )
                 else:
                     answer, n_used_tokens, n_first_dialog_messages_removed = await chatgpt_instance.send_message(
                         message,
                         dialog_messages=dialog_messages,
-                        chat_mode=chat_mode
+                        chat_mode=chat_mode,
+                        dialog_summary=dialog_summary
                     )
                     async def fake_gen():
                         yield "finished", answer, n_used_tokens, n_first_dialog_messages_removed
 
                     gen = fake_gen()
 
-                # send message to user
-                prev_answer = ""
-                i = -1
-                async for gen_item in gen:
-                    i += 1
-
-                    status = gen_item[0]
-                    if status == "not_finished":
-                        status, answer = gen_item
-                    elif status == "finished":
-                        status, answer, n_used_tokens, n_first_dialog_messages_removed = gen_item
-                    else:
-                        raise ValueError(f"Streaming status {status} is unknown")
-
-                    answer = answer[:4096]  # telegram message limit
-                    if i == 0:  # send first message (then it'll be edited if message streaming is enabled)
-                        try:                    
-                            sent_message = await update.message.reply_text(answer, parse_mode=parse_mode)
-                        except telegram.error.BadRequest as e:
-                            if str(e).startswith("Message must be non-empty"):  # first answer chunk from openai was empty
-                                i = -1  # try again to send first message
-                                continue
-                            else:
-                                sent_message = await update.message.reply_text(answer)
-                    else:  # edit sent message
-                        # update only when 100 new symbols are ready
-                        if abs(len(answer) - len(prev_answer)) < 100 and status != "finished":
-                            continue
-
-                        try:                    
-                            await context.bot.edit_message_text(answer, chat_id=sent_message.chat_id, message_id=sent_message.message_id, parse_mode=parse_mode)
-                        except telegram.error.BadRequest as e:
-                            if str(e).startswith("Message is not modified"):
-                                continue
-                            else:
-                                await context.bot.edit_message_text(answer, chat_id=sent_message.chat_id, message_id=sent_message.message_id)
-
-                        await asyncio.sleep(0.01)  # wait a bit to avoid flooding
-                        
-                    prev_answer = answer
+                # send message to user, edits are coalesced by the shared edit scheduler
+                try:
+                    async for gen_item in gen:
+                        status = gen_item[0]
+                        if status == "not_finished":
+                            await renderer.update(buffer)
+                        elif status == "finished":
+                            status, answer, n_used_tokens, n_first_dialog_messages_removed = gen_item
+                            await renderer.finish(answer)
+                        else:
+                            raise ValueError(f"Streaming status {status} is unknown")
+                finally:
+                    # a failed render leaves the generator suspended: close it now, so it releases
+                    # its singleflight key and OpenAI stream instead of waiting for the garbage collector
+                    await gen.aclose()
 
                 # update user data
                 new_dialog_message = {"user": message, "bot": answer, "date": datetime.now()}
-                db.set_dialog_messages(
+                new_dialog_message["n_tokens"] = tokens.count_dialog_message_tokens(new_dialog_message, model=chatgpt_instance.model)
+                await db.append_dialog_message(
                     user_id,
-                    db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message],
-                    dialog_id=None
+                    new_dialog_message,
+                    dialog_id=None,
+                    max_messages=config.max_dialog_messages
                 )
                 
                 n_used_tokens_last_message = n_used_tokens
                 
-                db.set_user_attribute(user_id, "n_used_tokens", n_used_tokens + db.get_user_attribute(user_id, "n_used_tokens"))
-                db.set_user_attribute(user_id, "token_limit", db.get_user_attribute(user_id, "token_limit") - n_used_tokens_last_message)
+                await db.charge_tokens(user_id, n_used_tokens_last_message)
+                if summarize:
+                    await schedule_dialog_summary(
+                        context, user_id, dialog_messages + [new_dialog_message], n_skipped_dialog_messages, chatgpt_instance
+                    )
                 
                 # await debbug(update, context, n_used_tokens_last_message)
                 
@@ -734,6 +890,7 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
             return
 
         # send message if some messages were removed from the context
+        n_first_dialog_messages_removed += n_skipped_dialog_messages
         if n_first_dialog_messages_removed > 0:
             keyboard = [
                 [InlineKeyboardButton("🆕 Начать новый диалог", callback_data="Начать диалог")]
@@ -746,11 +903,80 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
             await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
 
 
+async def schedule_dialog_summary(context: CallbackContext, user_id: int, dialog_messages, n_skipped_dialog_messages, chatgpt_instance):
+    """Запускает в фоне сворачивание старых сообщений, если несвернутая часть диалога может быть длиннее порога.
+
+    dialog_messages - окно последнего хода; оно совпадает с несвернутой частью, только если из него ничего не выпало.
+    """
+    n_tokens = sum(tokens.dialog_message_tokens(dialog_message, model=chatgpt_instance.model) for dialog_message in dialog_messages)
+    if n_tokens <= config.dialog_summary_threshold_tokens and n_skipped_dialog_messages == 0:
+        return
+
+    dialog_id = await db.get_user_attribute(user_id, "current_dialog_id")
+    if dialog_id in summarizing_dialogs:
+        return
+    summarizing_dialogs.add(dialog_id)
+    context.application.create_task(summarize_dialog(user_id, dialog_id, chatgpt_instance))
+
+
+def count_foldable_dialog_messages(dialog_messages, model) -> int:
+    """Сколько самых старых сообщений свернуть: все, кроме самых новых в пределах dialog_summary_keep_tokens.
+    Последнее сообщение не сворачивается никогда. 0 - диалог еще не длиннее порога.
+    """
+    n_tokens_per_message = [tokens.dialog_message_tokens(dialog_message, model=model) for dialog_message in dialog_messages]
+    if sum(n_tokens_per_message) <= config.dialog_summary_threshold_tokens:
+        return 0
+
+    n_kept = 0
+    n_kept_tokens = 0
+    for n_tokens in reversed(n_tokens_per_message):
+        n_kept_tokens += n_tokens
+        if n_kept > 0 and n_kept_tokens > config.dialog_summary_keep_tokens:
+            break
+        n_kept += 1
+    return len(dialog_messages) - n_kept
+
+
+async def summarize_dialog(user_id: int, dialog_id: str, chatgpt_instance):
+    """Сворачивает старые несвернутые сообщения диалога в краткое содержание. Потраченные токены списываются с пользователя."""
+    try:
+        # start from the stored summary and the whole unsummarized tail, not from the window of the turn
+        dialog_summary = await db.get_dialog_summary(user_id, dialog_id=dialog_id)
+        previous_summary_until = dialog_summary["summary_until"] if dialog_summary is not None else None
+        dialog_messages = await db.get_unsummarized_dialog_messages(user_id, previous_summary_until, dialog_id=dialog_id)
+
+        n_foldable = count_foldable_dialog_messages(dialog_messages, chatgpt_instance.model)
+        if n_foldable == 0:
+            return
+
+        summary, n_used_tokens, n_dialog_messages_summarized = await chatgpt_instance.summarize_dialog(
+            dialog_messages[:n_foldable], dialog_summary=dialog_summary
+        )
+        summary_until = dialog_messages[n_dialog_messages_summarized - 1]["date"]
+        if not await db.set_dialog_summary(user_id, summary, summary_until, previous_summary_until, dialog_id=dialog_id):
+            logger.warning(f"Summary of dialog {dialog_id} was updated meanwhile, the stale one is dropped")
+            return
+        await db.charge_tokens(user_id, n_used_tokens)
+    except Exception as e:
+        logger.error(f"Failed to summarize dialog {dialog_id}: {e}")
+    finally:
+        summarizing_dialogs.discard(dialog_id)
+
+
+async def get_request_priority(user_id: int) -> int:
+    """Полоса очереди запросов к OpenAI: админы, платные подписчики, остальные."""
+    if user_id in config.admin_ids:
+        return openai_utils.PRIORITY_ADMIN
+    if await db.get_user_attribute(user_id, "is_paid_sub"):
+        return openai_utils.PRIORITY_PAID
+    return openai_utils.PRIORITY_FREE
+
+
 async def is_previous_message_not_answered_yet(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
 
     user_id = update.message.from_user.id
-    if user_semaphores[user_id].locked():
+    if user_request_queue.is_busy(user_id):
         text = "⏳ <b>Пожалуйста подождите</b> обработки предыдущего сообщения"
         await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
         return True
@@ -769,7 +995,7 @@ async def dalle(update: Update, context):
     if not await check_token_limit(update, context): return
     
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.touch_user(user_id)
     
     await update.message.chat.send_action(action="upload_photo")    
     
@@ -780,12 +1006,9 @@ async def dalle(update: Update, context):
         # Если сообщение пришло с группы/канала, то убираем первые два слова "Макс, нарисуй" из сообщения пользователя
         prompt = ''.join(update.message.text[14::])
         # Отправляем АПИ запрос в DALL-E с сообщением пользователя и получаем ответ
-        response = openai.Image.create(
-                prompt=prompt,
-                n=1,
-                size="1024x1024"
-                )
-        image_url = response['data'][0]['url']
+        image_url = (await openai_utils.generate_images(
+            prompt, n_images=1, size="1024x1024", priority=await get_request_priority(user_id)
+        ))[0]
 
         # Отправляем сгенерированное изображение пользователю
         await update.message.chat.send_action(action="upload_photo")
@@ -796,12 +1019,9 @@ async def dalle(update: Update, context):
     elif (GROUP_ATTR not in chat_id) and config.DALLE_PRIVATE in prompt:
         prompt = ''.join(update.message.text[8::])
         try:
-            response = openai.Image.create(
-                    prompt=prompt,
-                    n=1,
-                    size="1024x1024"
-                    )
-            image_url = response['data'][0]['url']
+            image_url = (await openai_utils.generate_images(
+                prompt, n_images=1, size="1024x1024", priority=await get_request_priority(user_id)
+            ))[0]
             await update.message.chat.send_action(action="upload_photo")
             await context.bot.send_photo(update.effective_chat.id, photo=image_url)
             await context.bot.send_message(update.effective_chat.id, prompt, parse_mode=ParseMode.HTML)
@@ -817,8 +1037,7 @@ async def dalle(update: Update, context):
     # n_spent_dollars = config.dalle_price_per_one_image
 
     n_used_tokens = int(1000)
-    db.set_user_attribute(user_id, "n_used_tokens", n_used_tokens + db.get_user_attribute(user_id, "n_used_tokens"))
-    db.set_user_attribute(user_id, "token_limit", db.get_user_attribute(user_id, "token_limit") - n_used_tokens)
+    await db.charge_tokens(user_id, n_used_tokens)
 
 
 async def voice_message_handle(update: Update, context: CallbackContext):
@@ -832,33 +1051,37 @@ async def voice_message_handle(update: Update, context: CallbackContext):
         await context.bot.send_message(update.effective_chat.id, text, parse_mode=ParseMode.HTML)
     else:
         await register_user_if_not_exists(update, context, update.message.from_user)
-        if await is_previous_message_not_answered_yet(update, context): return
-        
+        # no busy check: the transcribed text waits in the user's queue in message_handle
         if not await check_token_limit(update, context): return
 
 
         user_id = update.message.from_user.id
-        db.set_user_attribute(user_id, "last_interaction", datetime.now())
+        db.touch_user(user_id)
 
         voice = update.message.voice
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            tmp_dir = Path(tmp_dir)
-            
-            voice_ogg_path = Path(tmp_dir, "voice.ogg")
+        async with admission_controllers["voice"].slot() as admitted:
+            if not admitted:
+                await reply_busy(update)
+                return
 
-            # download
-            voice_file = await context.bot.get_file(voice.file_id)
-            await voice_file.download_to_drive(voice_ogg_path)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                tmp_dir = Path(tmp_dir)
 
-            # convert to mp3    
-            voice_mp3_path = Path(tmp_dir, "voice.mp3")
-            
-            # voice_mp3_path = tmp_dir / "voice.mp3"
-            pydub.AudioSegment.from_file(voice_ogg_path).export(voice_mp3_path, format="mp3")
+                voice_ogg_path = Path(tmp_dir, "voice.ogg")
+
+                # download
+                voice_file = await context.bot.get_file(voice.file_id)
+                await voice_file.download_to_drive(voice_ogg_path)
+
+                # convert to mp3 in a worker thread, so the conversion doesn't block other updates
+                voice_mp3_path = Path(tmp_dir, "voice.mp3")
+                await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: pydub.AudioSegment.from_file(voice_ogg_path).export(voice_mp3_path, format="mp3")
+                )
 
-            # transcribe
-            with open(voice_mp3_path, "rb") as f:
-                transcribed_text = await openai_utils.transcribe_audio(f)
+                # transcribe
+                with open(voice_mp3_path, "rb") as f:
+                    transcribed_text = await openai_utils.transcribe_audio(f, priority=await get_request_priority(user_id))
 
         text = f"🎤: <i>{transcribed_text}</i>"
         await update.message.reply_text(text, parse_mode=ParseMode.HTML)
@@ -871,8 +1094,7 @@ async def voice_message_handle(update: Update, context: CallbackContext):
         # normalize dollars to tokens (it's very convenient to measure everything in a single unit)
         price_per_1000_tokens = config.chatgpt_price_per_1000_tokens if config.use_chatgpt_api else config.gpt_price_per_1000_tokens
         n_used_tokens = int(n_spent_dollars / (price_per_1000_tokens / 1000))
-        db.set_user_attribute(user_id, "n_used_tokens", n_used_tokens + db.get_user_attribute(user_id, "n_used_tokens"))
-        db.set_user_attribute(user_id, "token_limit", db.get_user_attribute(user_id, "token_limit") - n_used_tokens)
+        await db.charge_tokens(user_id, n_used_tokens)
         
 
 
@@ -882,12 +1104,12 @@ async def new_dialog_handle(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.touch_user(user_id)
 
-    db.start_new_dialog(user_id)
+    await db.start_new_dialog(user_id)
     # await update.message.reply_text("Начат новый диалог ✅")
 
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
     await update.message.reply_text(f"{openai_utils.CHAT_MODES[chat_mode]['welcome_message']}", parse_mode=ParseMode.HTML)
     # await update.message.reply_text(f"{openai_utils.CHAT_MODES[chat_mode]['welcome_message']}", parse_mode=openai_utils.CHAT_MODES[chat_mode]['parse_mode'])
     
@@ -898,7 +1120,7 @@ async def show_chat_modes_handle(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.touch_user(user_id)
 
     keyboard = []
     for chat_mode, chat_mode_dict in openai_utils.CHAT_MODES.items():
@@ -936,8 +1158,8 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
 
     chat_mode = query.data.split("|")[1]
 
-    db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
-    db.start_new_dialog(user_id)
+    await db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
+    await db.start_new_dialog(user_id)
 
     await query.edit_message_text(f"{openai_utils.CHAT_MODES[chat_mode]['welcome_message']}", parse_mode=ParseMode.HTML)
 
@@ -946,17 +1168,17 @@ async def show_balance_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.touch_user(user_id)
 
     # Получить текущий курс usd to rub
     s_date, usd_rate = await get_s_date_user_rate(user_id)
     price_per_1000_tokens = config.chatgpt_price_per_1000_tokens if config.use_chatgpt_api else config.gpt_price_per_1000_tokens
-    n_used_tokens = db.get_user_attribute(user_id, "n_used_tokens")
+    n_used_tokens = await db.get_user_attribute(user_id, "n_used_tokens")
     
     rub_rate_per_1000_tokens = (price_per_1000_tokens * usd_rate)
     # n_spent_rub = (n_used_tokens * rub_rate_per_1000_tokens)/1000
 
-    balance = db.get_user_attribute(user_id, 'token_limit')
+    balance = await db.get_user_attribute(user_id, 'token_limit')
 
     text = f'💰 Ваш баланс: <b>{balance}</b> токенов.\n'
     # text += f"Вы потратили <b>{n_spent_rub:.03f} руб.</b>\n"
@@ -975,8 +1197,8 @@ async def show_balance_handle(update: Update, context: CallbackContext):
 
 async def get_s_date_user_rate(user_id):
     old_answer = []
-    s_date_old = db.get_user_attribute(user_id, 's_date')
-    usd_rate_old = db.get_user_attribute(user_id, 'usd_rate')
+    s_date_old = await db.get_user_attribute(user_id, 's_date')
+    usd_rate_old = await db.get_user_attribute(user_id, 'usd_rate')
 
     old_answer.append(s_date_old)
     old_answer.append(usd_rate_old)
@@ -986,8 +1208,8 @@ async def get_s_date_user_rate(user_id):
     s_date = new_answer[0]
     usd_rate = new_answer[1]
             
-    db.set_user_attribute(user_id, 's_date', s_date)
-    db.set_user_attribute(user_id, 'usd_rate', usd_rate)
+    await db.set_user_attribute(user_id, 's_date', s_date)
+    await db.set_user_attribute(user_id, 'usd_rate', usd_rate)
     
     return s_date, usd_rate
 
@@ -1031,9 +1253,9 @@ async def debbug(update: Update, context: CallbackContext, n_used_tokens_last_me
     # Получить текущий курс usd to rub
     old_answer = []
 
-    n_used_tokens = db.get_user_attribute(user_id, "n_used_tokens")
-    s_date = db.get_user_attribute(user_id, 's_date')
-    usd_rate = db.get_user_attribute(user_id, 'usd_rate')
+    n_used_tokens = await db.get_user_attribute(user_id, "n_used_tokens")
+    s_date = await db.get_user_attribute(user_id, 's_date')
+    usd_rate = await db.get_user_attribute(user_id, 'usd_rate')
 
     old_answer.append(s_date)
     old_answer.append(usd_rate)
@@ -1043,8 +1265,8 @@ async def debbug(update: Update, context: CallbackContext, n_used_tokens_last_me
     s_date = new_answer[0]
     usd_rate = new_answer[1]
     
-    db.set_user_attribute(user_id, 's_date', s_date)
-    db.set_user_attribute(user_id, 'usd_rate', usd_rate)
+    await db.set_user_attribute(user_id, 's_date', s_date)
+    await db.set_user_attribute(user_id, 'usd_rate', usd_rate)
     
     rub_rate_per_1000_tokens = (price_per_1000_tokens * usd_rate)
     n_spent_rub = (n_used_tokens * rub_rate_per_1000_tokens)/1000
@@ -1061,13 +1283,35 @@ async def update_token_limit_every_day_at_ten_am(application: Application):
     """Функция ежедневно обновляет token_limit у каждого пользователя, баланс которых меньше 10000 токенов."""
 
     # Выбираем всех пользователей из базы данных и пополняем их баланс на 10000 токенов
-    user_ids_list = db.update_balance_every_day()
+    user_ids_list = await db.update_balance_every_day()
 
     text=f'Ваш баланс равен {config.token_limit_for_users} токенов!\n\nБаланс пополняется каждый день в 10:00 по МСК.'
     for user_id in user_ids_list:
         await application.bot.send_message(user_id, text)
         
 
+async def flush_last_interactions(context: CallbackContext):
+    """Периодически пишет накопленные last_interaction в БД (при ошибке значения остаются в буфере)."""
+    try:
+        await db.flush_last_interactions()
+    except Exception as e:
+        logger.error(f"Failed to flush last_interaction: {e}")
+
+
+async def archive_old_dialogs(context: CallbackContext):
+    """Периодически переносит старые диалоги в сжатый архив и пишет отчет в лог."""
+    try:
+        report = await db.archive_dialogs()
+    except Exception as e:
+        logger.error(f"Failed to archive dialogs: {e}")
+        return
+
+    logger.info(
+        f"Archived {report['n_dialogs']} dialogs ({report['n_messages']} messages) in {report['elapsed']:.2f}s: "
+        f"{report['raw_bytes']} bytes -> {report['archived_bytes']} bytes, reclaimed {report['reclaimed_bytes']} bytes"
+    )
+
+
 def get_tomorrow_10am():
     tomorrow = datetime.now() + timedelta(days=1)
     tomorrow_10am = datetime(year=tomorrow.year, month=tomorrow.month, day=tomorrow.day, hour=7, minute=0, second=0)
@@ -1075,6 +1319,12 @@ def get_tomorrow_10am():
     
 
 async def post_init(application: Application):
+    await db.migrate()
+    for payment_dict in await db.credit_pending_payments():
+        logger.warning(f"Payment {payment_dict['_id']} of user {payment_dict['user_id']} was credited after a restart")
+    await openai_utils.openai_session.start()
+    tokens.warm_up(models=[openai_utils.ChatGPT(use_chatgpt_api=config.use_chatgpt_api).model])
+
     await application.bot.set_my_commands([
         BotCommand("/profile", "Личный кабинет 🗄"),
         BotCommand("/help", "Info ℹ️ | Что умеет бот?🤖"),
@@ -1083,6 +1333,13 @@ async def post_init(application: Application):
     ])
 
 
+async def post_shutdown(application: Application):
+    # write buffered last_interaction values before the process exits
+    await db.flush_last_interactions()
+    await db.close()
+    await openai_utils.openai_session.close()
+
+
 def run_bot() -> None:
     application = (
         ApplicationBuilder()
@@ -1090,11 +1347,15 @@ def run_bot() -> None:
         .concurrent_updates(True)
         .rate_limiter(AIORateLimiter(max_retries=5))
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
     first = get_tomorrow_10am()
     job_queue = application.job_queue
     job_queue.run_repeating(update_token_limit_every_day_at_ten_am, interval=config.update_token_limit, first=first)
+    job_queue.run_repeating(flush_last_interactions, interval=config.last_interaction_flush_interval)
+    if config.dialog_archive_after_days is not None:
+        job_queue.run_repeating(archive_old_dialogs, interval=config.dialog_archive_interval, first=60)
 
     # add handlers
     user_filter = filters.ALL
@@ -1121,12 +1382,14 @@ def run_bot() -> None:
     application.add_handler(CommandHandler("panel", help_handle_for_admins, filters=user_filter))
     application.add_handler(CommandHandler("get_users", send_users_list_for_admin, filters=user_filter))
     application.add_handler(CommandHandler("get_subs", send_paid_subs_list_for_admin, filters=user_filter))
+    application.add_handler(CommandHandler("get_payments", send_payments_list_for_admin, filters=user_filter))
+    application.add_handler(CommandHandler("stats", stats_handle, filters=user_filter))
     application.add_handler(CommandHandler("add", add_token_limit_by_id, filters=user_filter))
     application.add_handler(CommandHandler("send_message", send_text_to_all, filters=user_filter))
     # application.add_handler(CommandHandler("delete", delete_user, filters=user_filter))
     
 
-    application.add_handler(MessageHandler((filters.Regex(f'{config.DALLE_GROUP}') ^ filters.Regex(f'{config.DALLE_PRIVATE}')) & ~filters.COMMAND & user_filter, dalle))
+    application.add_handler(MessageHandler((filters.Regex(f'{config.DALLE_GROUP}') ^ filters.Regex(f'{config.DALLE_PRIVATE}')) & ~filters.COMMAND & user_filter, with_admission("dalle", dalle)))
     application.add_handler(MessageHandler(filters.ChatType.PRIVATE & ~filters.COMMAND & ~filters.VOICE & ~filters.AUDIO & ~filters.VIDEO & ~filters.VIDEO_NOTE & ~filters.PHOTO  & ~filters.ANIMATION & ~filters.Sticker.ALL & ~filters.Document.ALL & user_filter, message_handle))
     application.add_handler(MessageHandler(filters.Regex(f'{config.CHATGPT_GROUP}') & ~filters.COMMAND & user_filter, message_handle)) # текст
     # application.add_handler(CommandHandler("retry", retry_handle, filters=user_filter))
@@ -0,0 +1,121 @@
+'''
+Кэш ответов OpenAI с объединением одинаковых запросов "в полете" (singleflight).
+
+Ключ - хэш (модель, режим, нормализованные сообщения промпта, параметры запроса).
+Кэш ограничен по количеству записей (LRU) и по времени жизни записи (TTL).
+Пока первый запрос с таким ключом выполняется, остальные такие же запросы ждут его результат,
+а не идут в OpenAI сами, но не дольше wait_timeout секунд.
+'''
+
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+def make_key(model: str, chat_mode: str, prompt, options: dict) -> str:
+    """prompt - список сообщений ChatCompletion или строка промпта Completion."""
+    if isinstance(prompt, str):
+        prompt = normalize_text(prompt)
+    else:
+        prompt = [[message["role"], normalize_text(message["content"])] for message in prompt]
+
+    payload = json.dumps([model, chat_mode, prompt, sorted(options.items())], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    def __init__(self, maxsize: int = 1000, ttl: float = 3600, wait_timeout: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._in_flight = {}  # key -> asyncio.Future of the leader request
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.timeouts = 0
+
+    def get(self, key: str):
+        item = self._data.get(key)
+        if item is None:
+            return None
+
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.evictions += 1
+            return None
+
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key: str, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    async def lookup(self, key: str):
+        """Возвращает значение из кэша или результат такого же запроса в полете.
+
+        None означает, что вызывающий стал ведущим: он обязан вызвать set() или release() для этого ключа.
+        Если ведущий не ответил за wait_timeout секунд, поднимается asyncio.TimeoutError: вызывающий
+        делает свой запрос без кэша (ведущим он не стал).
+        """
+        while True:
+            value = self.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+
+            future = self._in_flight.get(key)
+            if future is None:
+                self.misses += 1
+                self._in_flight[key] = asyncio.get_running_loop().create_future()
+                return None
+
+            self.coalesced += 1
+            try:
+                # shield: a waiter that gives up must not cancel the leader's future
+                value = await asyncio.wait_for(asyncio.shield(future), self.wait_timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise
+            if value is not None:
+                return value
+            # the leader failed: try again, possibly as the new leader
+
+    def set(self, key: str, value):
+        self.put(key, value)
+        self.release(key, value)
+
+    def release(self, key: str, value=None):
+        future = self._in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(value)
+
+    def stats(self) -> dict:
+        n_lookups = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "in_flight": len(self._in_flight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "timeouts": self.timeouts,
+            "hit_rate": (self.hits + self.coalesced) / n_lookups if n_lookups > 0 else 0.0,
+        }
+
+    def __len__(self):
+        return len(self._data)
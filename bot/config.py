@@ -15,6 +15,8 @@ config_env = dotenv.dotenv_values(config_dir / "config.env")
 # config parameters
 telegram_token = config_yaml["telegram_token"]
 openai_api_key = config_yaml["openai_api_key"]
+# optional pool of keys/endpoints: strings or {api_key, api_base, weight}; empty means just openai_api_key
+openai_api_keys = config_yaml.get("openai_api_keys") or []
 payment_token = config_yaml["payment_token"]
 bot_username = config_yaml["bot_username"]
 
@@ -30,12 +32,67 @@ token_limit_for_users = config_yaml["token_limit_for_users"]
 update_token_limit = config_yaml["update_token_limit"]
 enable_message_streaming = config_yaml.get("enable_message_streaming", True)
 
+# messages that arrive while the previous answer is in progress wait in a per-user queue
+user_queue_depth = config_yaml.get("user_queue_depth", 3)
+user_queue_drop_policy = config_yaml.get("user_queue_drop_policy", "reject_new")
+
+# admission control: tasks of a workload class running at once and waiting for a slot, the rest get a "busy" reply
+admission_limits = {
+    "chat": {"max_concurrency": 50, "max_queue": 100},
+    "voice": {"max_concurrency": 4, "max_queue": 20},
+    "dalle": {"max_concurrency": 5, "max_queue": 10},
+    "tts": {"max_concurrency": 4, "max_queue": 10},
+    "broadcast": {"max_concurrency": 1, "max_queue": 100},
+}
+for workload, limits in (config_yaml.get("admission_limits") or {}).items():
+    admission_limits[workload] = {**admission_limits.get(workload, {}), **limits}
+
+# streamed answers: edits of one chat are coalesced, all chats share the global edit rate
+stream_edit_interval = config_yaml.get("stream_edit_interval", 1.0)
+stream_edit_min_chars = config_yaml.get("stream_edit_min_chars", 100)
+stream_global_edit_rate = config_yaml.get("stream_global_edit_rate", 25)
+
+max_dialog_messages = config_yaml.get("max_dialog_messages", None)
+dialog_window_max_messages = config_yaml.get("dialog_window_max_messages", 50)
+dialog_summary_threshold_tokens = config_yaml.get("dialog_summary_threshold_tokens", 2000)
+dialog_summary_keep_tokens = config_yaml.get("dialog_summary_keep_tokens", 1000)
+dialog_archive_after_days = config_yaml.get("dialog_archive_after_days", 30)
+dialog_archive_interval = config_yaml.get("dialog_archive_interval", 86400)
+
+# shared HTTP connection pool for OpenAI requests
+openai_connection_pool_size = config_yaml.get("openai_connection_pool_size", 100)
+openai_keepalive_timeout = config_yaml.get("openai_keepalive_timeout", 30)
+
+# OpenAI rate limits for the request scheduler (per minute, per key of the pool)
+openai_rpm_limit = config_yaml.get("openai_rpm_limit", 3500)
+openai_tpm_limit = config_yaml.get("openai_tpm_limit", 90000)
+openai_audio_rpm_limit = config_yaml.get("openai_audio_rpm_limit", 50)
+openai_image_rpm_limit = config_yaml.get("openai_image_rpm_limit", 50)
+openai_max_retries = config_yaml.get("openai_max_retries", 5)
+openai_key_eject_errors = config_yaml.get("openai_key_eject_errors", 3)
+openai_key_eject_timeout = config_yaml.get("openai_key_eject_timeout", 30)
+
+# completion cache (identical prompts share one OpenAI answer)
+enable_completion_cache = config_yaml.get("enable_completion_cache", False)
+completion_cache_size = config_yaml.get("completion_cache_size", 1000)
+completion_cache_ttl = config_yaml.get("completion_cache_ttl", 3600)
+completion_cache_wait_timeout = config_yaml.get("completion_cache_wait_timeout", 60)
+
+# user documents cache
+user_cache_size = config_yaml.get("user_cache_size", 10000)
+user_cache_ttl = config_yaml.get("user_cache_ttl", 300)
+last_interaction_flush_interval = config_yaml.get("last_interaction_flush_interval", 5)
+
 
 platname = platform.system()
 if platname == 'Windows':
     mongodb_uri = "mongodb://localhost:27017/"
 else:
-    mongodb_uri = f"mongodb://mongo:{config_env['MONGODB_PORT']}"
+    mongodb_uri = f"mongodb://mongo:{config_env.get('MONGODB_PORT', 27017)}"
+
+# storage backend: "mongodb" or "sqlite" (embedded, single node)
+storage_backend = config_yaml.get("storage_backend", "mongodb")
+sqlite_path = config_yaml.get("sqlite_path", str(config_dir.parent / "sqlite" / "bot.sqlite3"))
 
 # chat_modes
 with open(config_dir / "chat_modes.yml", 'r') as f:
@@ -1,16 +1,26 @@
-from typing import Optional, Any
+from typing import Optional, Any, List
 
+import time
+import asyncio
+import itertools
+import logging
 import pymongo
 import uuid
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
 import config
+import tokens
+from storage import Storage
 from get_current_usd import CBR_XML_Daily_Ru
 
 
+logger = logging.getLogger(__name__)
+
+
 class Database:
-    def __init__(self):
-        self.client = pymongo.MongoClient(config.mongodb_uri)
+    def __init__(self, mongodb_uri: str = config.mongodb_uri):
+        self.client = pymongo.MongoClient(mongodb_uri)
         self.db = self.client["chatgpt_telegram_bot"]
 
         self.user_collection = self.db["user"]
@@ -182,7 +192,496 @@ class Database:
         except Exception as e:
             text = f"Пользователь с таким user_id не найден в базе данных. Ошибка {e}"
             return text
-            
-            
-            
-        
\ No newline at end of file
+
+
+class UserCache:
+    """Write-through кэш пользовательских документов с TTL и LRU-вытеснением.
+
+    Хранит документы целиком, чтобы хендлер загружал пользователя из MongoDB
+    один раз и читал любые атрибуты из памяти. Все записи AsyncDatabase
+    обновляют закэшированный документ, TTL ограничивает устаревание данных,
+    если базу меняет кто-то кроме этого процесса.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # user_id -> (expires_at, user_dict)
+        self._generations = OrderedDict()  # user_id -> number of the last write to the user's entry
+        self._write_counter = itertools.count(1)
+
+    def get(self, user_id: int) -> Optional[dict]:
+        item = self._data.get(user_id)
+        if item is None:
+            return None
+
+        expires_at, user_dict = item
+        if expires_at < time.monotonic():
+            del self._data[user_id]
+            return None
+
+        self._data.move_to_end(user_id)
+        return user_dict
+
+    def generation(self, user_id: int) -> Optional[int]:
+        """Номер последней записи в кэш для пользователя. Снимается перед чтением из хранилища, см. put_if_unchanged."""
+        return self._generations.get(user_id)
+
+    def _bump(self, user_id: int):
+        self._generations[user_id] = next(self._write_counter)
+        self._generations.move_to_end(user_id)
+        while len(self._generations) > self.maxsize:
+            self._generations.popitem(last=False)
+
+    def put(self, user_id: int, user_dict: dict):
+        self._bump(user_id)
+        self._data[user_id] = (time.monotonic() + self.ttl, user_dict)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def put_if_unchanged(self, user_id: int, user_dict: dict, generation: Optional[int]) -> dict:
+        """Кладет прочитанный документ, если с generation в кэш ничего не писали. Возвращает актуальный документ:
+        прочитанный или тот, что закэшировала запись, завершившаяся во время чтения.
+        """
+        if self.generation(user_id) != generation:
+            cached_user_dict = self.get(user_id)
+            return cached_user_dict if cached_user_dict is not None else user_dict
+
+        self.put(user_id, user_dict)
+        return user_dict
+
+    def update(self, user_id: int, fields: dict):
+        # only patch documents that are already cached, otherwise the next read loads a fresh copy
+        self._bump(user_id)
+        user_dict = self.get(user_id)
+        if user_dict is not None:
+            user_dict.update(fields)
+
+    def invalidate(self, user_id: int):
+        self._bump(user_id)
+        self._data.pop(user_id, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class LastInteractionBuffer:
+    """Write-behind буфер отметок last_interaction.
+
+    Хендлеры только запоминают время последнего действия пользователя в памяти,
+    а AsyncDatabase.flush_last_interactions периодически пишет накопленное одним bulk_write.
+    """
+
+    def __init__(self):
+        self._pending = {}  # user_id -> datetime
+
+    def touch(self, user_id: int, when: datetime):
+        previous = self._pending.get(user_id)
+        if previous is None or previous < when:
+            self._pending[user_id] = when
+
+    def get(self, user_id: int) -> Optional[datetime]:
+        return self._pending.get(user_id)
+
+    def drain(self) -> dict:
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def restore(self, pending: dict):
+        # put back values from a failed flush without overwriting newer ones
+        for user_id, when in pending.items():
+            self.touch(user_id, when)
+
+    def __len__(self):
+        return len(self._pending)
+
+
+def create_storage(backend: str = config.storage_backend) -> Storage:
+    """Создает хранилище, выбранное в config.yml (storage_backend: mongodb | sqlite)."""
+    # backends are imported lazily so the sqlite backend runs without motor/MongoDB
+    if backend == "mongodb":
+        from mongo_storage import MongoStorage
+        return MongoStorage(config.mongodb_uri)
+    elif backend == "sqlite":
+        from sqlite_storage import SQLiteStorage
+        return SQLiteStorage(config.sqlite_path)
+    else:
+        raise ValueError(f"Storage backend {backend} is not supported")
+
+
+class AsyncDatabase:
+    """Асинхронный вариант Database с той же поверхностью методов.
+
+    Работает поверх любого Storage (MongoDB или встроенный SQLite) и не блокирует event loop.
+    Документы пользователей кэшируются в UserCache, last_interaction пишется через LastInteractionBuffer.
+    """
+
+    def __init__(self, storage: Optional[Storage] = None):
+        self.storage = storage if storage is not None else create_storage()
+
+        self.user_cache = UserCache(maxsize=config.user_cache_size, ttl=config.user_cache_ttl)
+        self.last_interaction_buffer = LastInteractionBuffer()
+
+    async def migrate(self):
+        """Создает индексы и применяет миграции схемы (идемпотентно, вызывается при старте)."""
+        return await self.storage.migrate()
+
+    async def close(self):
+        await self.storage.close()
+
+    async def get_user(self, user_id: int, raise_exception: bool = True) -> Optional[dict]:
+        """Возвращает документ пользователя: из кэша или одним запросом к хранилищу."""
+        user_dict = self.user_cache.get(user_id)
+        if user_dict is None:
+            # a write that finishes while the read is in flight caches a newer document, the read must not replace it
+            generation = self.user_cache.generation(user_id)
+            user_dict = await self.storage.find_user(user_id)
+            if user_dict is not None:
+                user_dict = self.user_cache.put_if_unchanged(user_id, user_dict, generation)
+
+        if user_dict is None:
+            if raise_exception:
+                raise ValueError(f"User {user_id} does not exist")
+            return None
+
+        user_dict = dict(user_dict)
+        last_interaction = self.last_interaction_buffer.get(user_id)
+        if last_interaction is not None and last_interaction > user_dict["last_interaction"]:
+            # not flushed yet, the buffer has the freshest value
+            user_dict["last_interaction"] = last_interaction
+        return user_dict
+
+    def touch_user(self, user_id: int):
+        """Отмечает действие пользователя. В хранилище попадет при следующем flush_last_interactions."""
+        now = datetime.now()
+        self.last_interaction_buffer.touch(user_id, now)
+        self.user_cache.update(user_id, {"last_interaction": now})
+
+    async def flush_last_interactions(self) -> int:
+        """Пишет накопленные last_interaction одним пакетным запросом. Возвращает количество пользователей."""
+        pending = self.last_interaction_buffer.drain()
+        if len(pending) == 0:
+            return 0
+
+        try:
+            await self.storage.max_last_interactions(pending)
+        except Exception:
+            self.last_interaction_buffer.restore(pending)
+            raise
+        return len(pending)
+
+    async def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
+        return await self.get_user(user_id, raise_exception=raise_exception) is not None
+
+    async def add_new_user(
+        self,
+        user_id: int,
+        chat_id: int,
+        username: str = "",
+        first_name: str = "",
+        last_name: str = "",
+    ):
+        # CBR_XML_Daily_Ru uses blocking requests, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        new_answer = await loop.run_in_executor(None, CBR_XML_Daily_Ru)
+        s_date = new_answer[0]
+        usd_rate = new_answer[1]
+
+        user_dict = {
+            "_id": user_id,
+            "chat_id": chat_id,
+
+            "username": username,
+            "first_name": first_name,
+            "last_name": last_name,
+
+            "last_interaction": datetime.now(),
+            "first_seen": datetime.now(),
+
+            "current_dialog_id": None,
+            "current_chat_mode": "assistant",
+
+            "n_used_tokens": 0,
+
+            "s_date": s_date,
+            "usd_rate": usd_rate,
+
+            "token_limit": 10000,
+
+            "is_admin": False,
+            "is_paid_sub": False
+        }
+
+        if not await self.check_if_user_exists(user_id):
+            await self.storage.insert_user(user_dict)
+            self.user_cache.put(user_id, user_dict)
+
+    async def start_new_dialog(self, user_id: int):
+        user_dict = await self.get_user(user_id)
+
+        dialog_id = str(uuid.uuid4())
+        dialog_dict = {
+            "_id": dialog_id,
+            "user_id": user_id,
+            "chat_mode": user_dict["current_chat_mode"],
+            "start_time": datetime.now(),
+            "messages": []
+        }
+
+        # add new dialog
+        await self.storage.insert_dialog(dialog_dict)
+
+        # update user's current dialog
+        await self.set_user_attribute(user_id, "current_dialog_id", dialog_id)
+
+        return dialog_id
+
+    async def get_user_attribute(self, user_id: int, key: str):
+        user_dict = await self.get_user(user_id)
+
+        if key not in user_dict:
+            raise ValueError(f"User {user_id} does not have a value for {key}")
+
+        return user_dict[key]
+
+    async def set_user_attribute(self, user_id: int, key: str, value: Any):
+        if not await self.storage.update_user(user_id, {key: value}):
+            self.user_cache.invalidate(user_id)
+            raise ValueError(f"User {user_id} does not exist")
+
+        self.user_cache.update(user_id, {key: value})
+
+    async def _inc_user_counters(self, user_id: int, inc: dict, set_fields: Optional[dict] = None) -> dict:
+        # one atomic round trip, concurrent charges for the same user can't overwrite each other
+        user_dict = await self.storage.inc_user(user_id, inc, set_fields=set_fields)
+        if user_dict is None:
+            self.user_cache.invalidate(user_id)
+            raise ValueError(f"User {user_id} does not exist")
+
+        self.user_cache.put(user_id, user_dict)
+        return user_dict
+
+    async def charge_tokens(self, user_id: int, n_tokens: int) -> int:
+        """Списывает n_tokens с баланса и увеличивает n_used_tokens. Возвращает новый баланс."""
+        user_dict = await self._inc_user_counters(user_id, {"n_used_tokens": n_tokens, "token_limit": -n_tokens})
+        return user_dict["token_limit"]
+
+    async def top_up_tokens(self, user_id: int, n_tokens: int, is_paid_sub: Optional[bool] = None) -> int:
+        """Пополняет баланс на n_tokens (и при необходимости меняет is_paid_sub). Возвращает новый баланс."""
+        set_fields = {"is_paid_sub": is_paid_sub} if is_paid_sub is not None else None
+        user_dict = await self._inc_user_counters(user_id, {"token_limit": n_tokens}, set_fields=set_fields)
+        return user_dict["token_limit"]
+
+    async def clear_overdraft(self, user_id: int):
+        """Обнуляет отрицательный баланс. Пополнение, успевшее раньше, не затирается."""
+        user_dict = await self.storage.clear_overdraft(user_id)
+        if user_dict is not None:
+            self.user_cache.put(user_id, user_dict)
+
+    async def _get_dialog_id(self, user_id: int, dialog_id: Optional[str]) -> str:
+        if dialog_id is None:
+            return await self.get_user_attribute(user_id, "current_dialog_id")
+
+        await self.check_if_user_exists(user_id, raise_exception=True)
+        return dialog_id
+
+    async def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
+        dialog_id = await self._get_dialog_id(user_id, dialog_id)
+        return await self.storage.get_dialog_messages(user_id, dialog_id)
+
+    async def get_dialog_messages_window(
+        self,
+        user_id: int,
+        token_budget: int,
+        dialog_id: Optional[str] = None,
+        max_messages: int = config.dialog_window_max_messages,
+        summary_until: Optional[datetime] = None,
+        model: str = "gpt-3.5-turbo"
+    ):
+        """Возвращает самые новые сообщения диалога, которые помещаются в token_budget.
+
+        Из хранилища читаются только последние max_messages сообщений и длина диалога,
+        поэтому загрузка длинного диалога стоит столько же, сколько короткого.
+        Сообщения не позже summary_until уже свернуты в краткое содержание диалога и пропускаются.
+        Возвращает (dialog_messages, n_skipped), где n_skipped - сколько первых несвернутых сообщений не вошло.
+        """
+        dialog_id = await self._get_dialog_id(user_id, dialog_id)
+        # n_messages counts only unsummarized messages, so summarized ones are never reported as skipped
+        window_messages, n_messages = await self.storage.get_dialog_window(
+            user_id, dialog_id, max_messages, summary_until=summary_until
+        )
+
+        dialog_messages = []
+        n_tokens = 0
+        for dialog_message in reversed(window_messages):
+            n_tokens += tokens.dialog_message_tokens(dialog_message, model=model)
+            if n_tokens > token_budget:
+                break
+            dialog_messages.append(dialog_message)
+        dialog_messages.reverse()
+
+        return dialog_messages, n_messages - len(dialog_messages)
+
+    async def get_dialog_summary(self, user_id: int, dialog_id: Optional[str] = None) -> Optional[dict]:
+        """Краткое содержание свернутой части диалога: {"summary", "summary_until"} или None."""
+        dialog_id = await self._get_dialog_id(user_id, dialog_id)
+        return await self.storage.get_dialog_summary(user_id, dialog_id)
+
+    async def set_dialog_summary(
+        self,
+        user_id: int,
+        summary: str,
+        summary_until: datetime,
+        previous_summary_until: Optional[datetime],
+        dialog_id: Optional[str] = None
+    ) -> bool:
+        """Обновляет краткое содержание, если с previous_summary_until его никто не обновил. Возвращает False, если обновили."""
+        dialog_id = await self._get_dialog_id(user_id, dialog_id)
+        return await self.storage.set_dialog_summary(user_id, dialog_id, summary, summary_until, previous_summary_until)
+
+    async def get_unsummarized_dialog_messages(self, user_id: int, summary_until: Optional[datetime], dialog_id: Optional[str] = None):
+        """Все сообщения диалога после summary_until, то есть еще не свернутые в краткое содержание."""
+        dialog_messages = await self.get_dialog_messages(user_id, dialog_id=dialog_id)
+        if summary_until is None:
+            return dialog_messages
+        return [dialog_message for dialog_message in dialog_messages if dialog_message["date"] > summary_until]
+
+    async def has_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None) -> bool:
+        dialog_id = await self._get_dialog_id(user_id, dialog_id)
+        return await self.storage.has_dialog_messages(user_id, dialog_id)
+
+    async def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
+        dialog_id = await self._get_dialog_id(user_id, dialog_id)
+        await self.storage.set_dialog_messages(user_id, dialog_id, dialog_messages)
+
+    async def append_dialog_message(
+        self,
+        user_id: int,
+        dialog_message: dict,
+        dialog_id: Optional[str] = None,
+        max_messages: Optional[int] = None
+    ):
+        """Дописывает одно сообщение в конец диалога, не перезаписывая историю.
+
+        Если задан max_messages, в диалоге остаются только последние max_messages сообщений.
+        """
+        dialog_id = await self._get_dialog_id(user_id, dialog_id)
+        await self.storage.push_dialog_message(user_id, dialog_id, dialog_message, max_messages=max_messages)
+
+    async def pop_dialog_message(self, user_id: int, dialog_id: Optional[str] = None) -> Optional[dict]:
+        """Удаляет последнее сообщение диалога и возвращает его (None, если диалог пуст)."""
+        dialog_id = await self._get_dialog_id(user_id, dialog_id)
+        return await self.storage.pop_dialog_message(user_id, dialog_id)
+
+    async def archive_dialogs(self, older_than_days: float = config.dialog_archive_after_days) -> dict:
+        """Переносит диалоги старше older_than_days (кроме текущих) в сжатый архив.
+
+        Возвращает отчет хранилища, дополненный reclaimed_bytes (насколько уменьшились данные) и elapsed (секунды).
+        """
+        start = time.perf_counter()
+        report = await self.storage.archive_dialogs(datetime.now() - timedelta(days=older_than_days))
+        report["reclaimed_bytes"] = report["raw_bytes"] - report["archived_bytes"]
+        report["elapsed"] = time.perf_counter() - start
+        return report
+
+    async def get_archived_dialog(self, dialog_id: str) -> Optional[dict]:
+        return await self.storage.get_archived_dialog(dialog_id)
+
+    async def export_users_csv(self, path: str, paid_subs_only: bool = False) -> int:
+        """Выгружает пользователей в gzip CSV файл path. Возвращает количество выгруженных пользователей.
+
+        Строки читаются курсором с фильтром и проекцией и пишутся построчно в отдельном потоке,
+        поэтому event loop не блокируется, а память не зависит от количества пользователей.
+        """
+        return await self.storage.export_users_csv(path, paid_subs_only, config.bot_username)
+
+    async def export_payments_csv(self, path: str) -> int:
+        """Выгружает журнал платежей в gzip CSV файл path. Возвращает количество платежей."""
+        return await self.storage.export_payments_csv(path)
+
+    async def add_payment(
+        self,
+        user_id: int,
+        provider_payment_charge_id: str,
+        telegram_payment_charge_id: str,
+        total_amount: float,
+        currency: str,
+        n_tokens: int
+    ) -> bool:
+        """Записывает платеж в журнал payments (еще не зачисленным, см. credit_payment).
+
+        provider_payment_charge_id служит ключом идемпотентности (_id): повторная доставка того же
+        платежа ничего не записывает и возвращает False, новый платеж - True.
+        """
+        user_dict = await self.get_user(user_id)
+        payment_dict = {
+            "_id": provider_payment_charge_id,
+            "telegram_payment_charge_id": telegram_payment_charge_id,
+            "date": datetime.now(),
+
+            "user_id": user_id,
+            "username": user_dict["username"],
+            "first_name": user_dict["first_name"],
+            "last_name": user_dict["last_name"],
+
+            "total_amount": total_amount,
+            "currency": currency,
+            "n_tokens": n_tokens,
+            "credited": False,
+        }
+
+        return await self.storage.insert_payment(payment_dict)
+
+    async def credit_payment(self, provider_payment_charge_id: str) -> Optional[int]:
+        """Зачисляет токены записанного платежа на баланс и отмечает платеж зачисленным (атомарно в хранилище).
+
+        Возвращает новый баланс или None, если платеж уже зачислен.
+        Если зачисление упало, платеж остается незачисленным: его зачислит повторная доставка или credit_pending_payments.
+        """
+        user_dict = await self.storage.credit_payment(provider_payment_charge_id)
+        if user_dict is None:
+            return None
+
+        self.user_cache.put(user_dict["_id"], user_dict)
+        return user_dict["token_limit"]
+
+    async def credit_pending_payments(self) -> List[dict]:
+        """Зачисляет платежи, которые остались незачисленными после ошибки или перезапуска. Возвращает зачисленные."""
+        credited = []
+        for payment_dict in await self.storage.find_uncredited_payments():
+            try:
+                balance = await self.credit_payment(payment_dict["_id"])
+            except Exception as e:
+                logger.error(f"Failed to credit payment {payment_dict['_id']}: {e}")
+                continue
+            if balance is not None:
+                credited.append(payment_dict)
+        return credited
+
+    async def update_balance_every_day(self):
+        token_limit = config.token_limit_for_users
+        user_ids_list = await self.storage.refill_balances(token_limit)
+
+        # a user topped up between the read and the update keeps the higher balance: reload instead of patching
+        for user_id in user_ids_list:
+            self.user_cache.invalidate(user_id)
+        return user_ids_list
+
+    async def for_text_to_all(self):
+        return await self.storage.find_broadcast_user_ids(config.bot_username)
+
+    async def delete_user(self, user_id: int):
+        try:
+            await self.check_if_user_exists(user_id, raise_exception=True)
+            username = await self.get_user_attribute(user_id, "username")
+            text = f"Пользователь с id: {user_id} username: {username} успешно удален из базы данных."
+            await self.storage.delete_user(user_id)
+            self.user_cache.invalidate(user_id)
+            return text
+        except Exception as e:
+            text = f"Пользователь с таким user_id не найден в базе данных. Ошибка {e}"
+            return text
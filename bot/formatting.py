@@ -0,0 +1,175 @@
+'''
+Проверка и исправление разметки ответов перед отправкой в Telegram.
+
+Telegram отклоняет сообщение целиком, если разметка parse_mode не разбирается, и тогда бот тратит еще один запрос
+на отправку простым текстом. Здесь разметка исправляется локально, до первого запроса:
+    - HTML: неподдерживаемые теги и одиночные <, >, & экранируются, закрывающие теги без пары экранируются,
+      незакрытые теги закрываются в конце, <br> заменяется переводом строки;
+    - Markdown (первая версия Telegram): незакрытый блок ``` закрывается, непарные *, _, ` и [ экранируются,
+      **жирный** из CommonMark превращается в *жирный*.
+
+open_markup возвращает разметку, которую нужно открыть заново в следующем сообщении, если длинный ответ
+разрезан посреди блока кода или тега.
+'''
+
+import re
+
+from telegram.constants import ParseMode
+
+
+HTML_TAGS = {
+    "b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "a", "code", "pre", "span", "tg-spoiler", "tg-emoji", "blockquote"
+}
+HTML_TAGS_WITH_ATTRIBUTES = {"a", "code", "span", "tg-emoji", "blockquote"}
+HTML_TAG_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)(\s[^<>]*?)?\s*(/?)>")
+HTML_ENTITY_RE = re.compile(r"&(?:#\d+|#x[0-9a-fA-F]+|lt|gt|amp|quot);")
+HTML_ESCAPES = {"<": "&lt;", ">": "&gt;", "&": "&amp;"}
+
+MARKDOWN_FENCE = "```"
+MARKDOWN_LINK_RE = re.compile(r"\[[^\[\]\n]*\]\([^()\s]*\)")
+MARKDOWN_BOLD_RE = re.compile(r"\*\*(?=\S)(.+?)(?<=\S)\*\*")
+
+
+def prepare(text: str, parse_mode):
+    """Возвращает (text, parse_mode), которые Telegram разберет без ошибки."""
+    if parse_mode == ParseMode.HTML:
+        text, _ = _repair_html(text)
+    elif parse_mode == ParseMode.MARKDOWN:
+        text = _repair_markdown(text)
+    return text, parse_mode
+
+
+def open_markup(text: str, parse_mode) -> str:
+    """Разметка, открытая в конце text: с нее продолжается следующее сообщение."""
+    if parse_mode == ParseMode.HTML:
+        _, open_tags = _repair_html(text)
+        return "".join(open_tag for _, open_tag in open_tags)
+
+    if parse_mode == ParseMode.MARKDOWN:
+        parts = text.split(MARKDOWN_FENCE)
+        if len(parts) % 2 == 0:
+            language = parts[-1].split("\n", 1)[0] if "\n" in parts[-1] else ""
+            return f"{MARKDOWN_FENCE}{language}\n"
+    return ""
+
+
+def _repair_html(text: str):
+    """Возвращает исправленный текст и теги, которые были открыты в конце исходного текста."""
+    result = []
+    stack = []  # (name, open tag as written)
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == "<":
+            match = HTML_TAG_RE.match(text, i)
+            if match is not None and _append_html_tag(match, stack, result):
+                i = match.end()
+                continue
+            result.append(HTML_ESCAPES[c])
+        elif c == "&":
+            match = HTML_ENTITY_RE.match(text, i)
+            if match is not None:
+                result.append(match.group(0))
+                i = match.end()
+                continue
+            result.append(HTML_ESCAPES[c])
+        elif c == ">":
+            result.append(HTML_ESCAPES[c])
+        else:
+            # copy the plain run up to the next special symbol at once
+            end = i + 1
+            while end < len(text) and text[end] not in "<>&":
+                end += 1
+            result.append(text[i:end])
+            i = end
+            continue
+        i += 1
+
+    open_tags = list(stack)
+    for name, _ in reversed(stack):
+        result.append(f"</{name}>")
+    return "".join(result), open_tags
+
+
+def _append_html_tag(match, stack: list, result: list) -> bool:
+    """Добавляет тег в result, если он допустим здесь. False - тег нужно показать как текст."""
+    is_closing, name, attributes, is_self_closing = match.group(1), match.group(2).lower(), match.group(3), match.group(4)
+
+    if name == "br" and not is_closing:
+        result.append("\n")
+        return True
+    if name not in HTML_TAGS or is_self_closing:
+        return False
+
+    # nothing is nested into code, except <code class="language-..."> right inside <pre>
+    top = stack[-1][0] if stack else None
+    if top in ("code", "pre"):
+        if is_closing:
+            if name != top:
+                return False
+        elif not (top == "pre" and name == "code"):
+            return False
+
+    if is_closing:
+        names = [open_name for open_name, _ in stack]
+        if name not in names:
+            return False
+        while stack:
+            open_name, _ = stack.pop()
+            result.append(f"</{open_name}>")
+            if open_name == name:
+                break
+        return True
+
+    open_tag = match.group(0) if (attributes and name in HTML_TAGS_WITH_ATTRIBUTES) else f"<{name}>"
+    if name == "a" and (not attributes or "href" not in attributes):
+        return False
+    stack.append((name, open_tag))
+    result.append(open_tag)
+    return True
+
+
+def _repair_markdown(text: str) -> str:
+    parts = text.split(MARKDOWN_FENCE)
+    # even parts are outside of code blocks
+    for i in range(0, len(parts), 2):
+        parts[i] = _repair_markdown_inline(MARKDOWN_BOLD_RE.sub(r"*\1*", parts[i]))
+    text = MARKDOWN_FENCE.join(parts)
+
+    if len(parts) % 2 == 0:  # the last code block is not closed
+        text += MARKDOWN_FENCE if text.endswith("\n") else "\n" + MARKDOWN_FENCE
+    return text
+
+
+def _repair_markdown_inline(text: str) -> str:
+    result = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == "\\" and i + 1 < len(text) and text[i + 1] in "_*`[":
+            result.append(text[i:i + 2])
+            i += 2
+        elif c in "_*`":
+            # entities are not nested: everything up to the same symbol is inside
+            end = text.find(c, i + 1)
+            if end == -1:
+                result.append("\\" + c)
+                i += 1
+            else:
+                result.append(text[i:end + 1])
+                i = end + 1
+        elif c == "[":
+            match = MARKDOWN_LINK_RE.match(text, i)
+            if match is None:
+                result.append("\\[")
+                i += 1
+            else:
+                result.append(match.group(0))
+                i = match.end()
+        else:
+            end = i + 1
+            while end < len(text) and text[end] not in "\\_*`[":
+                end += 1
+            result.append(text[i:end])
+            i = end
+    return "".join(result)
@@ -15,6 +15,8 @@ HELP_MESSAGE_FOR_ADMINS = """Commands for admins:
 ⚪ /add user_id amount – Пополнить лимит токенов у юзера
 ⚪ /get_users – Получить csv-файл со списком юзеров
 ⚪ /get_subs – Получить csv-файл со списком платных подписчиков
+⚪ /get_payments – Получить csv-файл с журналом платежей
+⚪ /stats – Статистика кэшей и очередей бота
 ⚪ /send_message text - Отправить text всем юзерам
 
 📸 Отправьте фото, видео, кружок или гиф с подписью для перессылки всем юзерам
@@ -0,0 +1,142 @@
+'''
+Версионированные миграции схемы MongoDB и отчет по планам "горячих" запросов.
+
+Миграции применяются при старте бота (AsyncDatabase.migrate -> MongoStorage.migrate) по порядку версий,
+примененные версии записываются в коллекцию schema_migrations. Все шаги
+идемпотентны, поэтому повторный или параллельный запуск безопасен.
+
+Запуск вручную:
+    python bot/migrations.py migrate
+    python bot/migrations.py explain
+'''
+
+import sys
+import asyncio
+import logging
+from datetime import datetime
+
+import pymongo
+
+import config
+
+
+logger = logging.getLogger(__name__)
+
+
+async def _create_base_indexes(db):
+    await db.dialog_collection.create_index([("user_id", pymongo.ASCENDING), ("start_time", pymongo.DESCENDING)])
+    await db.user_collection.create_index("is_paid_sub")
+    await db.user_collection.create_index("last_interaction")
+    await db.user_collection.create_index("username")
+    await db.user_collection.create_index("token_limit")
+
+
+async def _create_payments_indexes(db):
+    # _id is provider_payment_charge_id, which already makes payments idempotent
+    await db.payment_collection.create_index([("user_id", pymongo.ASCENDING), ("date", pymongo.DESCENDING)])
+    await db.payment_collection.create_index("date")
+
+
+async def _create_dialog_archive_indexes(db):
+    # archive job scans old dialogs by start_time and skips the ones that are still current
+    await db.dialog_collection.create_index("start_time")
+    await db.user_collection.create_index("current_dialog_id")
+    await db.dialog_archive_collection.create_index([("user_id", pymongo.ASCENDING), ("start_time", pymongo.DESCENDING)])
+
+
+async def _create_uncredited_payments_index(db):
+    # only payments that are still waiting for their tokens are indexed
+    await db.payment_collection.create_index("credited", partialFilterExpression={"credited": False})
+
+
+# (version, description, coroutine function taking MongoStorage)
+MIGRATIONS = [
+    (1, "indexes: dialog.user_id+start_time, user.is_paid_sub, user.last_interaction, user.username, user.token_limit", _create_base_indexes),
+    (2, "payments ledger indexes: user_id+date, date", _create_payments_indexes),
+    (3, "dialog archive indexes: dialog.start_time, user.current_dialog_id, dialog_archive.user_id+start_time", _create_dialog_archive_indexes),
+    (5, "payments ledger index: uncredited payments", _create_uncredited_payments_index),
+]
+
+
+async def migrate(db):
+    """Применяет все еще не примененные миграции. Возвращает список примененных версий."""
+    migrations_collection = db.db["schema_migrations"]
+    applied_versions = {doc["_id"] async for doc in migrations_collection.find({}, projection={"_id": 1})}
+
+    newly_applied = []
+    for version, description, migration in MIGRATIONS:
+        if version in applied_versions:
+            continue
+
+        logger.info(f"Applying schema migration {version}: {description}")
+        await migration(db)
+        await migrations_collection.update_one(
+            {"_id": version},
+            {"$set": {"description": description, "applied_at": datetime.now()}},
+            upsert=True
+        )
+        newly_applied.append(version)
+
+    return newly_applied
+
+
+def hot_queries(db):
+    """Запросы, которые выполняются на каждом апдейте или в регулярных задачах."""
+    return {
+        "current dialog": db.dialog_collection.find({"_id": "", "user_id": 0}),
+        "user dialogs by start_time": db.dialog_collection.find({"user_id": 0}).sort("start_time", pymongo.DESCENDING),
+        "paid subscribers": db.user_collection.find({"is_paid_sub": True}),
+        "broadcast recipients": db.user_collection.find({"username": {"$ne": config.bot_username}}, projection={"_id": 1}),
+        "active users": db.user_collection.find({"last_interaction": {"$gte": datetime.now()}}),
+        "dialog archive candidates": db.dialog_collection.find({"start_time": {"$lt": datetime(2000, 1, 1)}}).sort("start_time", pymongo.ASCENDING),
+        "current dialogs among candidates": db.user_collection.find({"current_dialog_id": {"$in": [""]}}, projection={"current_dialog_id": 1}),
+        "daily balance refill": db.user_collection.find({"token_limit": {"$lt": config.token_limit_for_users}}, projection={"_id": 1}),
+    }
+
+
+def _plan_stages(plan):
+    stages = []
+    while plan is not None:
+        stage = plan["stage"]
+        if "indexName" in plan:
+            stage += f"({plan['indexName']})"
+        stages.append(stage)
+
+        if "inputStage" in plan:
+            plan = plan["inputStage"]
+        elif plan.get("inputStages"):
+            plan = plan["inputStages"][0]
+        else:
+            plan = None
+    return " <- ".join(stages)
+
+
+async def explain_hot_queries(db):
+    """Возвращает {название запроса: план} для каждого горячего запроса."""
+    report = {}
+    for name, cursor in hot_queries(db).items():
+        explanation = await cursor.explain()
+        execution_stats = explanation.get("executionStats", {})
+        report[name] = {
+            "winning_plan": _plan_stages(explanation["queryPlanner"]["winningPlan"]),
+            "docs_examined": execution_stats.get("totalDocsExamined"),
+            "keys_examined": execution_stats.get("totalKeysExamined"),
+        }
+    return report
+
+
+async def main(command):
+    from mongo_storage import MongoStorage
+
+    db = MongoStorage()
+    if command == "migrate":
+        print(f"Applied migrations: {await db.migrate()}")
+    elif command == "explain":
+        for name, plan in (await explain_hot_queries(db)).items():
+            print(f"{name}: {plan['winning_plan']} (docs examined: {plan['docs_examined']}, keys examined: {plan['keys_examined']})")
+    else:
+        raise ValueError(f"Unknown command {command}, use migrate or explain")
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else "explain"))
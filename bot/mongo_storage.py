@@ -0,0 +1,295 @@
+'''
+Хранилище на MongoDB (motor), основной бэкенд бота.
+'''
+
+import asyncio
+from datetime import datetime
+from typing import Optional, List
+
+import pymongo
+import motor.motor_asyncio
+
+import config
+import migrations
+from storage import (Storage, write_csv, USERS_EXPORT_FIELDS, USERS_EXPORT_HEADER, user_export_row,
+                     PAYMENTS_EXPORT_FIELDS, PAYMENTS_EXPORT_HEADER, payment_export_row, EXPORT_BATCH_SIZE,
+                     ARCHIVE_BATCH_SIZE, archive_dialog_document, unarchive_dialog_document, new_archive_report)
+
+
+class MongoStorage(Storage):
+    def __init__(self, mongodb_uri: str = config.mongodb_uri, db_name: str = "chatgpt_telegram_bot"):
+        self.client = motor.motor_asyncio.AsyncIOMotorClient(mongodb_uri)
+        self.db = self.client[db_name]
+
+        self.user_collection = self.db["user"]
+        self.dialog_collection = self.db["dialog"]
+        self.payment_collection = self.db["payments"]
+        self.dialog_archive_collection = self.db["dialog_archive"]
+
+    async def migrate(self) -> list:
+        return await migrations.migrate(self)
+
+    async def close(self):
+        self.client.close()
+
+    # users
+    async def find_user(self, user_id: int) -> Optional[dict]:
+        return await self.user_collection.find_one({"_id": user_id})
+
+    async def insert_user(self, user_dict: dict):
+        await self.user_collection.insert_one(user_dict)
+
+    async def insert_users(self, user_dicts: List[dict]):
+        await self.user_collection.insert_many(user_dicts, ordered=False)
+
+    async def update_user(self, user_id: int, fields: dict) -> bool:
+        result = await self.user_collection.update_one({"_id": user_id}, {"$set": fields})
+        return result.matched_count > 0
+
+    async def inc_user(self, user_id: int, inc: dict, set_fields: Optional[dict] = None) -> Optional[dict]:
+        update = {"$inc": inc}
+        if set_fields:
+            update["$set"] = set_fields
+
+        return await self.user_collection.find_one_and_update(
+            {"_id": user_id},
+            update,
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+
+    async def clear_overdraft(self, user_id: int) -> Optional[dict]:
+        # conditional: a top-up that lands first makes the filter miss instead of being erased
+        return await self.user_collection.find_one_and_update(
+            {"_id": user_id, "token_limit": {"$lt": 0}},
+            {"$set": {"token_limit": 0}},
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+
+    async def max_last_interactions(self, last_interactions: dict):
+        # $max: a flush never moves last_interaction backwards
+        requests = [
+            pymongo.UpdateOne({"_id": user_id}, {"$max": {"last_interaction": when}})
+            for user_id, when in last_interactions.items()
+        ]
+        await self.user_collection.bulk_write(requests, ordered=False)
+
+    async def refill_balances(self, token_limit: int) -> List[int]:
+        user_filter = {"token_limit": {"$lt": token_limit}}
+
+        # ids only (covered by the token_limit index), then one set-based update of exactly those users:
+        # whoever drops below the limit in between is refilled next time, not left out of the returned ids
+        user_ids_list = [user["_id"] async for user in self.user_collection.find(user_filter, projection={"_id": 1})]
+        if len(user_ids_list) > 0:
+            await self.user_collection.update_many(
+                {"_id": {"$in": user_ids_list}, **user_filter}, {"$set": {"token_limit": token_limit}}
+            )
+        return user_ids_list
+
+    async def find_broadcast_user_ids(self, exclude_username: str) -> List[int]:
+        user_ids_list = []
+        async for user in self.user_collection.find({"username": {"$ne": exclude_username}}, projection={"_id": 1}):
+            user_ids_list.append(int(user['_id']))
+        return user_ids_list
+
+    async def delete_user(self, user_id: int) -> bool:
+        result = await self.user_collection.delete_one({"_id": user_id})
+        return result.deleted_count > 0
+
+    # dialogs
+    async def insert_dialog(self, dialog_dict: dict):
+        await self.dialog_collection.insert_one(dialog_dict)
+
+    async def get_dialog_messages(self, user_id: int, dialog_id: str) -> Optional[list]:
+        dialog_dict = await self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
+        if dialog_dict is None:
+            return None
+        return dialog_dict["messages"]
+
+    async def get_dialog_window(self, user_id: int, dialog_id: str, max_messages: int, summary_until: Optional[datetime] = None):
+        # only the tail of the array and its length go over the wire
+        pipeline = [{"$match": {"_id": dialog_id, "user_id": user_id}}]
+        if summary_until is not None:
+            pipeline.append({"$project": {"messages": {
+                "$filter": {"input": "$messages", "as": "message", "cond": {"$gt": ["$$message.date", summary_until]}}
+            }}})
+        pipeline += [
+            {"$project": {
+                "_id": 0,
+                "n_messages": {"$size": "$messages"},
+                "messages": {"$slice": ["$messages", -max_messages]}
+            }}
+        ]
+        dialog_dicts = await self.dialog_collection.aggregate(pipeline).to_list(length=1)
+        if len(dialog_dicts) == 0:
+            return [], 0
+        return dialog_dicts[0]["messages"], dialog_dicts[0]["n_messages"]
+
+    async def has_dialog_messages(self, user_id: int, dialog_id: str) -> bool:
+        dialog_dict = await self.dialog_collection.find_one(
+            {"_id": dialog_id, "user_id": user_id, "messages.0": {"$exists": True}},
+            projection={"_id": 1}
+        )
+        return dialog_dict is not None
+
+    async def set_dialog_messages(self, user_id: int, dialog_id: str, dialog_messages: list):
+        await self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$set": {"messages": dialog_messages}}
+        )
+
+    async def push_dialog_message(self, user_id: int, dialog_id: str, dialog_message: dict, max_messages: Optional[int] = None):
+        push = {"$each": [dialog_message]}
+        if max_messages is not None:
+            push["$slice"] = -max_messages
+
+        await self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$push": {"messages": push}}
+        )
+
+    async def pop_dialog_message(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        dialog_dict = await self.dialog_collection.find_one_and_update(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$pop": {"messages": 1}},
+            projection={"messages": {"$slice": -1}},
+            return_document=pymongo.ReturnDocument.BEFORE
+        )
+        if dialog_dict is None or len(dialog_dict["messages"]) == 0:
+            return None
+        return dialog_dict["messages"][0]
+
+    async def get_dialog_summary(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        dialog_dict = await self.dialog_collection.find_one(
+            {"_id": dialog_id, "user_id": user_id, "summary": {"$exists": True}},
+            projection={"_id": 0, "summary": 1, "summary_until": 1}
+        )
+        return dialog_dict
+
+    async def set_dialog_summary(
+        self, user_id: int, dialog_id: str, summary: str, summary_until: datetime, previous_summary_until: Optional[datetime]
+    ) -> bool:
+        # {"summary_until": None} also matches dialogs without the field
+        result = await self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id, "summary_until": previous_summary_until},
+            {"$set": {"summary": summary, "summary_until": summary_until}}
+        )
+        return result.matched_count > 0
+
+    async def archive_dialogs(self, older_than: datetime, batch_size: int = ARCHIVE_BATCH_SIZE) -> dict:
+        report = new_archive_report()
+        archived_at = datetime.now()
+
+        # start_time index; archived documents are deleted behind the cursor, which never revisits them
+        cursor = self.dialog_collection.find({"start_time": {"$lt": older_than}}).sort("start_time", pymongo.ASCENDING).batch_size(batch_size)
+        batch = []
+        async for dialog_dict in cursor:
+            batch.append(dialog_dict)
+            if len(batch) == batch_size:
+                await self._archive_batch(batch, archived_at, report)
+                batch = []
+        if batch:
+            await self._archive_batch(batch, archived_at, report)
+        return report
+
+    async def _archive_batch(self, dialog_dicts: List[dict], archived_at: datetime, report: dict):
+        # a dialog that is still somebody's current one stays hot however old it is
+        dialog_ids = [dialog_dict["_id"] for dialog_dict in dialog_dicts]
+        current_dialog_ids = {
+            user["current_dialog_id"]
+            async for user in self.user_collection.find({"current_dialog_id": {"$in": dialog_ids}}, projection={"current_dialog_id": 1})
+        }
+        dialog_dicts = [dialog_dict for dialog_dict in dialog_dicts if dialog_dict["_id"] not in current_dialog_ids]
+        if len(dialog_dicts) == 0:
+            return
+
+        # compression is CPU work, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        archived = await loop.run_in_executor(
+            None, lambda: [archive_dialog_document(dialog_dict, archived_at) for dialog_dict in dialog_dicts]
+        )
+
+        # upsert first, delete second: a crash in between leaves a dialog in both places, never in none
+        await self.dialog_archive_collection.bulk_write(
+            [pymongo.ReplaceOne({"_id": archive_dict["_id"]}, archive_dict, upsert=True) for archive_dict, _ in archived],
+            ordered=False
+        )
+        await self.dialog_collection.delete_many({"_id": {"$in": [archive_dict["_id"] for archive_dict, _ in archived]}})
+
+        for archive_dict, raw_bytes in archived:
+            report["n_dialogs"] += 1
+            report["n_messages"] += archive_dict["n_messages"]
+            report["raw_bytes"] += raw_bytes
+            report["archived_bytes"] += len(archive_dict["data"])
+
+    async def get_archived_dialog(self, dialog_id: str) -> Optional[dict]:
+        archive_dict = await self.dialog_archive_collection.find_one({"_id": dialog_id})
+        if archive_dict is None:
+            return None
+        return unarchive_dialog_document(archive_dict)
+
+    # payments
+    async def insert_payment(self, payment_dict: dict) -> bool:
+        try:
+            await self.payment_collection.insert_one(payment_dict)
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        return True
+
+    async def credit_payment(self, payment_id: str) -> Optional[dict]:
+        payment_dict = await self.payment_collection.find_one({"_id": payment_id, "credited": False})
+        if payment_dict is None:
+            return None
+
+        # the guard and the $inc are one atomic update of the user: a retry after a crash can't credit twice
+        user_dict = await self.user_collection.find_one_and_update(
+            {"_id": payment_dict["user_id"], "credited_payments": {"$ne": payment_id}},
+            {
+                "$inc": {"token_limit": payment_dict["n_tokens"]},
+                "$set": {"is_paid_sub": True},
+                "$push": {"credited_payments": payment_id},
+            },
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        if user_dict is None:
+            is_credited = await self.user_collection.count_documents(
+                {"_id": payment_dict["user_id"], "credited_payments": payment_id}, limit=1
+            ) > 0
+            if not is_credited:
+                return None  # the user is gone
+
+        # the ledger flag only spares the next retry a lookup, the user document is the source of truth
+        await self.payment_collection.update_one({"_id": payment_id}, {"$set": {"credited": True}})
+        return user_dict
+
+    async def find_uncredited_payments(self) -> List[dict]:
+        # payments written before the flag existed have no "credited" field and were credited right away
+        return await self.payment_collection.find({"credited": False}).to_list(length=None)
+
+    # exports
+    async def export_users_csv(self, path: str, paid_subs_only: bool, exclude_username: str) -> int:
+        if paid_subs_only:
+            user_filter = {"is_paid_sub": True}
+        else:
+            user_filter = {"username": {"$ne": exclude_username}}
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, self._write_csv, path, self.user_collection, user_filter,
+            USERS_EXPORT_FIELDS, USERS_EXPORT_HEADER, user_export_row
+        )
+
+    async def export_payments_csv(self, path: str) -> int:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, self._write_csv, path, self.payment_collection, {},
+            PAYMENTS_EXPORT_FIELDS, PAYMENTS_EXPORT_HEADER, payment_export_row
+        )
+
+    def _write_csv(self, path: str, collection, query_filter: dict, fields: list, header: list, row_func) -> int:
+        # sync pymongo collection behind motor: the whole export runs inside the worker thread
+        cursor = collection.delegate.find(
+            query_filter,
+            projection={field: 1 for field in fields},
+            batch_size=EXPORT_BATCH_SIZE
+        )
+        return write_csv(path, cursor, header, row_func)
@@ -1,6 +1,17 @@
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import contextlib
+from collections import deque
+
 import config
+import tokens
+import streaming
+import completion_cache as completion_cache_module
 
-import tiktoken
+import aiohttp
 import openai
 openai.api_key = config.openai_api_key
 
@@ -15,108 +26,665 @@ OPENAI_COMPLETION_OPTIONS = {
     "presence_penalty": 0
 }
 
+DIALOG_SUMMARY_COMPLETION_OPTIONS = {
+    "temperature": 0.3,
+    "max_tokens": 400,
+}
+
+DIALOG_SUMMARY_INSTRUCTION = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Update the current summary with the new messages. Keep facts, names, numbers, decisions, "
+    "user preferences and open questions, drop small talk. Write in the language of the conversation, "
+    "at most 200 words. Reply with the updated summary only."
+)
+
+# opt-in: identical prompts in the same mode share one answer (see completion_cache.py)
+completion_cache = None
+if config.enable_completion_cache:
+    completion_cache = completion_cache_module.CompletionCache(
+        maxsize=config.completion_cache_size,
+        ttl=config.completion_cache_ttl,
+        wait_timeout=config.completion_cache_wait_timeout
+    )
+
+MODEL_CONTEXT_WINDOW = {
+    "gpt-3.5-turbo": 4096,
+    "text-davinci-003": 4097,
+}
+
+
+class OpenAISession:
+    """Одна aiohttp-сессия с ограниченным пулом соединений для всех запросов к OpenAI.
+
+    Без нее openai создает новую сессию (и TLS-соединение) на каждый запрос.
+    Сессия создается в post_init и закрывается при остановке бота; openai.aiosession -
+    ContextVar, поэтому request() выставляет сессию в контексте текущей задачи.
+    """
+
+    def __init__(self, limit: int = 100, keepalive_timeout: float = 30):
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self.session = None
+
+        self.n_requests = 0
+        self.n_in_flight = 0
+        self.max_in_flight = 0
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=self.keepalive_timeout, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _begin(self):
+        if self.session is not None:
+            openai.aiosession.set(self.session)
+
+        self.n_requests += 1
+        self.n_in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.n_in_flight)
+
+    def _end(self):
+        self.n_in_flight -= 1
+
+    @contextlib.asynccontextmanager
+    async def request(self):
+        self._begin()
+        try:
+            yield
+        finally:
+            self._end()
+
+    async def call(self, func, *args, **kwargs):
+        """await func(*args, **kwargs) через общую сессию. Запрос с stream=True остается в работе,
+        пока поток не дочитан или не закрыт: тело ответа читается уже после возврата из func.
+        """
+        self._begin()
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException:
+            self._end()
+            raise
+
+        if kwargs.get("stream"):
+            return self._end_after_stream(result)
+        self._end()
+        return result
+
+    async def _end_after_stream(self, stream):
+        try:
+            async for item in stream:
+                yield item
+        finally:
+            await stream.aclose()
+            self._end()
+
+    def stats(self) -> dict:
+        n_idle_connections = 0
+        n_used_connections = 0
+        if self.session is not None:
+            # aiohttp has no public counters of idle and acquired connections
+            n_idle_connections = sum(len(conns) for conns in getattr(self.session.connector, "_conns", {}).values())
+            n_used_connections = len(getattr(self.session.connector, "_acquired", ()))
+
+        return {
+            "started": self.session is not None,
+            "limit": self.limit,
+            "in_flight": self.n_in_flight,
+            "max_in_flight": self.max_in_flight,
+            "used_connections": n_used_connections,
+            "idle_connections": n_idle_connections,
+            "requests": self.n_requests,
+        }
+
+
+openai_session = OpenAISession(limit=config.openai_connection_pool_size, keepalive_timeout=config.openai_keepalive_timeout)
+
+
+# priority lanes of RequestScheduler, lower value goes first
+PRIORITY_ADMIN = 0
+PRIORITY_PAID = 1
+PRIORITY_FREE = 2
+PRIORITY_BACKGROUND = 3
+PRIORITY_LANES = {
+    PRIORITY_ADMIN: "admin",
+    PRIORITY_PAID: "paid",
+    PRIORITY_FREE: "free",
+    PRIORITY_BACKGROUND: "background",
+}
+
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+)
+
+
+# errors that say something about the key or endpoint, not about the request
+ENDPOINT_ERRORS = RETRYABLE_ERRORS + (
+    openai.error.AuthenticationError,
+    openai.error.PermissionError,
+)
+
+
+class ApiEndpoint:
+    def __init__(self, api_key: str, api_base: str = None, weight: float = 1):
+        self.api_key = api_key
+        self.api_base = api_base
+        self.weight = weight
+
+        self.n_outstanding = 0
+        self.n_requests = 0
+        self.n_tokens = 0
+        self.n_errors = 0
+        self.n_consecutive_errors = 0
+        self.n_ejections = 0
+        self.ejected_until = 0.0
+
+    @property
+    def name(self) -> str:
+        name = f"...{self.api_key[-4:]}"
+        if self.api_base is not None:
+            name += f"@{self.api_base}"
+        return name
+
+    def request_kwargs(self) -> dict:
+        kwargs = {"api_key": self.api_key}
+        if self.api_base is not None:
+            kwargs["api_base"] = self.api_base
+        return kwargs
+
+
+class ApiKeyPool:
+    """Пул ключей/адресов OpenAI: запрос уходит на здоровый ключ с наименьшим числом запросов в работе
+    (с учетом веса). После eject_errors ошибок подряд ключ выводится из пула на eject_timeout секунд,
+    при повторных выводах время удваивается.
+    """
+
+    MAX_EJECT_TIMEOUT = 600
+
+    def __init__(self, endpoints, eject_errors: int = 3, eject_timeout: float = 30):
+        self.endpoints = endpoints
+        self.eject_errors = eject_errors
+        self.eject_timeout = eject_timeout
+
+    @classmethod
+    def from_config(cls):
+        endpoints = []
+        for item in config.openai_api_keys:
+            if isinstance(item, str):
+                item = {"api_key": item}
+            endpoints.append(ApiEndpoint(item["api_key"], api_base=item.get("api_base"), weight=item.get("weight", 1)))
+        if len(endpoints) == 0:
+            endpoints.append(ApiEndpoint(config.openai_api_key))
+
+        return cls(endpoints, eject_errors=config.openai_key_eject_errors, eject_timeout=config.openai_key_eject_timeout)
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def acquire(self, n_tokens: int = 0) -> ApiEndpoint:
+        now = time.monotonic()
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.ejected_until <= now]
+        if healthy:
+            # least outstanding requests per unit of weight, the less used key wins a tie
+            endpoint = min(healthy, key=lambda endpoint: ((endpoint.n_outstanding + 1) / endpoint.weight, endpoint.n_requests / endpoint.weight))
+        else:
+            # everything is ejected: the key that comes back first gets an early probe
+            endpoint = min(self.endpoints, key=lambda endpoint: endpoint.ejected_until)
+
+        endpoint.n_outstanding += 1
+        endpoint.n_requests += 1
+        endpoint.n_tokens += n_tokens
+        return endpoint
+
+    def release(self, endpoint: ApiEndpoint, error: Exception = None):
+        endpoint.n_outstanding -= 1
+        if error is None or not isinstance(error, ENDPOINT_ERRORS):
+            endpoint.n_consecutive_errors = 0
+            return
+
+        endpoint.n_errors += 1
+        endpoint.n_consecutive_errors += 1
+        if endpoint.n_consecutive_errors >= self.eject_errors:
+            timeout = min(self.MAX_EJECT_TIMEOUT, self.eject_timeout * 2 ** endpoint.n_ejections)
+            endpoint.ejected_until = time.monotonic() + timeout
+            endpoint.n_ejections += 1
+            endpoint.n_consecutive_errors = 0
+
+    def stats(self) -> list:
+        now = time.monotonic()
+        return [
+            {
+                "name": endpoint.name,
+                "healthy": endpoint.ejected_until <= now,
+                "outstanding": endpoint.n_outstanding,
+                "requests": endpoint.n_requests,
+                "tokens": endpoint.n_tokens,
+                "errors": endpoint.n_errors,
+                "ejections": endpoint.n_ejections,
+            }
+            for endpoint in self.endpoints
+        ]
+
+
+api_key_pool = ApiKeyPool.from_config()
+
+
+class TokenBucket:
+    """Бюджет на минуту, который непрерывно пополняется со скоростью capacity / 60 в секунду."""
+
+    def __init__(self, capacity_per_minute: float):
+        self.capacity = capacity_per_minute
+        self.rate = capacity_per_minute / 60
+        self.level = capacity_per_minute
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """Через сколько секунд в бюджете будет amount (запрос больше всего бюджета ждет полного бюджета)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def consume(self, amount: float):
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+
+class RequestScheduler:
+    """Очередь запросов к OpenAI с бюджетами RPM/TPM и приоритетами.
+
+    Запрос уходит, когда в обоих бюджетах есть место, в порядке (приоритет, время постановки):
+    админы, платные подписчики, остальные, фоновые задачи. Ответы 429/503 и сетевые ошибки
+    повторяются с экспоненциальной задержкой со случайным разбросом, а после 429 пауза
+    распространяется на всю очередь.
+    """
+
+    def __init__(self, rpm: int, tpm: int = None, session: OpenAISession = None, key_pool: ApiKeyPool = None,
+                 max_retries: int = 5, backoff_base: float = 1.0, backoff_max: float = 30.0):
+        self.requests_bucket = TokenBucket(rpm)
+        self.tokens_bucket = TokenBucket(tpm) if tpm else None
+        self.session = session
+        self.key_pool = key_pool
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._queue = []  # heap of (priority, seq, n_tokens, enqueued_at, future)
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._paused_until = 0.0
+
+        self.lane_stats = {
+            priority: {"queued": 0, "dispatched": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for priority in PRIORITY_LANES
+        }
+        self.n_retries = 0
+        self.n_rate_limited = 0
+        self._dispatched_at = deque()  # dispatch times over the last minute
+
+    async def acquire(self, priority: int = PRIORITY_FREE, n_tokens: int = 0):
+        """Ждет своей очереди и места в бюджетах."""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), n_tokens, time.monotonic(), future))
+        self.lane_stats[priority]["queued"] += 1
+        self._dispatch()
+        await future
+
+    def _dispatch(self):
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+
+        while self._queue:
+            priority, _, n_tokens, enqueued_at, future = self._queue[0]
+            if future.done():  # the waiter was cancelled
+                heapq.heappop(self._queue)
+                self.lane_stats[priority]["queued"] -= 1
+                continue
+
+            now = time.monotonic()
+            wait = max(self._paused_until - now, self.requests_bucket.wait_time(1))
+            if self.tokens_bucket is not None:
+                wait = max(wait, self.tokens_bucket.wait_time(n_tokens))
+            if wait > 0:
+                # strict priority: nobody overtakes the head of the queue
+                self._wakeup = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+
+            heapq.heappop(self._queue)
+            self.requests_bucket.consume(1)
+            if self.tokens_bucket is not None:
+                self.tokens_bucket.consume(n_tokens)
+
+            lane_stats = self.lane_stats[priority]
+            lane_stats["queued"] -= 1
+            lane_stats["dispatched"] += 1
+            lane_stats["wait_total"] += now - enqueued_at
+            lane_stats["wait_max"] = max(lane_stats["wait_max"], now - enqueued_at)
+            self._dispatched_at.append(now)
+            future.set_result(None)
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    async def run(self, func, *args, priority: int = PRIORITY_FREE, n_tokens: int = 0, **kwargs):
+        """Выполняет await func(*args, **kwargs) через очередь, повторяя при 429/503 и сетевых ошибках.
+
+        n_tokens - оценка токенов запроса (промпт + max_tokens), как их считает лимит TPM OpenAI.
+        С key_pool в kwargs добавляются api_key/api_base выбранного ключа; при stream=True ключ
+        считается занятым, пока поток не дочитан или не закрыт.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(priority, n_tokens)
+
+            # every attempt picks a key again, so a retry goes to another key if this one is failing
+            endpoint = None
+            request_kwargs = kwargs
+            if self.key_pool is not None:
+                endpoint = self.key_pool.acquire(n_tokens)
+                request_kwargs = dict(kwargs, **endpoint.request_kwargs())
+
+            try:
+                if self.session is not None:
+                    result = await self.session.call(func, *args, **request_kwargs)
+                else:
+                    result = await func(*args, **request_kwargs)
+                if endpoint is not None:
+                    if kwargs.get("stream"):
+                        # the key stays busy until the last chunk of the stream
+                        return self._release_after_stream(result, endpoint)
+                    self.key_pool.release(endpoint)
+                return result
+            except Exception as e:
+                if endpoint is not None:
+                    self.key_pool.release(endpoint, error=e)
+                if not isinstance(e, RETRYABLE_ERRORS):
+                    raise
+                if attempt == self.max_retries:
+                    raise
+                if isinstance(e, openai.error.RateLimitError) and getattr(e, "code", None) == "insufficient_quota":
+                    raise  # out of credits, retries won't help
+
+                delay = self._backoff(attempt)
+                if isinstance(e, openai.error.RateLimitError):
+                    # our budgets are ahead of the real limits: hold the whole queue
+                    self.n_rate_limited += 1
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self.n_retries += 1
+                await asyncio.sleep(delay)
+
+    async def _release_after_stream(self, stream, endpoint: ApiEndpoint):
+        error = None
+        try:
+            async for item in stream:
+                yield item
+        except Exception as e:
+            error = e  # a stream broken midway counts against the key
+            raise
+        finally:
+            await stream.aclose()
+            self.key_pool.release(endpoint, error=error)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        while self._dispatched_at and self._dispatched_at[0] < now - 60:
+            self._dispatched_at.popleft()
+
+        lanes = {}
+        for priority, lane_stats in self.lane_stats.items():
+            lanes[PRIORITY_LANES[priority]] = {
+                "queued": lane_stats["queued"],
+                "dispatched": lane_stats["dispatched"],
+                "wait_avg": lane_stats["wait_total"] / lane_stats["dispatched"] if lane_stats["dispatched"] > 0 else 0.0,
+                "wait_max": lane_stats["wait_max"],
+            }
+        return {
+            "requests_per_minute": len(self._dispatched_at),
+            "retries": self.n_retries,
+            "rate_limited": self.n_rate_limited,
+            "lanes": lanes,
+        }
+
+
+# limits are per key, the pool multiplies them
+chat_scheduler = RequestScheduler(
+    rpm=config.openai_rpm_limit * len(api_key_pool), tpm=config.openai_tpm_limit * len(api_key_pool),
+    session=openai_session, key_pool=api_key_pool, max_retries=config.openai_max_retries
+)
+audio_scheduler = RequestScheduler(
+    rpm=config.openai_audio_rpm_limit * len(api_key_pool),
+    session=openai_session, key_pool=api_key_pool, max_retries=config.openai_max_retries
+)
+image_scheduler = RequestScheduler(
+    rpm=config.openai_image_rpm_limit * len(api_key_pool),
+    session=openai_session, key_pool=api_key_pool, max_retries=config.openai_max_retries
+)
+
+
+def dialog_summary_prompt(dialog_summary):
+    """Текст, который отправляется в промпте вместо свернутых сообщений диалога."""
+    if dialog_summary is None:
+        return None
+    return f"Summary of the earlier part of this conversation:\n{dialog_summary['summary']}"
+
 
 class ChatGPT:
-    def __init__(self, use_chatgpt_api=True):
+    def __init__(self, use_chatgpt_api=True, priority=PRIORITY_FREE):
         self.use_chatgpt_api = use_chatgpt_api
+        self.model = "gpt-3.5-turbo" if use_chatgpt_api else "text-davinci-003"
+        self.priority = priority
+
+    def dialog_token_budget(self, message, chat_mode="assistant", dialog_summary=None):
+        """Сколько токенов контекста остается на историю диалога при отправке message."""
+        # system prompt + current user message, 5 service tokens each
+        prompt_tokens = 2 * tokens.CHAT_MESSAGE_TOKENS
+        prompt_tokens += tokens.prompt_start_tokens(chat_mode, model=self.model)
+        prompt_tokens += tokens.count_text_tokens(message, model=self.model)
+        if dialog_summary is not None:
+            prompt_tokens += tokens.CHAT_MESSAGE_TOKENS + tokens.count_text_tokens(dialog_summary_prompt(dialog_summary), model=self.model)
+        return MODEL_CONTEXT_WINDOW[self.model] - OPENAI_COMPLETION_OPTIONS["max_tokens"] - prompt_tokens
     
-    async def send_message(self, message, dialog_messages=[], chat_mode="assistant"):
+    def pack_dialog_messages(self, message, dialog_messages, chat_mode="assistant", dialog_summary=None):
+        """Оставляет самые новые сообщения диалога, которые вместе с system prompt, кратким содержанием,
+        message и max_tokens помещаются в контекст модели. Возвращает (dialog_messages, n_first_dialog_messages_removed).
+        """
+        token_budget = self.dialog_token_budget(message, chat_mode=chat_mode, dialog_summary=dialog_summary)
+        if token_budget < 0:
+            raise ValueError("Dialog messages is reduced to zero, but still has too many tokens to make completion")
+
+        n_tokens = 0
+        n_dialog_messages_kept = 0
+        for dialog_message in reversed(dialog_messages):
+            n_tokens += tokens.dialog_message_tokens(dialog_message, model=self.model)
+            if n_tokens > token_budget:
+                break
+            n_dialog_messages_kept += 1
+
+        n_first_dialog_messages_removed = len(dialog_messages) - n_dialog_messages_kept
+        return dialog_messages[n_first_dialog_messages_removed:], n_first_dialog_messages_removed
+
+    def _estimate_request_tokens(self, message, dialog_messages, chat_mode, dialog_summary):
+        # prompt + max_tokens, the way the TPM limit counts a request
+        n_tokens = MODEL_CONTEXT_WINDOW[self.model] - self.dialog_token_budget(message, chat_mode=chat_mode, dialog_summary=dialog_summary)
+        n_tokens += sum(tokens.dialog_message_tokens(dialog_message, model=self.model) for dialog_message in dialog_messages)
+        return n_tokens
+
+    async def _lookup_cached_completion(self, chat_mode, prompt):
+        """(cache_key, (answer, n_used_tokens) или None). Если вернулся ключ без значения, запрос ведущий
+        и должен вызвать completion_cache.set() или completion_cache.release()."""
+        if completion_cache is None:
+            return None, None
+
+        cache_key = completion_cache_module.make_key(self.model, chat_mode, prompt, OPENAI_COMPLETION_OPTIONS)
+        try:
+            return cache_key, await completion_cache.lookup(cache_key)
+        except asyncio.TimeoutError:
+            # the same request is stuck somewhere else: make a fresh one, not shared with anybody
+            return None, None
+
+    async def send_message(self, message, dialog_messages=[], chat_mode="assistant", dialog_summary=None):
         if chat_mode not in CHAT_MODES.keys():
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
-        n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        while answer is None:
-            try:
-                if self.use_chatgpt_api:
-                    messages = self._generate_prompt_messages_for_chatgpt_api(message, dialog_messages, chat_mode)
-                    r = await openai.ChatCompletion.acreate(
-                        model="gpt-3.5-turbo",
-                        messages=messages,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
-                    answer = r.choices[0].message["content"]
-                else:
-                    prompt = self._generate_prompt(message, dialog_messages, chat_mode)
-                    r = await openai.Completion.acreate(
-                        engine="text-davinci-003",
-                        prompt=prompt,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
-                    answer = r.choices[0].text
-
-                answer = self._postprocess_answer(answer)
-                n_used_tokens = r.usage.total_tokens
-                
-            except openai.error.InvalidRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise ValueError("Dialog messages is reduced to zero, but still has too many tokens to make completion") from e
-
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
-
-        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+        # the prompt is fitted into the context window before the request, no retries on InvalidRequestError
+        dialog_messages, n_first_dialog_messages_removed = self.pack_dialog_messages(
+            message, dialog_messages, chat_mode=chat_mode, dialog_summary=dialog_summary
+        )
+
+        if self.use_chatgpt_api:
+            prompt = self._generate_prompt_messages_for_chatgpt_api(message, dialog_messages, chat_mode, dialog_summary)
+        else:
+            prompt = self._generate_prompt(message, dialog_messages, chat_mode, dialog_summary)
+
+        cache_key, cached = await self._lookup_cached_completion(chat_mode, prompt)
+        if cached is not None:
+            answer, n_used_tokens = cached
+            return answer, n_used_tokens, n_first_dialog_messages_removed
+
+        n_request_tokens = self._estimate_request_tokens(message, dialog_messages, chat_mode, dialog_summary)
+        try:
+            if self.use_chatgpt_api:
+                r = await chat_scheduler.run(
+                    openai.ChatCompletion.acreate,
+                    model="gpt-3.5-turbo",
+                    messages=prompt,
+                    priority=self.priority,
+                    n_tokens=n_request_tokens,
+                    **OPENAI_COMPLETION_OPTIONS
+                )
+                answer = r.choices[0].message["content"]
+            else:
+                r = await chat_scheduler.run(
+                    openai.Completion.acreate,
+                    engine="text-davinci-003",
+                    prompt=prompt,
+                    priority=self.priority,
+                    n_tokens=n_request_tokens,
+                    **OPENAI_COMPLETION_OPTIONS
+                )
+                answer = r.choices[0].text
+
+            answer = self._postprocess_answer(answer)
+            n_used_tokens = r.usage.total_tokens
+
+            if cache_key is not None:
+                completion_cache.set(cache_key, (answer, n_used_tokens))
+        finally:
+            if cache_key is not None:
+                completion_cache.release(cache_key)
 
         return answer, n_used_tokens, n_first_dialog_messages_removed
 
-    async def send_message_stream(self, message, dialog_messages=[], chat_mode="assistant"):
+    async def send_message_stream(self, message, dialog_messages=[], chat_mode="assistant", dialog_summary=None, buffer=None):
+        """Отдает ("not_finished", дельта) по мере генерации и ("finished", ответ, n_used_tokens, n_removed) в конце.
+
+        Дельты дописываются в buffer (streaming.StreamBuffer вызывающего, по умолчанию - свой), так что ответ
+        собирается один раз и вызывающему не нужно копить дельты самому. В "finished" приходит уже обработанный ответ.
+        """
+        if buffer is None:
+            buffer = streaming.StreamBuffer()
+
         if chat_mode not in CHAT_MODES.keys():
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
-        n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        while answer is None:
-            try:
-                if self.use_chatgpt_api:
-                    messages = self._generate_prompt_messages_for_chatgpt_api(message, dialog_messages, chat_mode)
-                    r_gen = await openai.ChatCompletion.acreate(
-                        model="gpt-3.5-turbo",
-                        messages=messages,
-                        stream=True,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
-
-                    answer = ""
+        dialog_messages, n_first_dialog_messages_removed = self.pack_dialog_messages(
+            message, dialog_messages, chat_mode=chat_mode, dialog_summary=dialog_summary
+        )
+
+        if self.use_chatgpt_api:
+            prompt = self._generate_prompt_messages_for_chatgpt_api(message, dialog_messages, chat_mode, dialog_summary)
+        else:
+            prompt = self._generate_prompt(message, dialog_messages, chat_mode, dialog_summary)
+
+        cache_key, cached = await self._lookup_cached_completion(chat_mode, prompt)
+        if cached is not None:
+            # replayed through the same statuses, so message_handle renders it like a streamed answer
+            answer, n_used_tokens = cached
+            buffer.append(answer)
+            yield "not_finished", answer
+            yield "finished", answer, n_used_tokens, n_first_dialog_messages_removed
+            return
+
+        n_request_tokens = self._estimate_request_tokens(message, dialog_messages, chat_mode, dialog_summary)
+        try:
+            if self.use_chatgpt_api:
+                r_gen = await chat_scheduler.run(
+                    openai.ChatCompletion.acreate,
+                    model="gpt-3.5-turbo",
+                    messages=prompt,
+                    stream=True,
+                    priority=self.priority,
+                    n_tokens=n_request_tokens,
+                    **OPENAI_COMPLETION_OPTIONS
+                )
+
+                try:
                     async for r_item in r_gen:
                         delta = r_item.choices[0].delta
                         if "content" in delta:
-                            answer += delta.content
-                            yield "not_finished", answer
-
-                    n_used_tokens = self._count_tokens_for_chatgpt(messages, answer, model="gpt-3.5-turbo")
-                else:
-                    prompt = self._generate_prompt(message, dialog_messages, chat_mode)
-                    r_gen = await openai.Completion.acreate(
-                        engine="text-davinci-003",
-                        prompt=prompt,
-                        stream=True,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
-                    
-                    answer = ""
+                            buffer.append(delta.content)
+                            yield "not_finished", delta.content
+                finally:
+                    await r_gen.aclose()  # an abandoned answer gives its key back right away
+
+                answer = buffer.getvalue()
+                n_used_tokens = tokens.count_chat_tokens(
+                    message, dialog_messages, chat_mode, answer, model="gpt-3.5-turbo", summary_prompt=dialog_summary_prompt(dialog_summary)
+                )
+            else:
+                r_gen = await chat_scheduler.run(
+                    openai.Completion.acreate,
+                    engine="text-davinci-003",
+                    prompt=prompt,
+                    stream=True,
+                    priority=self.priority,
+                    n_tokens=n_request_tokens,
+                    **OPENAI_COMPLETION_OPTIONS
+                )
+
+                try:
                     async for r_item in r_gen:
-                        answer += r_item.choices[0].text
-                        yield "not_finished", answer
-
-                    n_used_tokens = self._count_tokens_for_gpt(prompt, answer, model="text-davinci-003")
+                        delta = r_item.choices[0].text
+                        buffer.append(delta)
+                        yield "not_finished", delta
+                finally:
+                    await r_gen.aclose()
 
-                answer = self._postprocess_answer(answer)
-                
-            except openai.error.InvalidRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise ValueError("Dialog messages is reduced to zero, but still has too many tokens to make completion") from e
+                answer = buffer.getvalue()
+                n_used_tokens = tokens.count_completion_tokens(prompt, answer, model="text-davinci-003")
 
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
+            answer = self._postprocess_answer(answer)
 
-        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+            if cache_key is not None:
+                completion_cache.set(cache_key, (answer, n_used_tokens))
+        finally:
+            # waiters of a failed or abandoned request retry on their own
+            if cache_key is not None:
+                completion_cache.release(cache_key)
 
         yield "finished", answer, n_used_tokens, n_first_dialog_messages_removed  # sending final answer
 
-    def _generate_prompt(self, message, dialog_messages, chat_mode):
+    def _generate_prompt(self, message, dialog_messages, chat_mode, dialog_summary=None):
         prompt = CHAT_MODES[chat_mode]["prompt_start"]
         prompt += "\n\n"
 
+        if dialog_summary is not None:
+            prompt += dialog_summary_prompt(dialog_summary)
+            prompt += "\n\n"
+
         # add chat context
         if len(dialog_messages) > 0:
             prompt += "Chat:\n"
@@ -130,10 +698,12 @@ class ChatGPT:
 
         return prompt
 
-    def _generate_prompt_messages_for_chatgpt_api(self, message, dialog_messages, chat_mode):
+    def _generate_prompt_messages_for_chatgpt_api(self, message, dialog_messages, chat_mode, dialog_summary=None):
         prompt = CHAT_MODES[chat_mode]["prompt_start"]
         
         messages = [{"role": "system", "content": prompt}]
+        if dialog_summary is not None:
+            messages.append({"role": "system", "content": dialog_summary_prompt(dialog_summary)})
         for dialog_message in dialog_messages:
             messages.append({"role": "user", "content": dialog_message["user"]})
             messages.append({"role": "assistant", "content": dialog_message["bot"]})
@@ -141,34 +711,75 @@ class ChatGPT:
 
         return messages
 
+    async def summarize_dialog(self, dialog_messages, dialog_summary=None):
+        """Сворачивает самые старые сообщения dialog_messages в краткое содержание, дополняя dialog_summary.
+
+        Берет столько сообщений с начала, сколько помещается в контекст модели.
+        Возвращает (summary, n_used_tokens, n_dialog_messages_summarized).
+        """
+        current_summary = dialog_summary["summary"] if dialog_summary is not None else "(empty)"
+
+        token_budget = MODEL_CONTEXT_WINDOW[self.model] - DIALOG_SUMMARY_COMPLETION_OPTIONS["max_tokens"]
+        token_budget -= 3 * tokens.CHAT_MESSAGE_TOKENS + tokens.count_text_tokens(DIALOG_SUMMARY_INSTRUCTION, model=self.model)
+        token_budget -= tokens.count_text_tokens(current_summary, model=self.model) + 20  # headers
+
+        n_tokens = 0
+        n_dialog_messages_summarized = 0
+        for dialog_message in dialog_messages:
+            n_tokens += tokens.dialog_message_tokens(dialog_message, model=self.model)
+            if n_tokens > token_budget:
+                break
+            n_dialog_messages_summarized += 1
+        if n_dialog_messages_summarized == 0:
+            raise ValueError("Dialog message is too long to be summarized")
+
+        text = f"Current summary:\n{current_summary}\n\nNew messages:\n"
+        for dialog_message in dialog_messages[:n_dialog_messages_summarized]:
+            text += f"User: {dialog_message['user']}\n"
+            text += f"Assistant: {dialog_message['bot']}\n"
+
+        # summaries are never urgent: the background lane yields to every user request
+        n_request_tokens = MODEL_CONTEXT_WINDOW[self.model] - token_budget + n_tokens
+        if self.use_chatgpt_api:
+            r = await chat_scheduler.run(
+                openai.ChatCompletion.acreate,
+                model="gpt-3.5-turbo",
+                messages=[
+                    {"role": "system", "content": DIALOG_SUMMARY_INSTRUCTION},
+                    {"role": "user", "content": text}
+                ],
+                priority=PRIORITY_BACKGROUND,
+                n_tokens=n_request_tokens,
+                **DIALOG_SUMMARY_COMPLETION_OPTIONS
+            )
+            summary = r.choices[0].message["content"]
+        else:
+            r = await chat_scheduler.run(
+                openai.Completion.acreate,
+                engine="text-davinci-003",
+                prompt=f"{DIALOG_SUMMARY_INSTRUCTION}\n\n{text}\nUpdated summary:",
+                priority=PRIORITY_BACKGROUND,
+                n_tokens=n_request_tokens,
+                **DIALOG_SUMMARY_COMPLETION_OPTIONS
+            )
+            summary = r.choices[0].text
+
+        return self._postprocess_answer(summary), r.usage.total_tokens, n_dialog_messages_summarized
+
     def _postprocess_answer(self, answer):
         answer = answer.strip()
         return answer
 
-    def _count_tokens_for_chatgpt(self, prompt_messages, answer, model="gpt-3.5-turbo"):
-        prompt_messages += [{"role": "assistant", "content": answer}]        
 
-        encoding = tiktoken.encoding_for_model(model)
-        n_tokens = 0
-        for message in prompt_messages:
-            n_tokens += 4  # every message follows "<im_start>{role/name}\n{content}<im_end>\n"
-            for key, value in message.items():            
-                if key == "role":
-                    n_tokens += 1
-                elif key == "content":
-                    n_tokens += len(encoding.encode(value))
-                else:
-                    raise ValueError(f"Unknown key in message: {key}")
-                    
-        n_tokens -= 1  # remove 1 "<im_end>" token          
-        return n_tokens
+async def transcribe_audio(audio_file, priority=PRIORITY_FREE):
+    async def request(**kwargs):
+        audio_file.seek(0)  # a retry has to upload the file again
+        return await openai.Audio.atranscribe("whisper-1", audio_file, **kwargs)
 
-    def _count_tokens_for_gpt(self, prompt, answer, model="text-davinci-003"):
-        encoding = tiktoken.encoding_for_model(model)
-        n_tokens = len(encoding.encode(prompt)) + len(encoding.encode(answer)) + 1
-        return n_tokens
+    r = await audio_scheduler.run(request, priority=priority)
+    return r["text"]
 
 
-async def transcribe_audio(audio_file):
-    r = await openai.Audio.atranscribe("whisper-1", audio_file)
-    return r["text"]
\ No newline at end of file
+async def generate_images(prompt, n_images=1, size="1024x1024", priority=PRIORITY_FREE):
+    r = await image_scheduler.run(openai.Image.acreate, prompt=prompt, n=n_images, size=size, priority=priority)
+    return [item["url"] for item in r["data"]]
\ No newline at end of file
@@ -0,0 +1,524 @@
+'''
+Встроенное хранилище на SQLite (WAL) с той же семантикой, что и MongoStorage.
+
+Позволяет запускать бота на одной машине без MongoDB, а бенчмарки горячего пути - офлайн
+(path=":memory:"). Все обращения к базе идут через один рабочий поток: event loop
+не блокируется, а каждая операция выполняется в своей транзакции атомарно.
+Сообщения диалогов лежат в отдельной таблице с ключом (dialog_id, seq), поэтому
+дописывание, удаление последнего сообщения и чтение "хвоста" диалога стоят O(1) от его длины.
+'''
+
+import asyncio
+import sqlite3
+from pathlib import Path
+from datetime import datetime
+from typing import Optional, List
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import (Storage, write_csv, USERS_EXPORT_HEADER, user_export_row,
+                     PAYMENTS_EXPORT_HEADER, payment_export_row,
+                     ARCHIVE_BATCH_SIZE, archive_dialog_document, unarchive_dialog_document, new_archive_report)
+
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+sqlite3.register_converter("BOOLEAN", lambda value: bool(int(value)))
+
+USER_COLUMNS = [
+    "_id", "chat_id", "username", "first_name", "last_name", "last_interaction", "first_seen",
+    "current_dialog_id", "current_chat_mode", "n_used_tokens", "s_date", "usd_rate",
+    "token_limit", "is_admin", "is_paid_sub",
+]
+DIALOG_COLUMNS = ["_id", "user_id", "chat_mode", "start_time"]
+DIALOG_ARCHIVE_COLUMNS = ["_id", "user_id", "chat_mode", "start_time", "archived_at", "n_messages", "codec", "data"]
+PAYMENT_COLUMNS = [
+    "_id", "telegram_payment_charge_id", "date", "user_id", "username", "first_name", "last_name",
+    "total_amount", "currency", "n_tokens", "credited",
+]
+
+# (version, description, sql script), same versions as migrations.MIGRATIONS for MongoDB
+SCHEMA_MIGRATIONS = [
+    (1, "users, dialogs and dialog_messages tables with indexes", """
+        CREATE TABLE IF NOT EXISTS users (
+            _id INTEGER PRIMARY KEY,
+            chat_id INTEGER,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            last_interaction TIMESTAMP,
+            first_seen TIMESTAMP,
+            current_dialog_id TEXT,
+            current_chat_mode TEXT,
+            n_used_tokens INTEGER NOT NULL DEFAULT 0,
+            s_date TIMESTAMP,
+            usd_rate REAL,
+            token_limit INTEGER NOT NULL DEFAULT 0,
+            is_admin BOOLEAN NOT NULL DEFAULT 0,
+            is_paid_sub BOOLEAN NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS users_is_paid_sub ON users (is_paid_sub);
+        CREATE INDEX IF NOT EXISTS users_last_interaction ON users (last_interaction);
+        CREATE INDEX IF NOT EXISTS users_username ON users (username);
+        CREATE INDEX IF NOT EXISTS users_token_limit ON users (token_limit);
+
+        CREATE TABLE IF NOT EXISTS dialogs (
+            _id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            chat_mode TEXT,
+            start_time TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS dialogs_user_id_start_time ON dialogs (user_id, start_time DESC);
+
+        CREATE TABLE IF NOT EXISTS dialog_messages (
+            dialog_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            user_message TEXT,
+            bot_message TEXT,
+            date TIMESTAMP,
+            n_tokens INTEGER,
+            PRIMARY KEY (dialog_id, seq)
+        ) WITHOUT ROWID;
+    """),
+    (2, "payments table with indexes", """
+        CREATE TABLE IF NOT EXISTS payments (
+            _id TEXT PRIMARY KEY,
+            telegram_payment_charge_id TEXT,
+            date TIMESTAMP,
+            user_id INTEGER,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            total_amount REAL,
+            currency TEXT,
+            n_tokens INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS payments_user_id_date ON payments (user_id, date DESC);
+        CREATE INDEX IF NOT EXISTS payments_date ON payments (date);
+    """),
+    (3, "dialog_archive table, dialogs.start_time and users.current_dialog_id indexes", """
+        CREATE TABLE IF NOT EXISTS dialog_archive (
+            _id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            chat_mode TEXT,
+            start_time TIMESTAMP,
+            archived_at TIMESTAMP,
+            n_messages INTEGER,
+            codec TEXT,
+            data BLOB
+        );
+        CREATE INDEX IF NOT EXISTS dialog_archive_user_id_start_time ON dialog_archive (user_id, start_time DESC);
+        CREATE INDEX IF NOT EXISTS dialogs_start_time ON dialogs (start_time);
+        CREATE INDEX IF NOT EXISTS users_current_dialog_id ON users (current_dialog_id);
+    """),
+    (4, "dialogs.summary and dialogs.summary_until columns", """
+        ALTER TABLE dialogs ADD COLUMN summary TEXT;
+        ALTER TABLE dialogs ADD COLUMN summary_until TIMESTAMP;
+    """),
+    (5, "payments.credited column", """
+        ALTER TABLE payments ADD COLUMN credited BOOLEAN NOT NULL DEFAULT 1;
+        CREATE INDEX IF NOT EXISTS payments_uncredited ON payments (credited) WHERE credited = 0;
+    """),
+]
+
+
+def _message_from_row(row) -> dict:
+    dialog_message = {"user": row["user_message"], "bot": row["bot_message"], "date": row["date"]}
+    if row["n_tokens"] is not None:
+        dialog_message["n_tokens"] = row["n_tokens"]
+    return dialog_message
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        # one worker thread owns the connection: operations are serialized and never block the event loop
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite_storage")
+        self._conn = self._connect()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    # lifecycle
+    async def migrate(self) -> list:
+        return await self._run(self._migrate)
+
+    def _migrate(self) -> list:
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS schema_migrations (_id INTEGER PRIMARY KEY, description TEXT, applied_at TIMESTAMP)"
+            )
+            applied_versions = {row["_id"] for row in self._conn.execute("SELECT _id FROM schema_migrations")}
+
+        newly_applied = []
+        for version, description, script in SCHEMA_MIGRATIONS:
+            if version in applied_versions:
+                continue
+            # executescript commits whatever is pending and then runs in autocommit mode: the explicit BEGIN
+            # keeps the script and its version row in one transaction, so a crash can't apply it half or twice
+            try:
+                self._conn.executescript(f"BEGIN;\n{script}")
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO schema_migrations (_id, description, applied_at) VALUES (?, ?, ?)",
+                    (version, description, datetime.now())
+                )
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+            newly_applied.append(version)
+        return newly_applied
+
+    async def close(self):
+        await self._run(self._conn.close)
+        self._executor.shutdown(wait=True)
+
+    # users
+    async def find_user(self, user_id: int) -> Optional[dict]:
+        return await self._run(self._find_user, user_id)
+
+    def _find_user(self, user_id: int) -> Optional[dict]:
+        row = self._conn.execute("SELECT * FROM users WHERE _id = ?", (user_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    async def insert_user(self, user_dict: dict):
+        await self.insert_users([user_dict])
+
+    async def insert_users(self, user_dicts: List[dict]):
+        await self._run(self._insert_users, user_dicts)
+
+    def _insert_users(self, user_dicts: List[dict]):
+        sql = f"INSERT INTO users ({', '.join(USER_COLUMNS)}) VALUES ({', '.join('?' * len(USER_COLUMNS))})"
+        with self._conn:
+            self._conn.executemany(sql, [[user_dict.get(column) for column in USER_COLUMNS] for user_dict in user_dicts])
+
+    def _check_user_columns(self, fields):
+        for key in fields:
+            if key not in USER_COLUMNS or key == "_id":
+                raise ValueError(f"Unknown user field {key}")
+
+    async def update_user(self, user_id: int, fields: dict) -> bool:
+        self._check_user_columns(fields)
+        return await self._run(self._update_user, user_id, fields)
+
+    def _update_user(self, user_id: int, fields: dict) -> bool:
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        with self._conn:
+            cursor = self._conn.execute(f"UPDATE users SET {assignments} WHERE _id = ?", (*fields.values(), user_id))
+        return cursor.rowcount > 0
+
+    async def inc_user(self, user_id: int, inc: dict, set_fields: Optional[dict] = None) -> Optional[dict]:
+        set_fields = set_fields or {}
+        self._check_user_columns(inc)
+        self._check_user_columns(set_fields)
+        return await self._run(self._inc_user, user_id, inc, set_fields)
+
+    def _inc_user(self, user_id: int, inc: dict, set_fields: dict) -> Optional[dict]:
+        assignments = [f"{key} = {key} + ?" for key in inc] + [f"{key} = ?" for key in set_fields]
+        with self._conn:
+            cursor = self._conn.execute(
+                f"UPDATE users SET {', '.join(assignments)} WHERE _id = ?",
+                (*inc.values(), *set_fields.values(), user_id)
+            )
+            if cursor.rowcount == 0:
+                return None
+            return self._find_user(user_id)
+
+    async def clear_overdraft(self, user_id: int) -> Optional[dict]:
+        return await self._run(self._clear_overdraft, user_id)
+
+    def _clear_overdraft(self, user_id: int) -> Optional[dict]:
+        with self._conn:
+            cursor = self._conn.execute("UPDATE users SET token_limit = 0 WHERE _id = ? AND token_limit < 0", (user_id,))
+            if cursor.rowcount == 0:
+                return None
+            return self._find_user(user_id)
+
+    async def max_last_interactions(self, last_interactions: dict):
+        await self._run(self._max_last_interactions, last_interactions)
+
+    def _max_last_interactions(self, last_interactions: dict):
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE users SET last_interaction = ? WHERE _id = ? AND (last_interaction IS NULL OR last_interaction < ?)",
+                [(when, user_id, when) for user_id, when in last_interactions.items()]
+            )
+
+    async def refill_balances(self, token_limit: int) -> List[int]:
+        return await self._run(self._refill_balances, token_limit)
+
+    def _refill_balances(self, token_limit: int) -> List[int]:
+        with self._conn:
+            user_ids_list = [row["_id"] for row in self._conn.execute("SELECT _id FROM users WHERE token_limit < ?", (token_limit,))]
+            self._conn.execute("UPDATE users SET token_limit = ? WHERE token_limit < ?", (token_limit, token_limit))
+        return user_ids_list
+
+    async def find_broadcast_user_ids(self, exclude_username: str) -> List[int]:
+        return await self._run(self._find_broadcast_user_ids, exclude_username)
+
+    def _find_broadcast_user_ids(self, exclude_username: str) -> List[int]:
+        # IS NOT keeps users without username, like $ne in MongoDB
+        return [row["_id"] for row in self._conn.execute("SELECT _id FROM users WHERE username IS NOT ?", (exclude_username,))]
+
+    async def delete_user(self, user_id: int) -> bool:
+        return await self._run(self._delete_user, user_id)
+
+    def _delete_user(self, user_id: int) -> bool:
+        with self._conn:
+            cursor = self._conn.execute("DELETE FROM users WHERE _id = ?", (user_id,))
+        return cursor.rowcount > 0
+
+    # dialogs
+    def _dialog_exists(self, user_id: int, dialog_id: str) -> bool:
+        row = self._conn.execute("SELECT 1 FROM dialogs WHERE _id = ? AND user_id = ?", (dialog_id, user_id)).fetchone()
+        return row is not None
+
+    def _insert_messages(self, dialog_id: str, first_seq: int, dialog_messages: list):
+        self._conn.executemany(
+            "INSERT INTO dialog_messages (dialog_id, seq, user_message, bot_message, date, n_tokens) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (dialog_id, seq, dialog_message["user"], dialog_message["bot"], dialog_message.get("date"), dialog_message.get("n_tokens"))
+                for seq, dialog_message in enumerate(dialog_messages, start=first_seq)
+            ]
+        )
+
+    async def insert_dialog(self, dialog_dict: dict):
+        await self._run(self._insert_dialog, dialog_dict)
+
+    def _insert_dialog(self, dialog_dict: dict):
+        with self._conn:
+            self._conn.execute(
+                f"INSERT INTO dialogs ({', '.join(DIALOG_COLUMNS)}) VALUES ({', '.join('?' * len(DIALOG_COLUMNS))})",
+                [dialog_dict.get(column) for column in DIALOG_COLUMNS]
+            )
+            self._insert_messages(dialog_dict["_id"], 0, dialog_dict.get("messages", []))
+
+    async def get_dialog_messages(self, user_id: int, dialog_id: str) -> Optional[list]:
+        return await self._run(self._get_dialog_messages, user_id, dialog_id)
+
+    def _get_dialog_messages(self, user_id: int, dialog_id: str) -> Optional[list]:
+        if not self._dialog_exists(user_id, dialog_id):
+            return None
+        rows = self._conn.execute("SELECT * FROM dialog_messages WHERE dialog_id = ? ORDER BY seq", (dialog_id,))
+        return [_message_from_row(row) for row in rows]
+
+    async def get_dialog_window(self, user_id: int, dialog_id: str, max_messages: int, summary_until: Optional[datetime] = None):
+        return await self._run(self._get_dialog_window, user_id, dialog_id, max_messages, summary_until)
+
+    def _get_dialog_window(self, user_id: int, dialog_id: str, max_messages: int, summary_until: Optional[datetime]):
+        if not self._dialog_exists(user_id, dialog_id):
+            return [], 0
+
+        condition, params = "dialog_id = ?", (dialog_id,)
+        if summary_until is not None:
+            condition, params = "dialog_id = ? AND date > ?", (dialog_id, summary_until)
+        n_messages = self._conn.execute(f"SELECT COUNT(*) FROM dialog_messages WHERE {condition}", params).fetchone()[0]
+        rows = self._conn.execute(
+            f"SELECT * FROM dialog_messages WHERE {condition} ORDER BY seq DESC LIMIT ?", (*params, max_messages)
+        ).fetchall()
+        return [_message_from_row(row) for row in reversed(rows)], n_messages
+
+    async def has_dialog_messages(self, user_id: int, dialog_id: str) -> bool:
+        return await self._run(self._has_dialog_messages, user_id, dialog_id)
+
+    def _has_dialog_messages(self, user_id: int, dialog_id: str) -> bool:
+        if not self._dialog_exists(user_id, dialog_id):
+            return False
+        return self._conn.execute("SELECT 1 FROM dialog_messages WHERE dialog_id = ? LIMIT 1", (dialog_id,)).fetchone() is not None
+
+    async def set_dialog_messages(self, user_id: int, dialog_id: str, dialog_messages: list):
+        await self._run(self._set_dialog_messages, user_id, dialog_id, dialog_messages)
+
+    def _set_dialog_messages(self, user_id: int, dialog_id: str, dialog_messages: list):
+        with self._conn:
+            if not self._dialog_exists(user_id, dialog_id):
+                return
+            self._conn.execute("DELETE FROM dialog_messages WHERE dialog_id = ?", (dialog_id,))
+            self._insert_messages(dialog_id, 0, dialog_messages)
+
+    async def push_dialog_message(self, user_id: int, dialog_id: str, dialog_message: dict, max_messages: Optional[int] = None):
+        await self._run(self._push_dialog_message, user_id, dialog_id, dialog_message, max_messages)
+
+    def _push_dialog_message(self, user_id: int, dialog_id: str, dialog_message: dict, max_messages: Optional[int]):
+        with self._conn:
+            if not self._dialog_exists(user_id, dialog_id):
+                return
+            last_seq = self._conn.execute("SELECT MAX(seq) FROM dialog_messages WHERE dialog_id = ?", (dialog_id,)).fetchone()[0]
+            seq = 0 if last_seq is None else last_seq + 1
+            self._insert_messages(dialog_id, seq, [dialog_message])
+
+            if max_messages is not None:
+                self._conn.execute("DELETE FROM dialog_messages WHERE dialog_id = ? AND seq <= ?", (dialog_id, seq - max_messages))
+
+    async def pop_dialog_message(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        return await self._run(self._pop_dialog_message, user_id, dialog_id)
+
+    def _pop_dialog_message(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        with self._conn:
+            if not self._dialog_exists(user_id, dialog_id):
+                return None
+            row = self._conn.execute(
+                "SELECT * FROM dialog_messages WHERE dialog_id = ? ORDER BY seq DESC LIMIT 1", (dialog_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("DELETE FROM dialog_messages WHERE dialog_id = ? AND seq = ?", (dialog_id, row["seq"]))
+        return _message_from_row(row)
+
+    async def get_dialog_summary(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        return await self._run(self._get_dialog_summary, user_id, dialog_id)
+
+    def _get_dialog_summary(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        row = self._conn.execute(
+            "SELECT summary, summary_until FROM dialogs WHERE _id = ? AND user_id = ? AND summary IS NOT NULL", (dialog_id, user_id)
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    async def set_dialog_summary(
+        self, user_id: int, dialog_id: str, summary: str, summary_until: datetime, previous_summary_until: Optional[datetime]
+    ) -> bool:
+        return await self._run(self._set_dialog_summary, user_id, dialog_id, summary, summary_until, previous_summary_until)
+
+    def _set_dialog_summary(
+        self, user_id: int, dialog_id: str, summary: str, summary_until: datetime, previous_summary_until: Optional[datetime]
+    ) -> bool:
+        # IS compares NULL too: a dialog that was never summarized has summary_until NULL
+        with self._conn:
+            cursor = self._conn.execute(
+                "UPDATE dialogs SET summary = ?, summary_until = ? WHERE _id = ? AND user_id = ? AND summary_until IS ?",
+                (summary, summary_until, dialog_id, user_id, previous_summary_until)
+            )
+        return cursor.rowcount > 0
+
+    async def archive_dialogs(self, older_than: datetime, batch_size: int = ARCHIVE_BATCH_SIZE) -> dict:
+        report = new_archive_report()
+        archived_at = datetime.now()
+
+        # one transaction per batch, so regular operations get the worker between batches
+        while True:
+            n_dialogs = await self._run(self._archive_batch, older_than, batch_size, archived_at, report)
+            if n_dialogs < batch_size:
+                return report
+
+    def _archive_batch(self, older_than: datetime, batch_size: int, archived_at: datetime, report: dict) -> int:
+        with self._conn:
+            # archived rows are deleted, current dialogs are filtered out: the same query yields the next batch
+            dialog_rows = self._conn.execute(
+                """
+                SELECT * FROM dialogs
+                WHERE start_time < ? AND NOT EXISTS (SELECT 1 FROM users WHERE users.current_dialog_id = dialogs._id)
+                ORDER BY start_time LIMIT ?
+                """,
+                (older_than, batch_size)
+            ).fetchall()
+
+            for dialog_row in dialog_rows:
+                dialog_dict = dict(dialog_row)
+                rows = self._conn.execute("SELECT * FROM dialog_messages WHERE dialog_id = ? ORDER BY seq", (dialog_dict["_id"],))
+                dialog_dict["messages"] = [_message_from_row(row) for row in rows]
+
+                archive_dict, raw_bytes = archive_dialog_document(dialog_dict, archived_at)
+                self._conn.execute(
+                    f"INSERT OR REPLACE INTO dialog_archive ({', '.join(DIALOG_ARCHIVE_COLUMNS)}) VALUES ({', '.join('?' * len(DIALOG_ARCHIVE_COLUMNS))})",
+                    [archive_dict[column] for column in DIALOG_ARCHIVE_COLUMNS]
+                )
+                self._conn.execute("DELETE FROM dialog_messages WHERE dialog_id = ?", (dialog_dict["_id"],))
+                self._conn.execute("DELETE FROM dialogs WHERE _id = ?", (dialog_dict["_id"],))
+
+                report["n_dialogs"] += 1
+                report["n_messages"] += archive_dict["n_messages"]
+                report["raw_bytes"] += raw_bytes
+                report["archived_bytes"] += len(archive_dict["data"])
+        return len(dialog_rows)
+
+    async def get_archived_dialog(self, dialog_id: str) -> Optional[dict]:
+        return await self._run(self._get_archived_dialog, dialog_id)
+
+    def _get_archived_dialog(self, dialog_id: str) -> Optional[dict]:
+        row = self._conn.execute("SELECT * FROM dialog_archive WHERE _id = ?", (dialog_id,)).fetchone()
+        if row is None:
+            return None
+        return unarchive_dialog_document(dict(row))
+
+    # payments
+    async def insert_payment(self, payment_dict: dict) -> bool:
+        return await self._run(self._insert_payment, payment_dict)
+
+    def _insert_payment(self, payment_dict: dict) -> bool:
+        try:
+            with self._conn:
+                self._conn.execute(
+                    f"INSERT INTO payments ({', '.join(PAYMENT_COLUMNS)}) VALUES ({', '.join('?' * len(PAYMENT_COLUMNS))})",
+                    [payment_dict.get(column) for column in PAYMENT_COLUMNS]
+                )
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    async def credit_payment(self, payment_id: str) -> Optional[dict]:
+        return await self._run(self._credit_payment, payment_id)
+
+    def _credit_payment(self, payment_id: str) -> Optional[dict]:
+        # one transaction: the top-up and the ledger flag are written together or not at all
+        with self._conn:
+            row = self._conn.execute("SELECT user_id, n_tokens FROM payments WHERE _id = ? AND credited = 0", (payment_id,)).fetchone()
+            if row is None:
+                return None
+
+            cursor = self._conn.execute(
+                "UPDATE users SET token_limit = token_limit + ?, is_paid_sub = 1 WHERE _id = ?", (row["n_tokens"], row["user_id"])
+            )
+            if cursor.rowcount == 0:
+                return None
+            self._mark_payment_credited(payment_id)
+            return self._find_user(row["user_id"])
+
+    def _mark_payment_credited(self, payment_id: str):
+        self._conn.execute("UPDATE payments SET credited = 1 WHERE _id = ?", (payment_id,))
+
+    async def find_uncredited_payments(self) -> List[dict]:
+        return await self._run(self._find_uncredited_payments)
+
+    def _find_uncredited_payments(self) -> List[dict]:
+        return [dict(row) for row in self._conn.execute("SELECT * FROM payments WHERE credited = 0")]
+
+    # exports
+    async def export_users_csv(self, path: str, paid_subs_only: bool, exclude_username: str) -> int:
+        if paid_subs_only:
+            query = "SELECT * FROM users WHERE is_paid_sub = 1", ()
+        else:
+            query = "SELECT * FROM users WHERE username IS NOT ?", (exclude_username,)
+        return await self._export(path, query, USERS_EXPORT_HEADER, user_export_row)
+
+    async def export_payments_csv(self, path: str) -> int:
+        return await self._export(path, ("SELECT * FROM payments", ()), PAYMENTS_EXPORT_HEADER, payment_export_row)
+
+    async def _export(self, path: str, query, header: list, row_func) -> int:
+        if self.path == ":memory:":
+            # an in-memory database is only visible through the main connection
+            return await self._run(self._write_csv, self._conn, path, query, header, row_func)
+
+        # WAL lets a separate reader stream the export without blocking the storage worker
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._write_csv, None, path, query, header, row_func)
+
+    def _write_csv(self, conn, path: str, query, header: list, row_func) -> int:
+        own_conn = conn is None
+        if own_conn:
+            conn = self._connect()
+        try:
+            sql, params = query
+            return write_csv(path, (dict(row) for row in conn.execute(sql, params)), header, row_func)
+        finally:
+            if own_conn:
+                conn.close()
@@ -0,0 +1,221 @@
+'''
+Интерфейс хранилища, на котором работает AsyncDatabase.
+
+Storage описывает примитивные операции над пользователями, диалогами и платежами.
+Реализации: MongoStorage (mongo_storage.py, основной вариант) и SQLiteStorage
+(sqlite_storage.py, встроенная база для запуска на одной машине, тестов и бенчмарков).
+Кэши, write-behind буферы и бизнес-логика живут в AsyncDatabase и от хранилища не зависят.
+'''
+
+import abc
+import csv
+import gzip
+import json
+import zlib
+from datetime import datetime
+from typing import Optional, Iterable, Tuple, List
+
+
+USERS_EXPORT_HEADER = ['Number', "ID", 'Username', 'First_name', 'Last_name', 'Last_interaction', 'N_used_tokens', 'Balance', 'Is_admin', 'Is_paid_sub']
+USERS_EXPORT_FIELDS = ['username', 'first_name', 'last_name', 'last_interaction', 'n_used_tokens', 'token_limit', 'is_admin', 'is_paid_sub']
+PAYMENTS_EXPORT_HEADER = ["Date", "Provider_payment_charge_id", "Telegram_payment_charge_id", "ID", 'Username', 'First_name', 'Last_name', "Total_amount", "Currency", "N_tokens"]
+PAYMENTS_EXPORT_FIELDS = ['date', 'telegram_payment_charge_id', 'user_id', 'username', 'first_name', 'last_name', 'total_amount', 'currency', 'n_tokens']
+EXPORT_BATCH_SIZE = 1000
+
+# format of archived dialog messages, the same for every backend
+ARCHIVE_CODEC = "zlib+json"
+ARCHIVE_BATCH_SIZE = 500
+
+
+def user_export_row(number: int, user: dict) -> list:
+    return [number, user['_id'], f"@{user['username']}", user['first_name'], user['last_name'], f"{str(user['last_interaction'])[:16:]}", user['n_used_tokens'], user['token_limit'], user['is_admin'], user['is_paid_sub']]
+
+
+def payment_export_row(number: int, payment: dict) -> list:
+    return [f"{str(payment['date'])[:16:]}", payment['_id'], payment['telegram_payment_charge_id'], payment['user_id'], f"@{payment['username']}", payment['first_name'], payment['last_name'], payment['total_amount'], payment['currency'], payment['n_tokens']]
+
+
+def write_csv(path: str, documents: Iterable[dict], header: list, row_func) -> int:
+    """Пишет документы построчно в gzip CSV. Вызывается из рабочего потока, возвращает количество строк."""
+    count = 0
+    with gzip.open(path, "wt", newline="", encoding="utf-8") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(header)
+        for count, document in enumerate(documents, start=1):
+            writer.writerow(row_func(count, document))
+    return count
+
+
+def encode_dialog_messages(dialog_messages: list) -> Tuple[bytes, int]:
+    """Сжимает сообщения диалога для архива. Возвращает (сжатые данные, размер до сжатия)."""
+    raw = json.dumps(dialog_messages, ensure_ascii=False, default=lambda value: value.isoformat()).encode("utf-8")
+    return zlib.compress(raw, 6), len(raw)
+
+
+def decode_dialog_messages(data: bytes) -> list:
+    dialog_messages = json.loads(zlib.decompress(data).decode("utf-8"))
+    for dialog_message in dialog_messages:
+        if dialog_message.get("date") is not None:
+            dialog_message["date"] = datetime.fromisoformat(dialog_message["date"])
+    return dialog_messages
+
+
+def archive_dialog_document(dialog_dict: dict, archived_at: datetime) -> Tuple[dict, int]:
+    """Архивная запись диалога: метаданные + сжатые сообщения. Возвращает (запись, размер сообщений до сжатия)."""
+    data, raw_bytes = encode_dialog_messages(dialog_dict["messages"])
+    archive_dict = {
+        "_id": dialog_dict["_id"],
+        "user_id": dialog_dict["user_id"],
+        "chat_mode": dialog_dict["chat_mode"],
+        "start_time": dialog_dict["start_time"],
+        "archived_at": archived_at,
+        "n_messages": len(dialog_dict["messages"]),
+        "codec": ARCHIVE_CODEC,
+        "data": data,
+    }
+    return archive_dict, raw_bytes
+
+
+def unarchive_dialog_document(archive_dict: dict) -> dict:
+    dialog_dict = {key: archive_dict[key] for key in ("_id", "user_id", "chat_mode", "start_time", "archived_at")}
+    dialog_dict["messages"] = decode_dialog_messages(archive_dict["data"])
+    return dialog_dict
+
+
+def new_archive_report() -> dict:
+    return {"n_dialogs": 0, "n_messages": 0, "raw_bytes": 0, "archived_bytes": 0}
+
+
+class Storage(abc.ABC):
+    # lifecycle
+    @abc.abstractmethod
+    async def migrate(self) -> list:
+        """Создает схему/индексы, возвращает список примененных версий миграций."""
+
+    @abc.abstractmethod
+    async def close(self):
+        pass
+
+    # users
+    @abc.abstractmethod
+    async def find_user(self, user_id: int) -> Optional[dict]:
+        pass
+
+    @abc.abstractmethod
+    async def insert_user(self, user_dict: dict):
+        pass
+
+    @abc.abstractmethod
+    async def insert_users(self, user_dicts: List[dict]):
+        pass
+
+    @abc.abstractmethod
+    async def update_user(self, user_id: int, fields: dict) -> bool:
+        """$set полей. Возвращает False, если пользователя нет."""
+
+    @abc.abstractmethod
+    async def inc_user(self, user_id: int, inc: dict, set_fields: Optional[dict] = None) -> Optional[dict]:
+        """Атомарный $inc (и $set) одним запросом. Возвращает обновленный документ или None."""
+
+    @abc.abstractmethod
+    async def clear_overdraft(self, user_id: int) -> Optional[dict]:
+        """Обнуляет token_limit, только если он отрицательный. Возвращает обновленный документ или None."""
+
+    @abc.abstractmethod
+    async def max_last_interactions(self, last_interactions: dict):
+        """Пакетно поднимает last_interaction до переданных значений ({user_id: datetime})."""
+
+    @abc.abstractmethod
+    async def refill_balances(self, token_limit: int) -> List[int]:
+        """Поднимает token_limit до token_limit всем, у кого меньше. Возвращает id пополненных."""
+
+    @abc.abstractmethod
+    async def find_broadcast_user_ids(self, exclude_username: str) -> List[int]:
+        pass
+
+    @abc.abstractmethod
+    async def delete_user(self, user_id: int) -> bool:
+        pass
+
+    # dialogs
+    @abc.abstractmethod
+    async def insert_dialog(self, dialog_dict: dict):
+        pass
+
+    @abc.abstractmethod
+    async def get_dialog_messages(self, user_id: int, dialog_id: str) -> Optional[list]:
+        pass
+
+    @abc.abstractmethod
+    async def get_dialog_window(
+        self, user_id: int, dialog_id: str, max_messages: int, summary_until: Optional[datetime] = None
+    ) -> Tuple[list, int]:
+        """Последние max_messages сообщений и общее количество сообщений в диалоге.
+        С summary_until считаются и отдаются только сообщения после него (еще не свернутые в краткое содержание).
+        """
+
+    @abc.abstractmethod
+    async def has_dialog_messages(self, user_id: int, dialog_id: str) -> bool:
+        pass
+
+    @abc.abstractmethod
+    async def set_dialog_messages(self, user_id: int, dialog_id: str, dialog_messages: list):
+        pass
+
+    @abc.abstractmethod
+    async def push_dialog_message(self, user_id: int, dialog_id: str, dialog_message: dict, max_messages: Optional[int] = None):
+        pass
+
+    @abc.abstractmethod
+    async def pop_dialog_message(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        pass
+
+    @abc.abstractmethod
+    async def get_dialog_summary(self, user_id: int, dialog_id: str) -> Optional[dict]:
+        """{"summary": str, "summary_until": datetime} или None, если диалог еще не сворачивался."""
+
+    @abc.abstractmethod
+    async def set_dialog_summary(
+        self, user_id: int, dialog_id: str, summary: str, summary_until: datetime, previous_summary_until: Optional[datetime]
+    ) -> bool:
+        """Записывает краткое содержание, только если summary_until диалога все еще previous_summary_until
+        (None - диалог еще не сворачивался). Возвращает False, если его уже обновили.
+        """
+
+    @abc.abstractmethod
+    async def archive_dialogs(self, older_than: datetime, batch_size: int = ARCHIVE_BATCH_SIZE) -> dict:
+        """Переносит диалоги, начатые раньше older_than, в сжатый архив и удаляет их из горячего хранилища.
+
+        Текущие диалоги пользователей (current_dialog_id) не трогаются.
+        Возвращает отчет new_archive_report(): количество диалогов и сообщений, байты до и после сжатия.
+        """
+
+    @abc.abstractmethod
+    async def get_archived_dialog(self, dialog_id: str) -> Optional[dict]:
+        """Диалог из архива с распакованными сообщениями или None."""
+
+    # payments
+    @abc.abstractmethod
+    async def insert_payment(self, payment_dict: dict) -> bool:
+        """Возвращает False, если платеж с таким _id уже записан."""
+
+    @abc.abstractmethod
+    async def credit_payment(self, payment_id: str) -> Optional[dict]:
+        """Атомарно пополняет баланс на n_tokens платежа (is_paid_sub = True) и отмечает платеж зачисленным.
+
+        Возвращает обновленный документ пользователя или None, если платеж уже зачислен или не найден.
+        Повтор после сбоя на любом шаге не зачисляет платеж второй раз.
+        """
+
+    @abc.abstractmethod
+    async def find_uncredited_payments(self) -> List[dict]:
+        """Платежи, записанные в журнал, но еще не зачисленные на баланс."""
+
+    # exports
+    @abc.abstractmethod
+    async def export_users_csv(self, path: str, paid_subs_only: bool, exclude_username: str) -> int:
+        pass
+
+    @abc.abstractmethod
+    async def export_payments_csv(self, path: str) -> int:
+        pass
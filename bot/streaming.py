@@ -0,0 +1,339 @@
+'''
+Потоковые ответы OpenAI.
+
+send_message_stream отдает только новые куски текста (дельты), а ответ собирается в StreamBuffer:
+добавление куска стоит O(длина куска), а строка целиком склеивается только тогда, когда ее
+действительно нужно показать пользователю.
+
+StreamRenderer показывает ответ в Telegram: первое сообщение и его правки. Правки одного чата
+объединяются по бюджету времени и размера (EditScheduler), общий поток правок ограничен глобальным
+лимитом, а финальный текст отправляется сразу, без ожидания бюджета. Когда сообщение заполняется,
+ответ продолжается в новом сообщении (граница выбирается так, чтобы не ломать разметку), и дальше
+правится только последнее.
+'''
+
+import time
+import bisect
+import asyncio
+import logging
+from collections import deque, OrderedDict
+
+import telegram
+from telegram.constants import ParseMode
+
+import formatting
+
+
+logger = logging.getLogger(__name__)
+
+
+class StreamBuffer:
+    def __init__(self, text: str = ""):
+        self._chunks = []
+        self._starts = []  # position of every chunk in the text
+        self._length = 0
+        self.append(text)
+
+    def append(self, delta: str):
+        if delta:
+            self._chunks.append(delta)
+            self._starts.append(self._length)
+            self._length += len(delta)
+
+    def getvalue(self, start: int = 0) -> str:
+        """Текст с позиции start. Склеиваются только куски после start, поэтому при растущем start
+        (отрисовка последнего сообщения длинного ответа) стоимость не зависит от длины всего ответа.
+        """
+        if start >= self._length:
+            return ""
+
+        i = bisect.bisect_right(self._starts, start) - 1
+        if self._starts[i] < start:
+            # split the chunk at start, so the text before it is never copied again
+            chunk, cut = self._chunks[i], start - self._starts[i]
+            self._chunks[i:i + 1] = [chunk[:cut], chunk[cut:]]
+            self._starts.insert(i + 1, start)
+            i += 1
+
+        # joined chunks are kept as one, so the next call only joins what arrived since
+        if i < len(self._chunks) - 1:
+            self._chunks[i:] = ["".join(self._chunks[i:])]
+            del self._starts[i + 1:]
+        return self._chunks[i]
+
+    def __len__(self):
+        return self._length
+
+    def __str__(self):
+        return self.getvalue()
+
+
+def find_split_point(text: str, limit: int, html: bool = False) -> int:
+    """Где закончить сообщение из начала text длиной не больше limit, не ломая разметку.
+
+    Предпочитается конец абзаца, затем строки, затем слова - вне блоков кода (``` в Markdown, <pre>/<code> в HTML)
+    и только во второй половине сообщения (позже limit // 2), чтобы сообщения не выходили короткими. Если такого места
+    нет, текст режется по строке или слову внутри блока, а в крайнем случае - ровно по limit, но не посреди
+    HTML-тега или сущности.
+    """
+    if len(text) <= limit:
+        return len(text)
+
+    window = text[:limit]
+    for outside_blocks in (True, False):
+        for separator in ("\n\n", "\n", " "):
+            position = window.rfind(separator)
+            while position > limit // 2:
+                if not outside_blocks or not _inside_block(window[:position], html):
+                    return position + len(separator)
+                position = window.rfind(separator, 0, position)
+
+    split = limit
+    if html:
+        tag_start, entity_start = window.rfind("<"), window.rfind("&")
+        if tag_start > window.rfind(">"):
+            split = tag_start
+        elif entity_start > window.rfind(";"):
+            split = entity_start
+    return split if split > 0 else limit
+
+
+def _inside_block(text: str, html: bool) -> bool:
+    if html:
+        if text.rfind("<") > text.rfind(">"):
+            return True
+        return text.count("<pre") > text.count("</pre>") or text.count("<code") > text.count("</code>")
+    return text.count("```") % 2 == 1
+
+
+class EditScheduler:
+    """Бюджет правок сообщений: не чаще раза в interval секунд на чат и не больше global_rate правок в секунду на бота.
+
+    Правка делается, когда бюджет чата позволяет и набралось min_chars новых символов (или прошло
+    idle_flush секунд с прошлой правки). Если правка выполнялась дольше интервала чата (Telegram
+    притормозил нас через flood limit), интервал чата удваивается, а после быстрых правок плавно возвращается.
+    """
+
+    MAX_CHATS = 10000
+
+    def __init__(self, interval: float = 1.0, min_chars: int = 100, global_rate: float = 25, idle_flush: float = 3.0):
+        self.interval = interval
+        self.max_interval = 8 * interval
+        self.min_chars = min_chars
+        self.global_rate = global_rate
+        self.idle_flush = idle_flush
+
+        self._chats = OrderedDict()  # chat_id -> [last_edit_time, interval]
+        self._recent_edits = deque()  # times of edits during the last second, all chats
+
+        self.n_answers = 0
+        self.n_edits = 0
+        self.n_skipped = 0
+        self.n_slow_edits = 0
+        self.n_repaired = 0
+        self.n_parse_errors = 0
+        self.total_time_to_final = 0.0
+        self.max_time_to_final = 0.0
+
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = [0.0, self.interval]
+            while len(self._chats) > self.MAX_CHATS:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(chat_id)
+        return chat
+
+    def _global_available(self, now: float) -> bool:
+        while self._recent_edits and self._recent_edits[0] <= now - 1:
+            self._recent_edits.popleft()
+        return len(self._recent_edits) < self.global_rate
+
+    def should_edit(self, chat_id, n_new_chars: int) -> bool:
+        """True - правка разрешена, и ее место в бюджетах уже занято: вызывающий передает reserved=True в record."""
+        if n_new_chars <= 0:
+            return False
+
+        now = time.monotonic()
+        chat = self._chat(chat_id)
+        since_last_edit = now - chat[0]
+        if since_last_edit < chat[1] or (n_new_chars < self.min_chars and since_last_edit < self.idle_flush):
+            self.n_skipped += 1
+            return False
+        if not self._global_available(now):
+            self.n_skipped += 1
+            return False
+
+        # reserve the slot before the edit is awaited, so concurrent streams can't all pass in the same tick
+        chat[0] = now
+        self._recent_edits.append(now)
+        return True
+
+    def final_delay(self, chat_id) -> float:
+        """Сколько подождать перед финальной правкой, чтобы не упереться в лимит чата (это быстрее, чем flood wait)."""
+        last_edit_time, interval = self._chat(chat_id)
+        return max(0.0, last_edit_time + self.interval - time.monotonic())
+
+    def record(self, chat_id, started_at: float, edit: bool = True, reserved: bool = False):
+        """Учитывает отправку (edit=False) или правку сообщения, начатую в started_at.
+        reserved - место в общем бюджете уже заняла should_edit."""
+        now = time.monotonic()
+        chat = self._chat(chat_id)
+        chat[0] = now
+        if not reserved:
+            self._recent_edits.append(now)
+        if not edit:
+            return
+
+        if now - started_at > chat[1]:
+            # the edit was held back by Telegram: give this chat more room
+            chat[1] = min(self.max_interval, chat[1] * 2)
+            self.n_slow_edits += 1
+        else:
+            chat[1] = max(self.interval, chat[1] * 0.9)
+        self.n_edits += 1
+
+    def record_answer(self, time_to_final: float):
+        self.n_answers += 1
+        self.total_time_to_final += time_to_final
+        self.max_time_to_final = max(self.max_time_to_final, time_to_final)
+
+    def stats(self) -> dict:
+        return {
+            "answers": self.n_answers,
+            "edits": self.n_edits,
+            "skipped": self.n_skipped,
+            "slow_edits": self.n_slow_edits,
+            "repaired": self.n_repaired,
+            "parse_errors": self.n_parse_errors,
+            "edits_per_answer": self.n_edits / self.n_answers if self.n_answers > 0 else 0.0,
+            "time_to_final_avg": self.total_time_to_final / self.n_answers if self.n_answers > 0 else 0.0,
+            "time_to_final_max": self.max_time_to_final,
+        }
+
+
+class StreamRenderer:
+    """Показывает один потоковый ответ сообщениями в ответ на reply_to: правит последнее и начинает новое,
+    когда текст перестает помещаться в max_length.
+    """
+
+    def __init__(self, bot, reply_to, parse_mode, scheduler: EditScheduler, max_length: int = 4096):
+        self.bot = bot
+        self.reply_to = reply_to
+        self.chat_id = reply_to.chat_id
+        self.parse_mode = parse_mode
+        self.html = parse_mode == ParseMode.HTML
+        self.scheduler = scheduler
+        self.max_length = max_length
+
+        self.message = None  # the last message, the only one that is still edited
+        self.n_messages = 0
+        self.offset = 0  # where the last message starts in the answer
+        self.markup_prefix = ""  # markup left open by the previous message, reopened in the last one
+        self.n_leading_spaces = 0  # skipped before the first message; the final answer comes stripped
+        self.rendered_length = 0
+        self.n_edits = 0
+        self.reserved = False  # should_edit took a slot that the next send or edit uses up
+        self.started_at = time.monotonic()
+
+    async def update(self, buffer: StreamBuffer):
+        """Показывает текущий текст, если бюджет чата позволяет. Склеивается только текст последнего сообщения."""
+        n_new_chars = len(buffer) - self.rendered_length
+        if self.n_messages == 0:
+            if n_new_chars <= 0:
+                return
+        elif not self.scheduler.should_edit(self.chat_id, n_new_chars):
+            return
+        else:
+            self.reserved = True
+
+        try:
+            await self._render(buffer.getvalue(self.offset))
+        finally:
+            # an unused reservation (nothing changed) simply expires with the budget window
+            self.reserved = False
+        self.rendered_length = len(buffer)
+
+    async def finish(self, text: str):
+        """Финальный текст отправляется вне бюджета: ждем не дольше базового интервала чата."""
+        await self._render(text[self.offset - self.n_leading_spaces:], final=True)
+
+        time_to_final = time.monotonic() - self.started_at
+        self.scheduler.record_answer(time_to_final)
+        logger.debug(
+            f"Answer in chat {self.chat_id}: {self.n_messages} messages, {self.n_edits} edits, final text after {time_to_final:.2f}s"
+        )
+
+    async def _render(self, text: str, final: bool = False):
+        """text - все, что начиная с последнего сообщения."""
+        if self.n_messages == 0:
+            stripped_text = text.lstrip()
+            self.n_leading_spaces += len(text) - len(stripped_text)
+            self.offset = self.n_leading_spaces
+            text = stripped_text
+            if not text:
+                return
+
+        while len(text) > self.max_length:
+            # the last message is full: finish it at a safe point and go on in a new one
+            split = find_split_point(text, self.max_length, html=self.html)
+            await self._show(text[:split], final=True)
+            self.message = None
+            self.markup_prefix = formatting.open_markup(self.markup_prefix + text[:split], self.parse_mode)
+
+            rest = text[split:]
+            next_text = rest.lstrip()
+            self.offset += split + len(rest) - len(next_text)
+            text = next_text
+
+        if text:
+            await self._show(text, final=final)
+
+    async def _show(self, text: str, final: bool = False):
+        # markup is repaired locally, so Telegram does not have to reject it first
+        raw_text = self.markup_prefix + text
+        text, parse_mode = formatting.prepare(raw_text, self.parse_mode)
+        if text != raw_text:
+            self.scheduler.n_repaired += 1
+
+        if final and self.message is not None:
+            await asyncio.sleep(self.scheduler.final_delay(self.chat_id))
+
+        if self.message is None:
+            if self.n_messages > 0:
+                await asyncio.sleep(self.scheduler.final_delay(self.chat_id))
+            await self._send(text, parse_mode)
+        else:
+            await self._edit(text, parse_mode)
+
+    async def _send(self, text: str, parse_mode):
+        started_at = time.monotonic()
+        try:
+            self.message = await self.reply_to.reply_text(text, parse_mode=parse_mode)
+        except telegram.error.BadRequest as e:
+            if str(e).startswith("Message must be non-empty"):
+                return
+            self.scheduler.n_parse_errors += 1
+            self.message = await self.reply_to.reply_text(text)
+
+        self.n_messages += 1
+        self.scheduler.record(self.chat_id, started_at, edit=False, reserved=self._use_reservation())
+
+    async def _edit(self, text: str, parse_mode):
+        started_at = time.monotonic()
+        try:
+            await self.bot.edit_message_text(
+                text, chat_id=self.message.chat_id, message_id=self.message.message_id, parse_mode=parse_mode
+            )
+        except telegram.error.BadRequest as e:
+            if str(e).startswith("Message is not modified"):
+                return
+            self.scheduler.n_parse_errors += 1
+            await self.bot.edit_message_text(text, chat_id=self.message.chat_id, message_id=self.message.message_id)
+
+        self.n_edits += 1
+        self.scheduler.record(self.chat_id, started_at, reserved=self._use_reservation())
+
+    def _use_reservation(self) -> bool:
+        reserved, self.reserved = self.reserved, False
+        return reserved
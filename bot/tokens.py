@@ -0,0 +1,97 @@
+'''
+Подсчет токенов для промптов OpenAI.
+
+Энкодеры tiktoken создаются один раз на процесс, стоимость prompt_start каждого режима из CHAT_MODES
+считается при старте (warm_up), а количество токенов текстов запоминается в ограниченном LRU по хешу
+текста (сами тексты - длинные ответы - в кеше не хранятся).
+Сообщения диалога хранят свой n_tokens в БД, поэтому на каждом ходу кодируется только новый текст:
+сообщение пользователя и ответ.
+'''
+
+import hashlib
+import functools
+from collections import OrderedDict
+
+import tiktoken
+
+import config
+
+
+CHAT_MODES = config.chat_modes
+
+# every chat message follows "<im_start>{role/name}\n{content}<im_end>\n": 4 service tokens + 1 for the role
+CHAT_MESSAGE_TOKENS = 5
+TEXT_TOKENS_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model="gpt-3.5-turbo"):
+    return tiktoken.encoding_for_model(model)
+
+
+_text_tokens = OrderedDict()
+
+
+def count_text_tokens(text, model="gpt-3.5-turbo"):
+    # keyed on a digest: hashing is far cheaper than encoding and the cache holds 16 bytes per text, not the text
+    key = (hashlib.blake2b(text.encode(), digest_size=16).digest(), model)
+    n_tokens = _text_tokens.get(key)
+    if n_tokens is not None:
+        _text_tokens.move_to_end(key)
+        return n_tokens
+
+    n_tokens = len(get_encoding(model).encode(text))
+    _text_tokens[key] = n_tokens
+    if len(_text_tokens) > TEXT_TOKENS_CACHE_SIZE:
+        _text_tokens.popitem(last=False)
+    return n_tokens
+
+
+_prompt_start_tokens = {}
+
+
+def warm_up(models=("gpt-3.5-turbo",)):
+    """Загружает энкодеры и считает токены prompt_start всех режимов (вызывается при старте бота)."""
+    for model in models:
+        for chat_mode in CHAT_MODES:
+            prompt_start_tokens(chat_mode, model=model)
+
+
+def prompt_start_tokens(chat_mode, model="gpt-3.5-turbo"):
+    key = (chat_mode, model)
+    if key not in _prompt_start_tokens:
+        _prompt_start_tokens[key] = count_text_tokens(CHAT_MODES[chat_mode]["prompt_start"], model=model)
+    return _prompt_start_tokens[key]
+
+
+def count_dialog_message_tokens(dialog_message, model="gpt-3.5-turbo"):
+    """Токены, которые пара user/bot занимает в промпте (используется для поля n_tokens в диалоге)."""
+    n_tokens = 2 * CHAT_MESSAGE_TOKENS
+    n_tokens += count_text_tokens(dialog_message["user"], model=model)
+    n_tokens += count_text_tokens(dialog_message["bot"], model=model)
+    return n_tokens
+
+
+def dialog_message_tokens(dialog_message, model="gpt-3.5-turbo"):
+    # n_tokens is stored with the message when it is appended; older messages are counted (and memoized) here
+    if "n_tokens" in dialog_message:
+        return dialog_message["n_tokens"]
+    return count_dialog_message_tokens(dialog_message, model=model)
+
+
+def count_chat_tokens(message, dialog_messages, chat_mode, answer, model="gpt-3.5-turbo", summary_prompt=None):
+    """Токены запроса к ChatCompletion и ответа: system prompt (+ краткое содержание) + диалог + сообщение + ответ."""
+    n_tokens = CHAT_MESSAGE_TOKENS + prompt_start_tokens(chat_mode, model=model)
+    if summary_prompt is not None:
+        n_tokens += CHAT_MESSAGE_TOKENS + count_text_tokens(summary_prompt, model=model)
+    n_tokens += sum(dialog_message_tokens(dialog_message, model=model) for dialog_message in dialog_messages)
+    n_tokens += CHAT_MESSAGE_TOKENS + count_text_tokens(message, model=model)
+    n_tokens += CHAT_MESSAGE_TOKENS + count_text_tokens(answer, model=model)
+    n_tokens -= 1  # remove 1 "<im_end>" token
+    return n_tokens
+
+
+def count_completion_tokens(prompt, answer, model="text-davinci-003"):
+    """Токены запроса к Completion и ответа. Промпт - одна строка, поэтому кодируется целиком."""
+    encoding = get_encoding(model)
+    return len(encoding.encode(prompt)) + count_text_tokens(answer, model=model) + 1
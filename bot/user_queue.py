@@ -0,0 +1,137 @@
+'''
+Очередь сообщений пользователя.
+
+Пока бот отвечает пользователю, его следующие сообщения не отклоняются, а ждут в очереди и обрабатываются
+по порядку. Очередь ограничена max_depth ожидающими сообщениями; при переполнении drop_policy решает,
+что выбросить:
+    - "reject_new": новое сообщение (пользователь получает "подождите");
+    - "drop_oldest": самое старое ожидающее, новое встает в конец очереди.
+
+Состояние хранится только для пользователей, у которых есть сообщение в работе или в очереди:
+запись удаляется, как только очередь пользователя опустела.
+'''
+
+import time
+import asyncio
+import contextlib
+from collections import deque
+
+
+ADMITTED = "admitted"
+REJECTED = "rejected"  # the queue is full
+DROPPED = "dropped"  # waited in the queue and was pushed out by a newer message
+
+REJECT_NEW = "reject_new"
+DROP_OLDEST = "drop_oldest"
+DROP_POLICIES = (REJECT_NEW, DROP_OLDEST)
+
+
+class UserRequestQueue:
+    def __init__(self, max_depth: int = 3, drop_policy: str = REJECT_NEW):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Drop policy {drop_policy} is not supported")
+
+        self.max_depth = max_depth
+        self.drop_policy = drop_policy
+        self._waiters = {}  # user_id -> deque of futures of waiting messages; present while the user is busy
+
+        self.n_processed = 0
+        self.n_queued = 0
+        self.n_rejected = 0
+        self.n_dropped = 0
+        self.max_seen_depth = 0
+        self.total_wait = 0.0
+
+    def is_busy(self, user_id) -> bool:
+        return user_id in self._waiters
+
+    def depth(self, user_id) -> int:
+        waiters = self._waiters.get(user_id)
+        return len(waiters) if waiters is not None else 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id):
+        """Ждет очереди пользователя и отдает ADMITTED, REJECTED или DROPPED. Обрабатывать можно только ADMITTED."""
+        status = await self._acquire(user_id)
+        if status != ADMITTED:
+            yield status
+            return
+
+        try:
+            yield status
+        finally:
+            self._release(user_id)
+
+    async def _acquire(self, user_id) -> str:
+        waiters = self._waiters.get(user_id)
+        if waiters is None:
+            self._waiters[user_id] = deque()
+            self.n_processed += 1
+            return ADMITTED
+
+        if len(waiters) >= self.max_depth:
+            if self.drop_policy == REJECT_NEW or len(waiters) == 0:
+                self.n_rejected += 1
+                return REJECTED
+            oldest = self._pop_waiter(waiters)
+            if oldest is not None:
+                oldest.set_result(DROPPED)
+                self.n_dropped += 1
+
+        future = asyncio.get_running_loop().create_future()
+        waiters.append(future)
+        self.n_queued += 1
+        self.max_seen_depth = max(self.max_seen_depth, len(waiters))
+
+        started_at = time.monotonic()
+        try:
+            status = await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.result() == ADMITTED:
+                # the turn was handed over right before the cancellation: pass it on
+                self._release(user_id)
+            elif future in waiters:
+                waiters.remove(future)
+            raise
+        finally:
+            self.total_wait += time.monotonic() - started_at
+
+        if status == ADMITTED:
+            self.n_processed += 1
+        return status
+
+    def _release(self, user_id):
+        waiters = self._waiters[user_id]
+        future = self._pop_waiter(waiters)
+        if future is not None:
+            # the turn goes straight to the next message, so nobody can overtake it
+            future.set_result(ADMITTED)
+        else:
+            del self._waiters[user_id]
+
+    @staticmethod
+    def _pop_waiter(waiters):
+        # a waiter cancelled before its task got to run still sits in the deque with a done future
+        while waiters:
+            future = waiters.popleft()
+            if not future.done():
+                return future
+        return None
+
+    def stats(self) -> dict:
+        depths = [len(waiters) for waiters in self._waiters.values()]
+        return {
+            "busy_users": len(self._waiters),
+            "queued_now": sum(depths),
+            "max_depth_now": max(depths, default=0),
+            "max_depth": self.max_depth,
+            "max_seen_depth": self.max_seen_depth,
+            "processed": self.n_processed,
+            "queued": self.n_queued,
+            "rejected": self.n_rejected,
+            "dropped": self.n_dropped,
+            "wait_avg": self.total_wait / self.n_queued if self.n_queued > 0 else 0.0,
+        }
+
+    def __len__(self):
+        return len(self._waiters)